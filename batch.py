@@ -0,0 +1,290 @@
+"""
+Non-interactive (batch) processing, driven by a rules file.
+
+When a rules file has been loaded with load_rules, every question that would normally be asked with input() is answered
+from the rules instead. Questions the rules can't answer raise ReviewRequired, which is caught around each transaction
+(see review_on_failure): anything that transaction added is undone and it is written to the review queue, so that the
+rest of the transactions can still be processed. Transactions in the review queue are left unprocessed, so they will be
+asked about when the session is next run interactively.
+
+Answers given in person to questions about a transaction can also be recorded (see record_answers), keyed by the
+transaction hash, the question and how many times that question had already been asked about that transaction. When
+replaying, questions with a recorded answer are answered from it, so after a parser fix the transactions can be
+processed again only stopping at questions that weren't asked before.
+
+An example rules file:
+```
+session: fy2022                  # name of the save file for transactions.py
+load: fy2022                     # save file to continue from (optional)
+start_date: 2021-07-01
+end_date: 2022-06-30             # inclusive
+timezone: 10                     # offset of the dates from UTC
+sources: [binance-2021, coinspot, bsc]      # sources to process (optional, default all)
+wallets: [wallet1]               # names or addresses from wallets.yml (optional, default all)
+coingecko_ids:                   # ticker: coingecko ID, or null to never use coingecko for that ticker
+  cake: pancakeswap-token
+  lp-token: null
+accept_classification_guesses: false
+accept_estimated_prices: false
+classification:                  # first matching rule is used, all keys given must match
+  - contract: '0x10ed43c718714eb63d5aa57b78b54704e256024e'   # address the transaction was sent to
+    events: [Swap]               # log events that must all appear in the transaction
+    class: Buy + Sell            # name or number from CLASSIFICATIONS
+  - source: bsc
+    shape: {in: 1, out: 0}       # number of incoming and outgoing tokens
+    tokens_in: [CAKE]
+    class: Income
+tax:
+  session: fy2022                # save file to calculate tax from
+  output: fy2022
+review_queue: results/review/review-queue.jsonl   # optional
+```
+"""
+
+import os
+import json
+import datetime
+from contextlib import contextmanager
+
+import yaml
+
+REVIEW_QUEUE = os.path.join(os.path.dirname(__file__), "results", "review", "review-queue.jsonl")
+
+ANSWER_LOG = os.path.join(os.path.dirname(__file__), "results", "answers", "answers.jsonl")
+
+# rules being used for batch mode, None when running interactively
+RULES = None
+
+# file that answers given in person are appended to, None when not recording
+ANSWERS_FILE = None
+# answers to replay, mapping (transaction hash, question, occurrence) to the answer, None when not replaying
+RECORDED_ANSWERS = None
+# hash of the transaction being processed, see answering_for
+ANSWER_CONTEXT = None
+# number of times each (transaction hash, question) has been asked so far
+ANSWER_COUNTS = dict()
+
+
+class ReviewRequired(Exception):
+    """
+    Raised in batch mode when a question can't be answered from the rules, so a person needs to review the
+    transaction.
+    """
+    pass
+
+
+def load_rules(filename):
+    """
+    Read in a rules file and switch to batch mode.
+    :param filename: path to a yaml rules file
+    :return: the rules dictionary
+    """
+    global RULES
+    with open(filename) as file:
+        rules = yaml.load(file, Loader=yaml.SafeLoader)
+    rules.setdefault('timezone', 0)
+    rules.setdefault('coingecko_ids', dict())
+    rules.setdefault('classification', [])
+    rules.setdefault('accept_classification_guesses', False)
+    rules.setdefault('accept_estimated_prices', False)
+    rules.setdefault('tax', dict())
+    rules.setdefault('review_queue', REVIEW_QUEUE)
+    RULES = rules
+    return rules
+
+
+def batch_mode():
+    return RULES is not None
+
+
+def record_answers(filename=ANSWER_LOG, replay=False):
+    """
+    Record the answers given to questions about transactions from now on.
+    :param filename: jsonl file the answers are appended to
+    :param replay: if True, questions that already have an answer recorded in filename are answered from it
+    """
+    global ANSWERS_FILE, RECORDED_ANSWERS
+    ANSWERS_FILE = filename
+    if replay:
+        RECORDED_ANSWERS = dict()
+        if os.path.exists(filename):
+            with open(filename) as file:
+                for line in file:
+                    if line.strip():
+                        answer = json.loads(line)
+                        # later answers replace earlier ones
+                        RECORDED_ANSWERS[(answer['hash'], answer['question'], answer['occurrence'])] = answer['answer']
+        print(f"Replaying {len(RECORDED_ANSWERS)} recorded answers from {filename}")
+
+
+def answer_key(string):
+    """The key of the next time a question is asked about the current transaction, or None if it isn't recorded."""
+    if ANSWER_CONTEXT is None or (ANSWERS_FILE is None and RECORDED_ANSWERS is None):
+        return None
+    question = string.strip()
+    return ANSWER_CONTEXT, question, ANSWER_COUNTS.get((ANSWER_CONTEXT, question), 0)
+
+
+def has_recorded_answer(string):
+    """Whether the next time a question is asked it will be answered from the recorded answers."""
+    key = answer_key(string)
+    return key is not None and RECORDED_ANSWERS is not None and key in RECORDED_ANSWERS
+
+
+def save_answer(key, answer):
+    os.makedirs(os.path.dirname(ANSWERS_FILE), exist_ok=True)
+    with open(ANSWERS_FILE, "a") as file:
+        file.write(json.dumps({'hash': key[0],
+                               'question': key[1],
+                               'occurrence': key[2],
+                               'answer': answer,
+                               'time': str(datetime.datetime.now())}) + "\n")
+
+
+@contextmanager
+def answering_for(transaction_hash):
+    """Record and replay the answers to the questions asked inside this block as answers about a transaction."""
+    global ANSWER_CONTEXT
+    previous = ANSWER_CONTEXT
+    ANSWER_CONTEXT = None if transaction_hash is None else str(transaction_hash)
+    try:
+        yield
+    finally:
+        ANSWER_CONTEXT = previous
+
+
+def ask(string, batch_answer=None):
+    """
+    Ask the user a question, or in batch mode, give the answer that the rules provide. When replaying, questions with a
+    recorded answer are answered from it first.
+    :param string: the question
+    :param batch_answer: the answer to use in batch mode. If None, the question can't be answered without a person and
+    ReviewRequired is raised
+    :return: the answer as a string
+    """
+    key = answer_key(string)
+    if key is not None:
+        ANSWER_COUNTS[key[:2]] = key[2] + 1
+        if RECORDED_ANSWERS is not None and key in RECORDED_ANSWERS:
+            print(f"{string}{RECORDED_ANSWERS[key]}")
+            return RECORDED_ANSWERS[key]
+    if RULES is None:
+        answer = input(string)
+        if key is not None and ANSWERS_FILE is not None:
+            save_answer(key, answer)
+        return answer
+    if batch_answer is None:
+        raise ReviewRequired(string.strip())
+    print(f"{string}{batch_answer}")
+    return batch_answer
+
+
+def yes_no(condition):
+    """Convert a condition into a batch answer to a (y/n) question."""
+    return 'y' if condition else 'n'
+
+
+def rule(name):
+    """Get a setting from the rules, or None when not in batch mode."""
+    if RULES is None:
+        return None
+    return RULES.get(name)
+
+
+def rule_date(name):
+    """Get a date from the rules as a datetime, or None if it isn't set."""
+    date = rule(name)
+    if date is None:
+        return None
+    if isinstance(date, str):
+        return datetime.datetime.strptime(date, "%Y-%m-%d")
+    return datetime.datetime(date.year, date.month, date.day)
+
+
+def source_answer(source):
+    """Batch answer to whether a source (eg. 'binance-2021', 'coinspot' or a chain) should be processed."""
+    if RULES is None:
+        return None
+    return yes_no(RULES.get('sources') is None or source in RULES['sources'])
+
+
+def wallet_answer(name, wallet):
+    """Batch answer to whether a wallet from wallets.yml should be processed."""
+    if RULES is None:
+        return None
+    wallets = RULES.get('wallets')
+    return yes_no(wallets is None or name in wallets or wallet.lower() in [str(w).lower() for w in wallets])
+
+
+def file_answer(file_list, name):
+    """Batch answer to a question choosing a save file by number from file_list, where name is the file wanted."""
+    if RULES is None or name is None:
+        return None
+    for n, f in enumerate(file_list):
+        if os.path.basename(f) in [name, f"{name}.p"]:
+            return str(n + 1)
+    return None
+
+
+def match_classification(source, temp_moves, contract=None, events=()):
+    """
+    Find the first classification rule matching a transaction.
+    :param source: where the transaction is from, eg. a chain name
+    :param temp_moves: list of token movement dictionaries
+    :param contract: address the transaction was sent to, if on-chain
+    :param events: names of the log events in the transaction
+    :return: the 'class' of the matching rule (a classification name or number), or None if no rule matches
+    """
+    if RULES is None:
+        return None
+    tokens_in = set(move['token'].lower() for move in temp_moves if move['direction'] == 'in')
+    tokens_out = set(move['token'].lower() for move in temp_moves if move['direction'] == 'out')
+    shape = {'in': len([True for move in temp_moves if move['direction'] == 'in']),
+             'out': len([True for move in temp_moves if move['direction'] == 'out'])}
+    for classification_rule in RULES['classification']:
+        if 'source' in classification_rule and classification_rule['source'] != source:
+            continue
+        if 'contract' in classification_rule and (contract is None or str(classification_rule['contract']).lower() != contract.lower()):
+            continue
+        if 'events' in classification_rule and not set(classification_rule['events']) <= set(events):
+            continue
+        if 'shape' in classification_rule and any(shape[direction] != count for direction, count in classification_rule['shape'].items()):
+            continue
+        if 'tokens_in' in classification_rule and not set(str(t).lower() for t in classification_rule['tokens_in']) <= tokens_in:
+            continue
+        if 'tokens_out' in classification_rule and not set(str(t).lower() for t in classification_rule['tokens_out']) <= tokens_out:
+            continue
+        return classification_rule['class']
+    return None
+
+
+def add_to_review_queue(source, transaction_hash, transaction_time, question):
+    """Append a transaction that needs reviewing to the review queue file."""
+    filename = RULES['review_queue']
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    with open(filename, "a") as file:
+        file.write(json.dumps({'source': source,
+                               'hash': transaction_hash,
+                               'time': str(transaction_time),
+                               'question': question}) + "\n")
+
+
+@contextmanager
+def review_on_failure(transaction_bank, source, transaction_hash, transaction_time):
+    """
+    Process a transaction, and if a question needed for it can't be answered from the rules, remove anything it had
+    already added to the transaction bank and add it to the review queue instead of stopping.
+    :param transaction_bank: a dictionary mapping each token to a list of transactions
+    """
+    lengths = {token: len(transactions) for token, transactions in transaction_bank.items()}
+    try:
+        with answering_for(transaction_hash):
+            yield
+    except ReviewRequired as error:
+        for token in list(transaction_bank.keys()):
+            if token in lengths:
+                del transaction_bank[token][lengths[token]:]
+            else:
+                del transaction_bank[token]
+        add_to_review_queue(source, transaction_hash, transaction_time, str(error))
+        print(f"Transaction {transaction_hash} needs to be reviewed: {error}")
@@ -0,0 +1,83 @@
+"""
+Index of block numbers and their times for each chain.
+
+The covalent exports already have the block number and time of every transaction in them, so most lookups of the block
+at a time can be answered from those with a bisect instead of a request to the chain's api. Blocks that had to be
+requested are added to the index and saved in results/cache/blocks, so they are only requested once.
+"""
+
+import os
+import json
+import bisect
+import datetime
+
+import numpy as np
+
+BLOCK_INDEX_DIR = os.path.join(os.path.dirname(__file__), "results", "cache", "blocks")
+# how long before a time the latest known block can be and still be used as the block at that time
+BLOCK_INDEX_TOLERANCE = datetime.timedelta(minutes=30)
+
+
+class BlockIndex:
+    """
+    Known (unix time, block number) points for a chain, sorted by time.
+    """
+    def __init__(self, chain):
+        self.chain = chain
+        self.filename = os.path.join(BLOCK_INDEX_DIR, f"{chain}.json")
+        self.times = []
+        self.blocks = []
+        # points that were requested, the rest come from the exports and aren't saved
+        # a requested point's block is at or before its time, where a point from the exports is exactly at its time
+        self.requested = []
+        if os.path.exists(self.filename):
+            with open(self.filename) as index_file:
+                self.requested = [tuple(point) for point in json.load(index_file)]
+            self.add_many([epoch_time for epoch_time, _ in self.requested], [block for _, block in self.requested])
+
+    def add_many(self, epoch_times, blocks):
+        """
+        Add points to the index.
+        :param epoch_times: iterable of unix times
+        :param blocks: iterable of the block numbers at those times
+        """
+        times = np.r_[np.asarray(self.times, dtype=np.int64), np.asarray(list(epoch_times), dtype=np.int64)]
+        blocks = np.r_[np.asarray(self.blocks, dtype=np.int64), np.asarray(list(blocks), dtype=np.int64)]
+        # sorted by time, then block
+        points = np.unique(np.stack([times, blocks]), axis=1)
+        self.times = points[0].tolist()
+        self.blocks = points[1].tolist()
+
+    def add_requested(self, epoch_time, block):
+        """Add a point that was requested from the api, and save it."""
+        ind = bisect.bisect_right(self.times, epoch_time)
+        self.times.insert(ind, epoch_time)
+        self.blocks.insert(ind, block)
+        self.requested.append((epoch_time, block))
+        os.makedirs(BLOCK_INDEX_DIR, exist_ok=True)
+        with open(self.filename, "w") as index_file:
+            json.dump(self.requested, index_file)
+
+    def block_before(self, epoch_time, tolerance=BLOCK_INDEX_TOLERANCE):
+        """
+        Find the latest known block at or before a time.
+        :return: the block number, or None if there isn't a known block within tolerance before the time
+        """
+        ind = bisect.bisect_right(self.times, epoch_time) - 1
+        if ind < 0 or epoch_time - self.times[ind] > tolerance.total_seconds():
+            return None
+        return self.blocks[ind]
+
+    def block_after(self, epoch_time, tolerance=BLOCK_INDEX_TOLERANCE):
+        """
+        Find the earliest block from the exports at or after a time. Requested points aren't used, as their blocks can
+        be before their times.
+        :return: the block number, or None if there isn't a known block within tolerance after the time
+        """
+        requested = set(self.requested)
+        ind = bisect.bisect_left(self.times, epoch_time)
+        while ind < len(self.times) and (self.times[ind], self.blocks[ind]) in requested:
+            ind += 1
+        if ind >= len(self.times) or self.times[ind] - epoch_time > tolerance.total_seconds():
+            return None
+        return self.blocks[ind]
@@ -4,8 +4,8 @@
 import glob
 import os
 import pprint
-import pickle
 from utils import get_user_input
+from session import load_session, save_session, session_path, describe_session
 from transactions import Transaction, TransactionType
 
 
@@ -15,19 +15,17 @@ def delete_transaction():
     if file_list:
         print("Existing files:")
         for n, f in enumerate(file_list):
-            print(f"{n+1}. {os.path.basename(f)}")
+            print(f"{n+1}. {describe_session(f)}")
         while True:
             file_num = input(f"Which existing file would you like to load? (#/n) ")
             if file_num in [str(m) for m in range(1, len(file_list)+1)]:
-                with open(file_list[int(file_num)-1], "rb") as pickle_file:
-                    global PREVIOUS_PRICES
-                    (transaction_bank, processed_transaction_hashes, PREVIOUS_PRICES) = pickle.load(pickle_file)
+                (transaction_bank, processed_transaction_hashes, previous_prices) = load_session(file_list[int(file_num)-1])
                 print(f"Loaded transaction hashes: {processed_transaction_hashes}")
                 pp = pprint.PrettyPrinter()
                 print("Loaded transactions:")
                 pp.pprint(transaction_bank)
                 print(f"Loaded previous prices:")
-                pp.pprint(PREVIOUS_PRICES)
+                pp.pprint(previous_prices)
                 break
 
     hash = input(f"Enter the transaction hash you would like to delete: ")
@@ -64,11 +62,10 @@ def delete_transaction():
         raise e
     else:
         print("All deleted successfully, saving this as a new file...")
-        # pickle progress so far
+        # save progress so far
         pickle_file_name = input("What would you like to call this new save file? ")
-        filename = os.path.join(os.path.dirname(__file__), "results", "transactions", f"{pickle_file_name}.p")
-        with open(filename, "wb") as pickle_file:
-            pickle.dump((transaction_bank, processed_transaction_hashes, PREVIOUS_PRICES), pickle_file)
+        filename = session_path(pickle_file_name)
+        save_session(filename, transaction_bank, processed_transaction_hashes, previous_prices)
         print(f"Progress saved to {filename}")
 
 
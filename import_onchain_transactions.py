@@ -1,11 +1,18 @@
 """ create a csv of onchain transaction """
 
-from utils import save_transactions, get_user_input
+from utils import sync_transactions, fetch_all
+from argparse import ArgumentParser
 import yaml
 
 
 if __name__ == '__main__':
+    parser = ArgumentParser(description="Download new on-chain transactions for the wallets in wallets.yml.")
+    parser.add_argument('--full', action='store_true', help="download the whole history of each wallet again, rather "
+                                                            "than only the blocks since the last sync")
+    args = parser.parse_args()
 
+    # ask which wallets to import first, so that they can all be downloaded at the same time
+    to_import = []
     for chain in ['ethereum', 'bsc', 'polygon', 'fantom']:
         process = input(f"Would you like to process {chain} transactions? (Y/n) ")
         if process.lower() != "n":
@@ -14,4 +21,7 @@ if __name__ == '__main__':
             for (name, wallet) in wallets.items():
                 wallet_bsc = input(f"Would you like to import transactions for wallet {wallet} ({name}) on {chain}? (Y/n) ")
                 if wallet_bsc.lower() != "n":
-                    save_transactions(chain, wallet)
+                    to_import.append((chain, wallet, args.full))
+
+    # sync concurrently (requests to each api are still rate limited), each wallet's transactions are saved separately
+    fetch_all(sync_transactions, to_import)
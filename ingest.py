@@ -0,0 +1,260 @@
+"""
+Reading exported transaction files in chunks.
+
+Exports in transaction-files/ can be hundreds of MB (covalent exports have a row per decoded log event parameter), so
+rather than reading every file into one dataframe and then filtering it by date, files are read CHUNK_SIZE rows at a
+time with the date range applied to each chunk as it is read. read_csv_in_range collects only the rows in range, and
+iter_hash_groups goes further and yields one transaction at a time, so memory use doesn't grow with the size of the
+export.
+
+Parsed chunks (with the times converted and the columns typed, before the date range is applied) are also saved in
+results/cache/ingest, as Parquet when pyarrow or fastparquet is installed and pickled otherwise. Each file's entry in
+the cache manifest records its size, modification time and md5, so files that haven't changed since they were last
+read are loaded from the cache instead of being parsed again.
+"""
+
+import os
+import json
+import shutil
+import hashlib
+import importlib.util
+
+import numpy as np
+import pandas as pd
+
+# number of csv rows read at a time
+CHUNK_SIZE = 100000
+
+INGEST_CACHE_DIR = os.path.join(os.path.dirname(__file__), "results", "cache", "ingest")
+INGEST_MANIFEST = os.path.join(INGEST_CACHE_DIR, "manifest.json")
+# change this when the way files are parsed changes, so that older cached chunks aren't used
+INGEST_CACHE_VERSION = 1
+# set to False to always parse files from scratch
+USE_INGEST_CACHE = True
+
+# parquet needs one of these to be installed, otherwise chunks are cached as pickles
+if importlib.util.find_spec('pyarrow') is not None or importlib.util.find_spec('fastparquet') is not None:
+    CACHE_FORMAT = 'parquet'
+else:
+    CACHE_FORMAT = 'pickle'
+
+
+def file_md5(filename):
+    md5 = hashlib.md5()
+    with open(filename, "rb") as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+def load_manifest():
+    if os.path.exists(INGEST_MANIFEST):
+        with open(INGEST_MANIFEST) as manifest_file:
+            return json.load(manifest_file)
+    return dict()
+
+
+def save_manifest(manifest):
+    os.makedirs(INGEST_CACHE_DIR, exist_ok=True)
+    temp_filename = f"{INGEST_MANIFEST}.tmp"
+    with open(temp_filename, "w") as manifest_file:
+        json.dump(manifest, manifest_file, indent=1)
+    os.replace(temp_filename, INGEST_MANIFEST)
+
+
+def parse_options(time_column, time_format, dtype, usecols, rename, normalise):
+    """A string describing how a file is parsed, so that chunks parsed differently aren't loaded from the cache."""
+    def describe(value):
+        # functions are described by name, as their repr changes between runs
+        return getattr(value, '__qualname__', None) or repr(value)
+    return repr((INGEST_CACHE_VERSION, time_column, time_format,
+                 sorted((column, describe(column_type)) for column, column_type in (dtype or dict()).items()),
+                 usecols, describe(rename), describe(normalise)))
+
+
+def cache_key(filename, options):
+    # a file can be cached more than once if it is read with different options
+    return f"{os.path.abspath(filename)}|{hashlib.md5(options.encode('utf-8')).hexdigest()[:12]}"
+
+
+def cache_directory(filename, options):
+    # eg. results/cache/ingest/bsc/transactions.csv-<hash of the full path and options>
+    path = os.path.abspath(filename)
+    return os.path.join(INGEST_CACHE_DIR, os.path.basename(os.path.dirname(path)),
+                        f"{os.path.basename(path)}-{hashlib.md5(cache_key(filename, options).encode('utf-8')).hexdigest()[:12]}")
+
+
+def chunk_path(directory, n, cache_format):
+    return os.path.join(directory, f"{n}.{'parquet' if cache_format == 'parquet' else 'p'}")
+
+
+def cached_entry(manifest, filename, options):
+    """
+    Find the cache entry of a file, if the file hasn't changed since it was cached.
+    :return: the manifest entry, or None if the file needs to be parsed
+    """
+    entry = manifest.get(cache_key(filename, options))
+    if entry is None or entry['options'] != options:
+        return None
+    stat = os.stat(filename)
+    if entry['size'] != stat.st_size:
+        return None
+    if entry['mtime'] != stat.st_mtime_ns:
+        # the file may have been copied or touched without changing
+        if entry['md5'] != file_md5(filename):
+            return None
+        entry['mtime'] = stat.st_mtime_ns
+        save_manifest(manifest)
+    return entry
+
+
+def read_file_chunks(filename, time_column, time_format, dtype=None, usecols=None, rename=None, normalise=None,
+                     chunksize=CHUNK_SIZE):
+    """
+    Parse a csv file a chunk at a time, or load the chunks from the cache if the file hasn't changed.
+    :return: generator of dataframes, with the time column converted to datetimes
+    """
+    options = parse_options(time_column, time_format, dtype, usecols, rename, normalise)
+    manifest = load_manifest() if USE_INGEST_CACHE else dict()
+    entry = cached_entry(manifest, filename, options)
+    if entry is not None:
+        for n in range(entry['chunks']):
+            if entry['format'] == 'parquet':
+                yield pd.read_parquet(chunk_path(entry['directory'], n, 'parquet'))
+            else:
+                yield pd.read_pickle(chunk_path(entry['directory'], n, 'pickle'))
+        return
+
+    if USE_INGEST_CACHE:
+        stat = os.stat(filename)
+        entry = {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'md5': file_md5(filename), 'options': options,
+                 'format': CACHE_FORMAT, 'directory': cache_directory(filename, options), 'chunks': 0}
+        shutil.rmtree(entry['directory'], ignore_errors=True)
+        os.makedirs(entry['directory'])
+
+    # the reader can't be used with 'with' before pandas 1.2
+    reader = pd.read_csv(filename, index_col=None, header=0, dtype=dtype, usecols=usecols, chunksize=chunksize)
+    try:
+        for chunk in reader:
+            if rename is not None:
+                chunk = chunk.rename(columns=rename)
+            chunk[time_column] = pd.to_datetime(chunk[time_column], format=time_format)
+            if normalise is not None:
+                chunk = normalise(chunk)
+            if USE_INGEST_CACHE:
+                if CACHE_FORMAT == 'parquet':
+                    chunk.to_parquet(chunk_path(entry['directory'], entry['chunks'], 'parquet'))
+                else:
+                    chunk.to_pickle(chunk_path(entry['directory'], entry['chunks'], 'pickle'))
+                entry['chunks'] += 1
+            yield chunk
+    finally:
+        reader.close()
+
+    # only saved once the whole file has been read
+    if USE_INGEST_CACHE:
+        manifest = load_manifest()
+        manifest[cache_key(filename, options)] = entry
+        save_manifest(manifest)
+
+
+def read_file_chunks_reversed(filename, time_column, time_format, dtype=None, usecols=None, rename=None, normalise=None,
+                              chunksize=CHUNK_SIZE):
+    """
+    Read a csv file a chunk at a time from the last row to the first, see read_file_chunks. The chunks are loaded from
+    the cache in reverse, parsing the file into the cache first if it isn't already there.
+    :return: generator of dataframes, with the rows of each in reverse order
+    """
+    if not USE_INGEST_CACHE:
+        # without the cache the whole file has to be held to reverse it
+        for chunk in reversed(list(read_file_chunks(filename, time_column, time_format, dtype, usecols, rename, normalise, chunksize))):
+            yield chunk.iloc[::-1]
+        return
+
+    options = parse_options(time_column, time_format, dtype, usecols, rename, normalise)
+    entry = cached_entry(load_manifest(), filename, options)
+    if entry is None:
+        for _ in read_file_chunks(filename, time_column, time_format, dtype, usecols, rename, normalise, chunksize):
+            pass
+        entry = cached_entry(load_manifest(), filename, options)
+    for n in reversed(range(entry['chunks'])):
+        if entry['format'] == 'parquet':
+            chunk = pd.read_parquet(chunk_path(entry['directory'], n, 'parquet'))
+        else:
+            chunk = pd.read_pickle(chunk_path(entry['directory'], n, 'pickle'))
+        yield chunk.iloc[::-1]
+
+
+def read_csv_chunks(filenames, time_column, time_format, start_date=None, end_date=None, dtype=None, usecols=None,
+                    rename=None, normalise=None, chunksize=CHUNK_SIZE, reverse=()):
+    """
+    Read csv files a chunk at a time, keeping only the rows within a date range.
+    :param filenames: list of csv files, read in order
+    :param time_column: name of the column holding the time of each row (after rename)
+    :param time_format: format of the times, see pandas.to_datetime
+    :param start_date: datetime of the earliest rows to keep, or None to keep all rows up to end_date
+    :param end_date: datetime that kept rows must be before, or None for no end
+    :param dtype: dictionary of column types, see pandas.read_csv
+    :param usecols: list of the columns to read, or None for all
+    :param rename: dictionary or function used to rename the columns of each chunk
+    :param normalise: function applied to each parsed chunk before it is cached, eg. to lower case addresses
+    :param chunksize: number of rows to read at a time
+    :param reverse: filenames to read from the last row to the first, see read_file_chunks_reversed
+    :return: generator of dataframes, indexed by row number (in the order read) counting across all the files
+    """
+    offset = 0
+    for filename in filenames:
+        read_chunks = read_file_chunks_reversed if filename in reverse else read_file_chunks
+        for chunk in read_chunks(filename, time_column, time_format, dtype, usecols, rename, normalise, chunksize):
+            chunk.index = pd.RangeIndex(offset, offset + len(chunk.index))
+            offset += len(chunk.index)
+            if start_date is not None:
+                chunk = chunk[chunk[time_column] >= start_date]
+            if end_date is not None:
+                chunk = chunk[chunk[time_column] < end_date]
+            yield chunk
+
+
+def read_csv_in_range(filenames, time_column, time_format, start_date=None, end_date=None, dtype=None, usecols=None,
+                      rename=None, normalise=None):
+    """
+    Read csv files into a single dataframe of the rows within a date range, see read_csv_chunks.
+    """
+    return pd.concat(list(read_csv_chunks(filenames, time_column, time_format, start_date, end_date, dtype, usecols,
+                                          rename, normalise)), axis=0)
+
+
+def iter_transaction_chunks(chunks, hash_column):
+    """
+    Regroup chunks of rows so that no transaction is split between chunks. The rows of a transaction must be next to
+    each other, as they are in exported files.
+    :param chunks: iterable of dataframes, eg. from read_csv_chunks
+    :param hash_column: name of the column holding the transaction hash
+    :return: generator of dataframes, each holding all the rows of the transactions in it
+    """
+    carry = None
+    for chunk in chunks:
+        if carry is not None:
+            chunk = pd.concat([carry, chunk], axis=0)
+        if len(chunk.index) == 0:
+            continue
+        hashes = chunk[hash_column].to_numpy()
+        last_start = np.flatnonzero(np.r_[True, hashes[1:] != hashes[:-1]])[-1]
+        if last_start > 0:
+            yield chunk.iloc[:last_start]
+        # the last transaction may carry on into the next chunk
+        carry = chunk.iloc[last_start:]
+    if carry is not None and len(carry.index) > 0:
+        yield carry
+
+
+def iter_hash_groups(chunks, hash_column):
+    """
+    Split chunks of rows into the rows of each transaction, see iter_transaction_chunks.
+    :return: generator of (transaction hash, dataframe of its rows) tuples, in the order they appear in the chunks
+    """
+    for chunk in iter_transaction_chunks(chunks, hash_column):
+        hashes = chunk[hash_column].to_numpy()
+        starts = np.flatnonzero(np.r_[True, hashes[1:] != hashes[:-1]])
+        for begin, end in zip(starts, np.r_[starts[1:], len(hashes)]):
+            yield hashes[begin], chunk.iloc[begin:end]
@@ -0,0 +1,152 @@
+"""
+Price oracle built from swaps in exported on-chain transactions.
+
+Every swap through a liquidity pool shows up in the covalent exports as a Swap log event from the pool, with Transfer
+log events of one token into the pool and another token out of it. Each of these swaps gives the price of each token
+in terms of the other, so once the exports have been indexed, a token that coingecko can't price can be priced from
+the swaps against it around the time wanted, using tokens whose prices are already known, without any requests.
+"""
+
+import datetime
+
+import numpy as np
+import pandas as pd
+
+from prices import to_epoch, from_epoch
+
+# how far either side of the time wanted that swaps are used
+ORACLE_WINDOW = datetime.timedelta(hours=12)
+# number of swaps to estimate a price from, the closest in time are used
+ORACLE_ESTIMATES = 10
+# fewest swaps with a known counterpart price needed to give a price
+ORACLE_MIN_ESTIMATES = 3
+# proportion of the highest and lowest estimates dropped before averaging
+ORACLE_TRIM = 0.2
+
+
+def trimmed_mean(values, proportion=ORACLE_TRIM):
+    values = np.sort(np.asarray(values, dtype=np.float64))
+    cut = int(len(values) * proportion)
+    return float(values[cut:len(values) - cut].mean())
+
+
+def transfer_legs(transfers):
+    """
+    Turn the rows of Transfer log events into a row per transfer.
+    :param transfers: dataframe of Transfer log event rows, in the order they were exported (a row each for the from,
+    to and value parameters of each event)
+    :return: dataframe with the tx_hash, time, token (contract address), ticker, from, to and amount of each transfer
+    """
+    names = transfers['log_events_decoded_params_name'].to_numpy()
+    values = transfers['log_events_decoded_params_value'].to_numpy()
+    hashes = transfers['tx_hash'].to_numpy()
+    # each transfer is a run of from, to and value rows
+    starts = np.flatnonzero(names[:-2] == 'from')
+    starts = starts[(names[starts + 1] == 'to') & (names[starts + 2] == 'value') & (hashes[starts] == hashes[starts + 2])]
+    return pd.DataFrame({'tx_hash': hashes[starts],
+                         'time': transfers['block_signed_at'].to_numpy()[starts],
+                         'token': pd.Series(transfers['log_events_sender_address'].to_numpy()[starts]).str.lower(),
+                         'ticker': transfers['log_events_sender_contract_ticker_symbol'].to_numpy()[starts],
+                         'from': pd.Series(values[starts]).str.lower(),
+                         'to': pd.Series(values[starts + 1]).str.lower(),
+                         # quantities are taken as having 18 decimals, as they are everywhere else
+                         'amount': pd.to_numeric(pd.Series(values[starts + 2]), errors='coerce') / 1e18})
+
+
+class SwapPriceOracle:
+    """
+    Index of swaps by token contract and time. Add the log event rows of transactions with add_chunk, then call finish
+    before using estimate.
+    """
+    def __init__(self):
+        self.observations = []
+        # maps token contract to a tuple of (sorted unix times, counterpart contracts, counterpart tickers, ratios)
+        self.index = dict()
+
+    def add_chunk(self, transfers, swaps):
+        """
+        Find the swaps in some transactions.
+        :param transfers: dataframe of the Transfer log event rows of the transactions, in the order they were exported
+        (a row each for the from, to and value parameters of each event). The transactions must not be split
+        between calls, see ingest.iter_transaction_chunks
+        :param swaps: dataframe of the Swap log event rows of the same transactions
+        """
+        if len(transfers.index) < 3 or len(swaps.index) == 0:
+            return
+        legs = transfer_legs(transfers)
+
+        pools = pd.DataFrame({'tx_hash': swaps['tx_hash'].to_numpy(),
+                              'pool': swaps['log_events_sender_address'].str.lower().to_numpy()}).drop_duplicates()
+
+        def pool_legs(direction):
+            # the legs of each swap in one direction, kept only where a single token moved that way
+            matched = legs.merge(pools, left_on=['tx_hash', direction], right_on=['tx_hash', 'pool'])
+            totals = matched.groupby(['tx_hash', 'pool', 'token'], sort=False).agg(time=('time', 'first'),
+                                                                                     ticker=('ticker', 'first'),
+                                                                                     amount=('amount', 'sum')).reset_index()
+            return totals[totals.groupby(['tx_hash', 'pool'])['token'].transform('size') == 1]
+
+        # tokens go into the pool and come out of it
+        swapped = pool_legs('to').merge(pool_legs('from'), on=['tx_hash', 'pool'], suffixes=('_in', '_out'))
+        swapped = swapped[(swapped['token_in'] != swapped['token_out']) & (swapped['amount_in'] > 0) & (swapped['amount_out'] > 0)]
+        if len(swapped.index) == 0:
+            return
+
+        # price of the token in = ratio * price of the token out, and the other way around
+        self.observations.append(pd.DataFrame({'token': swapped['token_in'].to_numpy(),
+                                               'time': swapped['time_in'].to_numpy(),
+                                               'counterpart': swapped['token_out'].to_numpy(),
+                                               'counterpart_ticker': swapped['ticker_out'].to_numpy(),
+                                               'ratio': (swapped['amount_out'] / swapped['amount_in']).to_numpy()}))
+        self.observations.append(pd.DataFrame({'token': swapped['token_out'].to_numpy(),
+                                               'time': swapped['time_in'].to_numpy(),
+                                               'counterpart': swapped['token_in'].to_numpy(),
+                                               'counterpart_ticker': swapped['ticker_in'].to_numpy(),
+                                               'ratio': (swapped['amount_in'] / swapped['amount_out']).to_numpy()}))
+
+    def finish(self):
+        """Sort the swaps found into the index."""
+        if not self.observations:
+            return
+        observations = pd.concat(self.observations, axis=0, ignore_index=True)
+        self.observations = []
+        # the same transaction can be in more than one exported file
+        observations.drop_duplicates(inplace=True)
+        observations['time'] = pd.to_datetime(observations['time']).to_numpy().astype('datetime64[s]').astype(np.int64)
+        observations.sort_values(['token', 'time'], inplace=True, kind='mergesort')
+        for token, rows in observations.groupby('token', sort=False):
+            self.index[token] = (rows['time'].to_numpy(), rows['counterpart'].to_numpy(),
+                                 rows['counterpart_ticker'].to_numpy(), rows['ratio'].to_numpy())
+
+    def estimate(self, token_contract, time, counterpart_price, window=ORACLE_WINDOW, needed=ORACLE_ESTIMATES,
+                 minimum=ORACLE_MIN_ESTIMATES):
+        """
+        Estimate the price of a token from the swaps closest to a time.
+        :param token_contract: contract address of the token
+        :param time: datetime of the price wanted
+        :param counterpart_price: function of (ticker, contract address, datetime) giving the price of the other token
+        in a swap, or None if it isn't known
+        :param window: timedelta, how far from time swaps can be
+        :param needed: number of estimates to use
+        :param minimum: fewest estimates needed to give a price
+        :return: (price, number of swaps used), or None if there weren't enough swaps against tokens with known prices
+        """
+        if token_contract is None or token_contract.lower() not in self.index:
+            return None
+        times, counterparts, tickers, ratios = self.index[token_contract.lower()]
+        epoch_time = to_epoch(time)
+        first = np.searchsorted(times, epoch_time - window.total_seconds(), side='left')
+        last = np.searchsorted(times, epoch_time + window.total_seconds(), side='right')
+        # closest in time first
+        candidates = first + np.argsort(np.abs(times[first:last] - epoch_time), kind='stable')
+
+        estimates = []
+        for i in candidates:
+            price = counterpart_price(tickers[i], counterparts[i], from_epoch(int(times[i])))
+            if price:
+                estimates.append(ratios[i] * price)
+                if len(estimates) >= needed:
+                    break
+        if len(estimates) < minimum:
+            return None
+        return trimmed_mean(estimates), len(estimates)
@@ -0,0 +1,130 @@
+"""
+Persistent store of token prices that have been found previously, shared between sessions.
+
+Prices are saved in an SQLite database and are keyed by (token key, currency), where the token key is the token
+ticker, or the ticker and contract address for LP tokens (see price_key). Each key's prices are loaded into sorted
+lists of timestamps the first time they are needed, so that finding the closest price to a time is a bisect.
+"""
+
+import os
+import bisect
+import sqlite3
+import calendar
+import datetime
+
+PRICE_DB = os.path.join(os.path.dirname(__file__), "results", "prices", "prices.sqlite")
+
+# tokens that share a ticker across many contracts, so are stored by contract address as well
+LP_TOKENS = ['cake-lp', 'slp', 'wlp']
+
+
+def price_key(token, token_contract=None):
+    """
+    Return the key that prices of a token are stored under.
+    :param token: token ticker
+    :param token_contract: contract address of the token, only used for LP tokens
+    :return: a string
+    """
+    if token.lower() in LP_TOKENS:
+        return f"{token}:{token_contract}"
+    return token
+
+
+def to_epoch(time):
+    """Convert a (UTC) datetime or pandas Timestamp into integer unix time."""
+    return calendar.timegm(time.timetuple())
+
+
+def from_epoch(epoch_time):
+    return datetime.datetime.utcfromtimestamp(epoch_time)
+
+
+class PriceStore:
+    """
+    Contains previously found prices, backed by an SQLite database on disk.
+    """
+    def __init__(self, filename=PRICE_DB):
+        self.filename = filename
+        self.connection = None
+        # maps (key, currency) to a tuple of (sorted list of unix times, list of prices)
+        self.series = dict()
+
+    def connect(self):
+        if self.connection is None:
+            os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+            self.connection = sqlite3.connect(self.filename, timeout=30)
+            self.connection.execute("CREATE TABLE IF NOT EXISTS prices ("
+                                    "key TEXT NOT NULL, "
+                                    "currency TEXT NOT NULL, "
+                                    "time INTEGER NOT NULL, "
+                                    "price REAL NOT NULL, "
+                                    "PRIMARY KEY (key, currency, time))")
+            self.connection.commit()
+        return self.connection
+
+    def get_series(self, key, currency):
+        currency = currency.lower()
+        if (key, currency) not in self.series:
+            rows = self.connect().execute("SELECT time, price FROM prices WHERE key = ? AND currency = ? ORDER BY time",
+                                          (key, currency)).fetchall()
+            self.series[(key, currency)] = ([time for time, _ in rows], [price for _, price in rows])
+        return self.series[(key, currency)]
+
+    def store(self, key, currency, time, price):
+        self.store_many(key, currency, [(to_epoch(time), price)])
+
+    def store_many(self, key, currency, rows):
+        """
+        Save several prices for one token at once.
+        :param key: token key, see price_key
+        :param currency: currency the prices are in
+        :param rows: iterable of (unix time, price) tuples
+        """
+        rows = [(int(epoch_time), float(price)) for epoch_time, price in rows if price is not None]
+        if not rows:
+            return
+        connection = self.connect()
+        connection.executemany("INSERT OR REPLACE INTO prices (key, currency, time, price) VALUES (?, ?, ?, ?)",
+                               [(key, currency.lower(), epoch_time, price) for epoch_time, price in rows])
+        connection.commit()
+
+        times, prices = self.get_series(key, currency)
+        for epoch_time, price in rows:
+            ind = bisect.bisect_left(times, epoch_time)
+            if ind < len(times) and times[ind] == epoch_time:
+                prices[ind] = price
+            else:
+                times.insert(ind, epoch_time)
+                prices.insert(ind, price)
+
+    def nearest(self, key, currency, time, tolerance=datetime.timedelta(hours=24)):
+        """
+        Find the stored price closest in time to time.
+        :param key: token key, see price_key
+        :param currency: currency the price is in
+        :param time: datetime of the price wanted
+        :param tolerance: timedelta, how far from time a stored price can be
+        :return: (datetime, price) of the closest price, or None if there isn't one within the tolerance
+        """
+        times, prices = self.get_series(key, currency)
+        if not times:
+            return None
+        epoch_time = to_epoch(time)
+        ind = bisect.bisect_left(times, epoch_time)
+        candidates = [i for i in (ind - 1, ind) if 0 <= i < len(times)]
+        closest = min(candidates, key=lambda i: abs(times[i] - epoch_time))
+        if abs(times[closest] - epoch_time) > tolerance.total_seconds():
+            return None
+        return from_epoch(times[closest]), prices[closest]
+
+    def import_prices(self, previous_prices, currency='aud'):
+        """
+        Copy prices from a dictionary in the format saved with older sessions, {token or (token, contract): {time:
+        price}}, into the store.
+        """
+        for token, prices in previous_prices.items():
+            if type(token) is tuple:
+                key = price_key(*token)
+            else:
+                key = price_key(token)
+            self.store_many(key, currency, [(to_epoch(time), price) for time, price in prices.items()])
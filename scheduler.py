@@ -0,0 +1,77 @@
+"""
+Ordering of transactions that were left to be processed later.
+
+A transaction is left until later when more than one of its tokens doesn't have a known price yet, in the hope that
+other transactions will give those prices. Processing a transaction gives prices for all of its tokens, so the left
+over transactions form a graph of which transactions are waiting on the tokens of which others. They are processed in
+an order where each transaction is waiting on at most one token where possible, and transactions that can never get
+there (their tokens are only in other transactions that are also waiting) are found before any are processed, so that
+they can be shown to the user once.
+"""
+
+from collections import deque
+
+
+class DeferredTransactions:
+    """
+    Transactions left to be processed later, in the order they were left.
+    """
+    def __init__(self):
+        # maps each transaction hash to (item, set of the keys of all the tokens in the transaction)
+        self.transactions = dict()
+
+    def add(self, transaction_hash, item, tokens):
+        """
+        Leave a transaction until later.
+        :param transaction_hash: hash of the transaction
+        :param item: anything needed to process the transaction later
+        :param tokens: keys of all the tokens in the transaction, which will have prices once it is processed
+        """
+        self.transactions[transaction_hash] = (item, set(tokens))
+
+    def __len__(self):
+        return len(self.transactions)
+
+    def schedule(self, unpriced):
+        """
+        Work out the order to process the transactions in.
+        :param unpriced: function of an item giving the set of keys of its tokens that still don't have a price
+        :return: (order, stuck), where order is a list of (transaction hash, item, forced) in the order to process them,
+        forced being True for transactions that are still waiting on more than one token when they are reached, and
+        stuck maps the hashes of the transactions that can't be reached without forcing one to the tokens they need
+        """
+        needs = {transaction_hash: set(unpriced(item)) for transaction_hash, (item, _) in self.transactions.items()}
+        waiting = dict()
+        for transaction_hash, tokens in needs.items():
+            for token in tokens:
+                waiting.setdefault(token, []).append(transaction_hash)
+
+        ready = deque(transaction_hash for transaction_hash, tokens in needs.items() if len(tokens) <= 1)
+        queued = set(ready)
+        order = []
+        stuck = None
+        while len(order) < len(self.transactions):
+            if ready:
+                transaction_hash = ready.popleft()
+                forced = False
+            else:
+                left = [transaction_hash for transaction_hash in self.transactions if transaction_hash not in queued]
+                if stuck is None:
+                    stuck = {transaction_hash: set(needs[transaction_hash]) for transaction_hash in left}
+                # break the cycle with the transaction the most others are waiting on, then the one needing least
+                transaction_hash = max(left, key=lambda h: (sum(len(waiting.get(token, ())) for token in needs[h]), -len(needs[h])))
+                queued.add(transaction_hash)
+                forced = True
+
+            item, tokens = self.transactions[transaction_hash]
+            order.append((transaction_hash, item, forced))
+            # the tokens in this transaction will have prices once it has been processed
+            for token in tokens:
+                for other in waiting.pop(token, ()):
+                    needs[other].discard(token)
+                    if other not in queued and len(needs[other]) <= 1:
+                        ready.append(other)
+                        queued.add(other)
+
+        self.transactions = dict()
+        return order, stuck or dict()
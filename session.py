@@ -0,0 +1,360 @@
+"""
+Save files for transaction processing sessions.
+
+A session is saved as a snapshot plus an append-only journal holding only what each processed transaction added since
+that snapshot. The journal is folded back into the snapshot every COMPACT_EVERY transactions, so saving progress no
+longer rewrites the whole bank.
+
+Snapshots are zip containers with a separate section for each part of the session:
+  header.json             format version, and the number of transactions and date range of each token
+  hashes.txt              processed transaction hashes, one per line, in the order they were processed
+  transactions/<n>.npz    the transactions of one token, stored as columns
+  prices.p                prices saved by older sessions that haven't been moved into the price store yet
+The header can be read on its own to list or inspect a save file, and each section is only read when it's asked for
+(see SessionFile). Save files from before the container format (a single pickled (transaction_bank,
+processed_transaction_hashes, previous_prices) tuple) are still loaded, and can be converted with
+convert_legacy_session or by running this file.
+"""
+
+import io
+import os
+import sys
+import json
+import glob
+import pickle
+import zipfile
+from argparse import ArgumentParser
+
+import numpy as np
+import pandas as pd
+
+# number of journal records to accept before folding them into a new snapshot
+COMPACT_EVERY = 500
+
+SAVE_DIR = os.path.join(os.path.dirname(__file__), "results", "transactions")
+
+SESSION_FORMAT = "crypto-tax-session"
+SESSION_VERSION = 1
+
+
+class SessionUnpickler(pickle.Unpickler):
+    """
+    Unpickler that can find Transaction/TransactionType objects that were pickled while transactions.py was being run
+    as a script (and so were saved as belonging to __main__).
+    """
+    def find_class(self, module, name):
+        if module == '__main__' and not hasattr(sys.modules['__main__'], name):
+            module = 'transactions'
+        return super().find_class(module, name)
+
+
+class ProcessedHashes:
+    """
+    The hashes of transactions that have already been processed in a session. Works like a set for checking whether a
+    hash has been processed, but keeps the order that hashes were added in for displaying them.
+    """
+    def __init__(self, hashes=()):
+        self.hashes = dict.fromkeys(hashes)
+
+    def append(self, transaction_hash):
+        self.hashes[transaction_hash] = None
+
+    def remove(self, transaction_hash):
+        del self.hashes[transaction_hash]
+
+    def __contains__(self, transaction_hash):
+        return transaction_hash in self.hashes
+
+    def __iter__(self):
+        return iter(self.hashes)
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def __str__(self):
+        return str(list(self.hashes))
+
+    def __repr__(self):
+        return str(list(self.hashes))
+
+
+def session_path(name):
+    return os.path.join(SAVE_DIR, f"{name}.p")
+
+
+def journal_path(filename):
+    return f"{filename}.journal"
+
+
+def is_legacy_session(filename):
+    return not zipfile.is_zipfile(filename)
+
+
+def token_to_json(token):
+    # LP tokens are keyed by (ticker, contract address)
+    return list(token) if type(token) is tuple else token
+
+
+def token_from_json(token):
+    return tuple(token) if type(token) is list else token
+
+
+def transaction_columns(transactions):
+    """
+    Convert a list of transactions into columns to be saved with numpy.
+    :param transactions: list of Transaction objects
+    :return: dictionary of column name to numpy array
+    """
+    return {'time': np.array([transaction.time for transaction in transactions], dtype='datetime64[ns]'),
+            'transaction_type': np.array([transaction.transaction_type.value for transaction in transactions], dtype=np.int8),
+            'token': np.array([str(transaction.token) for transaction in transactions], dtype=str),
+            'volume': np.array([transaction.volume for transaction in transactions], dtype=np.float64),
+            'fee': np.array([transaction.fee for transaction in transactions], dtype=np.float64),
+            'token_price': np.array([transaction.token_price for transaction in transactions], dtype=np.float64),
+            'token_fee_adjusted_price': np.array([transaction.token_fee_adjusted_price for transaction in transactions], dtype=np.float64)}
+
+
+def transactions_from_columns(columns):
+    """Convert columns saved by transaction_columns back into a list of transactions."""
+    # imported here as transactions.py imports this module
+    from transactions import Transaction, TransactionType
+
+    transactions = []
+    for state in zip(pd.to_datetime(columns['time']),
+                     [TransactionType(value) for value in columns['transaction_type'].tolist()],
+                     columns['token'].tolist(),
+                     columns['volume'].tolist(),
+                     columns['fee'].tolist(),
+                     columns['token_price'].tolist(),
+                     columns['token_fee_adjusted_price'].tolist()):
+        # the fee is already per token, so skip __init__
+        transaction = Transaction.__new__(Transaction)
+        transaction.__setstate__(state)
+        transactions.append(transaction)
+    return transactions
+
+
+def save_session(filename, transaction_bank, processed_transaction_hashes, previous_prices=None):
+    """
+    Write a complete snapshot of a session, replacing the previous snapshot and any journal alongside it.
+    Prices are kept in the shared price store (see prices.py), so previous_prices is only used to pass on prices from
+    older save files that have not been moved into the store yet.
+    """
+    if previous_prices is None:
+        previous_prices = dict()
+    header = {'format': SESSION_FORMAT,
+              'version': SESSION_VERSION,
+              'hashes': len(processed_transaction_hashes),
+              'transactions': 0,
+              'first': None,
+              'last': None,
+              'tokens': []}
+
+    temp_filename = f"{filename}.tmp"
+    with zipfile.ZipFile(temp_filename, "w", compression=zipfile.ZIP_DEFLATED) as container:
+        for n, (token, transactions) in enumerate(transaction_bank.items()):
+            section = f"transactions/{n}.npz"
+            columns = transaction_columns(transactions)
+            buffer = io.BytesIO()
+            np.savez(buffer, **columns)
+            container.writestr(section, buffer.getvalue())
+
+            token_header = {'token': token_to_json(token), 'section': section, 'count': len(transactions),
+                            'first': None, 'last': None}
+            if len(transactions):
+                token_header['first'] = str(columns['time'].min())
+                token_header['last'] = str(columns['time'].max())
+                # the times are ISO strings so they sort in time order
+                if header['first'] is None or token_header['first'] < header['first']:
+                    header['first'] = token_header['first']
+                if header['last'] is None or token_header['last'] > header['last']:
+                    header['last'] = token_header['last']
+            header['transactions'] += len(transactions)
+            header['tokens'].append(token_header)
+
+        container.writestr("hashes.txt", "\n".join(processed_transaction_hashes))
+        container.writestr("prices.p", pickle.dumps(previous_prices))
+        container.writestr("header.json", json.dumps(header, indent=1))
+    os.replace(temp_filename, filename)
+    if os.path.exists(journal_path(filename)):
+        os.remove(journal_path(filename))
+
+
+class SessionFile:
+    """
+    A saved session snapshot, read a section at a time. Opening one only reads the header.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        with zipfile.ZipFile(filename) as container:
+            self.header = json.loads(container.read("header.json"))
+        if self.header.get('format') != SESSION_FORMAT:
+            raise ValueError(f"{filename} is not a session file")
+        if self.header['version'] > SESSION_VERSION:
+            raise ValueError(f"{filename} was saved with a newer version of this program (session format "
+                             f"{self.header['version']})")
+
+    def tokens(self):
+        return [token_from_json(token_header['token']) for token_header in self.header['tokens']]
+
+    def read_section(self, section):
+        with zipfile.ZipFile(self.filename) as container:
+            return container.read(section)
+
+    def transactions(self, token):
+        """Read in the transactions of a single token."""
+        for token_header in self.header['tokens']:
+            if token_from_json(token_header['token']) == token:
+                with np.load(io.BytesIO(self.read_section(token_header['section']))) as columns:
+                    return transactions_from_columns(columns)
+        raise KeyError(token)
+
+    def transaction_bank(self):
+        return {token: self.transactions(token) for token in self.tokens()}
+
+    def processed_hashes(self):
+        text = self.read_section("hashes.txt").decode()
+        return ProcessedHashes(text.split("\n") if text else ())
+
+    def previous_prices(self):
+        return pickle.loads(self.read_section("prices.p"))
+
+
+def read_session_header(filename):
+    """
+    Read the header of a save file without loading the rest of it.
+    :return: the header dictionary, or None for save files from before the container format
+    """
+    if is_legacy_session(filename):
+        return None
+    return SessionFile(filename).header
+
+
+def describe_session(filename):
+    """One line summary of a save file for listing save files to choose from."""
+    header = read_session_header(filename)
+    if header is None:
+        return f"{os.path.basename(filename)} (old format)"
+    if not header['transactions']:
+        return f"{os.path.basename(filename)} (no transactions)"
+    return (f"{os.path.basename(filename)} ({header['transactions']} transactions of {len(header['tokens'])} tokens, "
+            f"{header['first'][:10]} to {header['last'][:10]})")
+
+
+def print_session_summary(filename):
+    """Print the number of transactions and date range of each token in a save file, from its header."""
+    header = read_session_header(filename)
+    if header is None:
+        print(f"{os.path.basename(filename)} is in the old format, run session.py to convert it.")
+        return
+    print(f"{header['hashes']} processed transaction hashes")
+    print(f"{header['transactions']} transactions:")
+    for token_header in header['tokens']:
+        if token_header['count']:
+            print(f"  {token_from_json(token_header['token'])}: {token_header['count']} "
+                  f"({token_header['first'][:19]} to {token_header['last'][:19]})")
+        else:
+            print(f"  {token_from_json(token_header['token'])}: 0")
+
+
+def load_legacy_snapshot(filename):
+    with open(filename, "rb") as pickle_file:
+        (transaction_bank, processed_transaction_hashes, previous_prices) = SessionUnpickler(pickle_file).load()
+    # older save files stored the processed hashes as a list
+    if not isinstance(processed_transaction_hashes, ProcessedHashes):
+        processed_transaction_hashes = ProcessedHashes(processed_transaction_hashes)
+    return transaction_bank, processed_transaction_hashes, previous_prices
+
+
+def load_session(filename):
+    """
+    Load a session snapshot and replay any journal records saved after it.
+    :param filename: path to the snapshot (.p) file
+    :return: (transaction_bank, processed_transaction_hashes, previous_prices), where previous_prices is only
+    non-empty for files saved before prices were moved into the price store
+    """
+    if is_legacy_session(filename):
+        (transaction_bank, processed_transaction_hashes, previous_prices) = load_legacy_snapshot(filename)
+    else:
+        session_file = SessionFile(filename)
+        transaction_bank = session_file.transaction_bank()
+        processed_transaction_hashes = session_file.processed_hashes()
+        previous_prices = session_file.previous_prices()
+
+    if os.path.exists(journal_path(filename)):
+        with open(journal_path(filename), "rb") as journal_file:
+            while True:
+                try:
+                    (transaction_hash, new_transactions) = SessionUnpickler(journal_file).load()
+                except (EOFError, pickle.UnpicklingError):
+                    # end of journal, or a record that was only partly written when the program stopped
+                    break
+                # records can already be in the snapshot if the program stopped part way through compacting
+                if transaction_hash in processed_transaction_hashes:
+                    continue
+                for token, transactions in new_transactions:
+                    transaction_bank.setdefault(token, []).extend(transactions)
+                processed_transaction_hashes.append(transaction_hash)
+
+    return transaction_bank, processed_transaction_hashes, previous_prices
+
+
+def convert_legacy_session(filename):
+    """
+    Rewrite a save file from before the container format as a container. The original file is kept with .legacy
+    added to its name.
+    :return: True if the file was converted, False if it was already a container
+    """
+    if not is_legacy_session(filename):
+        return False
+    (transaction_bank, processed_transaction_hashes, previous_prices) = load_session(filename)
+    os.replace(filename, f"{filename}.legacy")
+    save_session(filename, transaction_bank, processed_transaction_hashes, previous_prices)
+    return True
+
+
+class SessionJournal:
+    """
+    Saves the progress of a session as transactions are processed. Each call to record() appends the transactions
+    added to the bank since the last call and the processed hash to the journal file.
+    """
+    def __init__(self, name, transaction_bank, processed_transaction_hashes):
+        self.filename = session_path(name)
+        self.transaction_bank = transaction_bank
+        self.processed_transaction_hashes = processed_transaction_hashes
+        self.lengths = dict()
+        self.records = 0
+        # start from a snapshot of the loaded state, which may have come from a different save file
+        self.compact()
+
+    def record(self, transaction_hash):
+        new_transactions = []
+        for token, transactions in self.transaction_bank.items():
+            saved_length = self.lengths.get(token, 0)
+            if len(transactions) > saved_length:
+                new_transactions.append((token, transactions[saved_length:]))
+                self.lengths[token] = len(transactions)
+
+        with open(journal_path(self.filename), "ab") as journal_file:
+            pickle.dump((transaction_hash, new_transactions), journal_file)
+        self.records += 1
+
+        if self.records >= COMPACT_EVERY:
+            self.compact()
+
+    def compact(self):
+        save_session(self.filename, self.transaction_bank, self.processed_transaction_hashes)
+        self.lengths = {token: len(transactions) for token, transactions in self.transaction_bank.items()}
+        self.records = 0
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description="List saved sessions, or convert old save files to the container format.")
+    parser.add_argument('--convert', action='store_true', help="convert old format save files")
+    parser.add_argument('files', nargs='*', help="save files (default all in results/transactions)")
+    args = parser.parse_args()
+
+    for f in args.files or sorted(glob.glob(os.path.join(SAVE_DIR, "*.p"))):
+        if args.convert and convert_legacy_session(f):
+            print(f"Converted {os.path.basename(f)}, the original was kept as {os.path.basename(f)}.legacy")
+        print(describe_session(f))
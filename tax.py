@@ -1,17 +1,33 @@
 from utils import FeatureState, Holding, TokenState, get_user_input
 from transactions import TransactionType, Transaction
+from session import load_session, describe_session, print_session_summary
+from batch import ask, rule, rule_date, batch_mode, load_rules, file_answer, add_to_review_queue
 
 from sys import exit
+from argparse import ArgumentParser
 from enum import Enum, auto
 from dateutil.relativedelta import relativedelta
 import pandas as pd
-import pickle
 import glob
 import yaml
-import pprint
 import os
 import heapq
 import datetime
+import numpy as np
+import pickle
+import hashlib
+import numbers
+import importlib.util
+from itertools import repeat
+from concurrent.futures import ProcessPoolExecutor
+
+
+class InsufficientHoldingsError(Exception):
+    """
+    Raised when there are not enough holdings to match a disposal and nobody can be asked about it, eg. in a worker
+    process.
+    """
+    pass
 
 
 class TaxType(Enum):
@@ -19,22 +35,176 @@ class TaxType(Enum):
     CAPGAINS = auto()
 
 
+# holdings of each token saved at the end of each financial year, see tax_process_token_checkpointed
+TAX_CHECKPOINTS = os.path.join(os.path.dirname(__file__), "results", "cache", "tax-checkpoints.p")
+# change this when what is saved in the checkpoints changes, so that older checkpoints aren't used
+TAX_CHECKPOINTS_VERSION = 3
+
+# columns of the tax summaries
+TAX_COLUMNS = ['Time Acquired', 'Time Disposed', 'Token', 'Tax Type', 'Cost Base', 'Capital Proceeds', 'Volume', 'CG Discount Eligible', 'Value']
+
+# codes used for the total of each kind of taxable amount, see TaxRecords.totals
+INCOME_TOTAL = 0
+DISCOUNT_ELIGIBLE_TOTAL = 1
+DISCOUNT_INELIGIBLE_TOTAL = 2
+CAPITAL_LOSSES_TOTAL = 3
+
+# bits of TaxRecords.integers, set for each value of a row that was an int rather than a float (eg. the capital
+# proceeds of 0 for a loss), as columns where every value is an int are written to csv without a decimal point
+INTEGER_COST_BASE = 1
+INTEGER_PROCEEDS = 2
+INTEGER_VOLUME = 4
+INTEGER_VALUE = 8
+
+
+def is_integer(value):
+    return isinstance(value, numbers.Integral) and not isinstance(value, bool)
+
+
+def integer_flags(start_price, end_price, volume, *amount_operands):
+    """
+    The TaxRecords.integers bits of a row.
+    :param amount_operands: the values the row's amount was calculated from, it is an int if they all are
+    """
+    flags = 0
+    for bit, value in [(INTEGER_COST_BASE, start_price), (INTEGER_PROCEEDS, end_price), (INTEGER_VOLUME, volume)]:
+        if is_integer(value):
+            flags |= bit
+    if all(is_integer(value) for value in amount_operands):
+        flags |= INTEGER_VALUE
+    return flags
+
+
+def to_datetime64(time):
+    """Convert a datetime or pandas Timestamp (or None) into a numpy datetime64."""
+    if time is None:
+        return np.datetime64('NaT', 'ns')
+    return pd.Timestamp(time).to_datetime64()
+
+
+class TaxRecords:
+    """
+    The rows of a single tax year's summary, kept as typed column arrays with room for more rows, which are doubled in
+    size when they fill up. Tax types are stored as integer codes (TaxType value - 1).
+    """
+    def __init__(self, capacity=256):
+        self.size = 0
+        self.start_times = np.empty(capacity, dtype='datetime64[ns]')
+        self.end_times = np.empty(capacity, dtype='datetime64[ns]')
+        self.tokens = np.empty(capacity, dtype=object)
+        self.tax_types = np.empty(capacity, dtype=np.int8)
+        self.start_prices = np.empty(capacity, dtype=float)
+        self.end_prices = np.empty(capacity, dtype=float)
+        self.volumes = np.empty(capacity, dtype=float)
+        self.discounts = np.empty(capacity, dtype=bool)
+        self.values = np.empty(capacity, dtype=float)
+        self.integers = np.empty(capacity, dtype=np.uint8)
+
+    def columns(self):
+        return ['start_times', 'end_times', 'tokens', 'tax_types', 'start_prices', 'end_prices', 'volumes', 'discounts', 'values', 'integers']
+
+    def reserve(self, count):
+        """Make sure there is room for count more rows."""
+        capacity = len(self.values)
+        if self.size + count <= capacity:
+            return
+        while capacity < self.size + count:
+            capacity *= 2
+        for column in self.columns():
+            old = getattr(self, column)
+            new = np.empty(capacity, dtype=old.dtype)
+            new[:self.size] = old[:self.size]
+            setattr(self, column, new)
+
+    def append(self, start_time, end_time, token, tax_type, start_price, end_price, volume, discount, amount):
+        self.reserve(1)
+        row = self.size
+        self.start_times[row] = to_datetime64(start_time)
+        self.end_times[row] = to_datetime64(end_time)
+        self.tokens[row] = token
+        self.tax_types[row] = tax_type.value - 1
+        self.start_prices[row] = start_price
+        self.end_prices[row] = end_price
+        self.volumes[row] = volume
+        self.discounts[row] = discount
+        self.values[row] = amount
+        self.integers[row] = integer_flags(start_price, end_price, volume, amount)
+        self.size += 1
+
+    def extend(self, start_times, end_times, tokens, tax_types, start_prices, end_prices, volumes, discounts, amounts, integers):
+        """
+        Add several rows at once, each argument is an array with a value for each row, tax_types are codes and
+        integers are the bits from integer_flags.
+        """
+        count = len(amounts)
+        self.reserve(count)
+        for column, values in zip(self.columns(), [start_times, end_times, tokens, tax_types, start_prices, end_prices, volumes, discounts, amounts, integers]):
+            getattr(self, column)[self.size:self.size + count] = values
+        self.size += count
+
+    def merge(self, other):
+        """Add all the rows of another TaxRecords."""
+        self.extend(*[getattr(other, column)[:other.size] for column in self.columns()])
+
+    def totals(self):
+        """
+        Total income, discount-eligible and ineligible capital gains and capital losses, each summed with pandas over
+        the rows it counts so that the totals come out to the same last digit as summing the dataframe's columns.
+        :return: list of the totals, indexed by INCOME_TOTAL, DISCOUNT_ELIGIBLE_TOTAL etc.
+        """
+        values = self.values[:self.size]
+        # summed as ints when every value was an int, which a year with no rows counts as, giving int zeros
+        if np.all(self.integers[:self.size] & INTEGER_VALUE):
+            values = values.astype(np.int64)
+        is_income = self.tax_types[:self.size] == TaxType.INCOME.value - 1
+        discounts = self.discounts[:self.size]
+        masks = [None] * 4
+        masks[INCOME_TOTAL] = is_income
+        masks[DISCOUNT_ELIGIBLE_TOTAL] = ~is_income & discounts & (values >= 0)
+        masks[DISCOUNT_INELIGIBLE_TOTAL] = ~is_income & ~discounts & (values >= 0)
+        masks[CAPITAL_LOSSES_TOTAL] = ~is_income & (values < 0)
+        return [pd.Series(values[mask]).sum() for mask in masks]
+
+    def to_frame(self):
+        """
+        The rows as a dataframe with TAX_COLUMNS, where 'Tax Type' is categorical, and the number columns where every
+        value was an int are ints.
+        """
+        frame = pd.DataFrame({'Time Acquired': self.start_times[:self.size],
+                              'Time Disposed': self.end_times[:self.size],
+                              'Token': self.tokens[:self.size],
+                              'Tax Type': pd.Categorical.from_codes(self.tax_types[:self.size], [str(tax_type) for tax_type in TaxType]),
+                              'Cost Base': self.start_prices[:self.size],
+                              'Capital Proceeds': self.end_prices[:self.size],
+                              'Volume': self.volumes[:self.size],
+                              'CG Discount Eligible': self.discounts[:self.size],
+                              'Value': self.values[:self.size]},
+                             columns=TAX_COLUMNS)
+        if self.size > 0:
+            integers = self.integers[:self.size]
+            for bit, column in [(INTEGER_COST_BASE, 'Cost Base'), (INTEGER_PROCEEDS, 'Capital Proceeds'), (INTEGER_VOLUME, 'Volume'), (INTEGER_VALUE, 'Value')]:
+                if (integers & bit).all():
+                    frame[column] = frame[column].astype(np.int64)
+        return frame
+
+
 class TaxState(FeatureState):
     """
     Contains the tax information for each of the financial years between the start and end dates.
     """
-    def __init__(self, start_date, end_date):
+    def __init__(self, start_date, end_date, interactive=True):
         super().__init__(start_date, end_date)
         self.tax_years = self.setup_tax_years()
         self.token_states = dict()
+        # whether the user can be asked about disposals that don't have enough holdings
+        self.interactive = interactive
 
     def setup_tax_years(self):
         tax_years = dict()
         date = self.start_date
         while date <= self.end_date:
-            print(f"Date: {date}, Year: {date.year}")
             year_string, second_year = calculate_tax_year(date)
-            tax_years[year_string] = []
+            tax_years[year_string] = TaxRecords()
             date = datetime.datetime(second_year, 7, 1)
         return tax_years
 
@@ -42,7 +212,7 @@ class TaxState(FeatureState):
         # add bought tokens to holdings, so that cost basis is tracked
         # check if token is already in token states, if not then add
         if transaction.token not in self.token_states:
-            self.token_states[transaction.token] = TaxTokenState(transaction.token)
+            self.token_states[transaction.token] = TaxTokenState(transaction.token, self.interactive)
         # create a new holding representing the tokens that were bought and their cost basis
         holding = TaxHolding(transaction.token, transaction.time, transaction.token_price, transaction.token_fee_adjusted_price, transaction.volume)
         self.token_states[transaction.token].add_holding(holding)
@@ -50,7 +220,7 @@ class TaxState(FeatureState):
     def process_sell(self, transaction):
         # check if token is already in token states, if not then add
         if transaction.token not in self.token_states:
-            self.token_states[transaction.token] = TaxTokenState(transaction.token)
+            self.token_states[transaction.token] = TaxTokenState(transaction.token, self.interactive)
         # get cost basis of token from holdings, and process the difference in value as capital gains
         holding_info = self.token_states[transaction.token].subtract_holding(transaction.volume, transaction)
 
@@ -67,7 +237,7 @@ class TaxState(FeatureState):
         # add gained tokens to holdings, so that cost basis is tracked
         # check if token is already in token states, if not then add
         if transaction.token not in self.token_states:
-            self.token_states[transaction.token] = TaxTokenState(transaction.token)
+            self.token_states[transaction.token] = TaxTokenState(transaction.token, self.interactive)
         # create a new holding representing the tokens that were gained and their cost basis
         holding = TaxHolding(transaction.token, transaction.time, transaction.token_price, transaction.token_fee_adjusted_price, transaction.volume)
         self.token_states[transaction.token].add_holding(holding)
@@ -77,7 +247,7 @@ class TaxState(FeatureState):
         # if crypto is gifted or otherwise disposed of at market price, this should have been considered a sell at market price
         # check if token is already in token states, if not then add
         if transaction.token not in self.token_states:
-            self.token_states[transaction.token] = TaxTokenState(transaction.token)
+            self.token_states[transaction.token] = TaxTokenState(transaction.token, self.interactive)
         # get cost basis of token from holdings, and process the difference in value as capital loss
         holding_info = self.token_states[transaction.token].subtract_holding(transaction.volume, transaction)
 
@@ -94,40 +264,117 @@ class TaxState(FeatureState):
             discount = False
         else:
             discount = (end_time > start_time + relativedelta(months=+12))
-        self.tax_years[tax_year].append([start_time, end_time, token, tax_type, start_price, end_price, volume, discount, amount])
-
-    def finish_processing(self, file_name):
-        # process all the lists of lists for each year into dataframes
-        # add total lines for each of income and capgains, then save to file
-        for tax_year in self.tax_years.keys():
-            # convert into dataframe
-            self.tax_years[tax_year] = pd.DataFrame(self.tax_years[tax_year], columns=['Time Acquired',
-                                                                                       'Time Disposed',
-                                                                                       'Token',
-                                                                                       'Tax Type',
-                                                                                       'Cost Base',
-                                                                                       'Capital Proceeds',
-                                                                                       'Volume',
-                                                                                       'CG Discount Eligible',
-                                                                                       'Value'])
+        self.tax_years[tax_year].append(start_time, end_time, token, tax_type, start_price, end_price, volume, discount, amount)
+
+    def process_fifo(self, transactions):
+        """
+        Process all of the transactions of a single (non-fiat) token at once. Disposals are matched to holdings with the
+        same holdings heap and the same subtractions as process_sell/process_loss, so the lots are exactly the same
+        (including their order when holdings were acquired at the same time, and any with no volume left), but the
+        rows are built as arrays and added to each tax year at once rather than one at a time with adjust_tax.
+        :param transactions: the token's transactions, sorted by time
+        :return: True if the transactions were processed, or False (with nothing recorded and the holdings unchanged)
+        if there were not enough holdings to match a disposal, so the transactions need to be processed one by one to
+        ask about the shortfall
+        """
+        if not transactions:
+            return True
+        name = transactions[0].token
+        if name not in self.token_states:
+            self.token_states[name] = TaxTokenState(name, self.interactive)
+        # work on copies of the holdings, so they are unchanged if there aren't enough for a disposal
+        holdings = [TaxHolding(holding.name, holding.time, holding.price, holding.tax_price, holding.volume) for holding in self.token_states[name].holdings]
+
+        # the rows in the order that process_gain, process_sell and process_loss would add them
+        start_times, end_times, tax_types, start_prices, end_prices, volumes, losses, integers = [], [], [], [], [], [], [], []
+        for transaction in transactions:
+            if transaction.transaction_type == TransactionType.BUY:
+                heapq.heappush(holdings, TaxHolding(name, transaction.time, transaction.token_price, transaction.token_fee_adjusted_price, transaction.volume))
+            elif transaction.transaction_type == TransactionType.GAIN:
+                # income rows don't have a start time or cost base
+                start_times.append(None)
+                end_times.append(transaction.time)
+                tax_types.append(TaxType.INCOME.value - 1)
+                start_prices.append(0)
+                end_prices.append(transaction.token_price)
+                volumes.append(transaction.volume)
+                losses.append(False)
+                integers.append(integer_flags(0, transaction.token_price, transaction.volume, transaction.token_price, transaction.volume))
+                heapq.heappush(holdings, TaxHolding(name, transaction.time, transaction.token_price, transaction.token_fee_adjusted_price, transaction.volume))
+            elif transaction.transaction_type in [TransactionType.SELL, TransactionType.LOSS]:
+                # sells are disposed of at their fee adjusted price and losses at a price of 0
+                is_loss = transaction.transaction_type == TransactionType.LOSS
+                end_price = 0 if is_loss else transaction.token_fee_adjusted_price
+                sell_volume = transaction.volume
+                while sell_volume > 0:
+                    if not holdings:
+                        return False
+                    holding = heapq.heappop(holdings)
+                    if holding.volume > sell_volume:
+                        holding.volume -= sell_volume
+                        heapq.heappush(holdings, holding)
+                        lot_volume = sell_volume
+                        sell_volume = 0
+                    else:
+                        lot_volume = holding.volume
+                        sell_volume -= holding.volume
+                    start_times.append(holding.time)
+                    end_times.append(transaction.time)
+                    tax_types.append(TaxType.CAPGAINS.value - 1)
+                    start_prices.append(holding.tax_price)
+                    end_prices.append(end_price)
+                    volumes.append(lot_volume)
+                    losses.append(is_loss)
+                    if is_loss:
+                        integers.append(integer_flags(holding.tax_price, end_price, lot_volume, holding.tax_price, lot_volume))
+                    else:
+                        integers.append(integer_flags(holding.tax_price, end_price, lot_volume, end_price, holding.tax_price, lot_volume))
+            else:
+                raise Exception("Transaction Type is not valid")
+        self.token_states[name].holdings = holdings
+        if not volumes:
+            return True
+
+        tax_types = np.array(tax_types, dtype=np.int8)
+        start_prices = np.array(start_prices, dtype=float)
+        end_prices = np.array(end_prices, dtype=float)
+        volumes = np.array(volumes, dtype=float)
+        is_income = tax_types == TaxType.INCOME.value - 1
+        losses = np.array(losses, dtype=bool)
+        # calculated the same way as process_gain, process_loss and process_sell, so the values are exactly the same
+        amounts = np.where(is_income, end_prices * volumes, np.where(losses, (-1) * start_prices * volumes, (end_prices - start_prices) * volumes))
+        start_times = pd.DatetimeIndex(pd.to_datetime(start_times)).values.astype('datetime64[ns]')
+        end_times = pd.DatetimeIndex(pd.to_datetime(end_times))
+        # 50% CG discount applies to holdings held for more than 12 months, see adjust_tax
+        discounts = ~is_income & np.asarray(end_times > pd.DatetimeIndex(start_times) + pd.DateOffset(months=12))
+        tokens = np.empty(len(volumes), dtype=object)
+        tokens[:] = [name] * len(volumes)
+        columns = [start_times, end_times.values.astype('datetime64[ns]'), tokens, tax_types, start_prices, end_prices, volumes, discounts, amounts,
+                   np.array(integers, dtype=np.uint8)]
+
+        # add the rows to the tax year they were disposed of (or received) in
+        second_years = np.asarray(end_times.year + (end_times.month >= 7))
+        for second_year in np.unique(second_years):
+            tax_year, _ = calculate_tax_year(datetime.datetime(int(second_year), 1, 1))
+            in_year = second_years == second_year
+            self.tax_years[tax_year].extend(*[column[in_year] for column in columns])
+        return True
+
+    def finish_processing(self, file_name, parquet=False):
+        """
+        Turn each year's rows into a dataframe, add total lines for each of income and capgains, then save to file.
+        :param file_name: start of the name of each year's output file
+        :param parquet: whether to also save each year as parquet files, the rows (with a categorical 'Tax Type') in
+        {file_name}-{tax_year}.parquet and the totals in {file_name}-{tax_year}-totals.parquet
+        """
+        for tax_year, records in self.tax_years.items():
+            rows = records.to_frame()
             # calculate totals
-            values = self.tax_years[tax_year].loc[:, 'Value']
-            # calculate income
-            income = values[self.tax_years[tax_year]['Tax Type'] == TaxType.INCOME].sum()
-
-            # calculate CG-discount-eligible capital gains
-            discount_eligible_cap_gains = values[(self.tax_years[tax_year]['Tax Type'] == TaxType.CAPGAINS) &
-                                                 (self.tax_years[tax_year]['CG Discount Eligible']) &
-                                                 (self.tax_years[tax_year]['Value'] >= 0)].sum()
-
-            # calculate CG-discount-ineligible capital gains
-            discount_ineligible_cap_gains = values[(self.tax_years[tax_year]['Tax Type'] == TaxType.CAPGAINS) &
-                                                   (~self.tax_years[tax_year]['CG Discount Eligible']) &
-                                                   (self.tax_years[tax_year]['Value'] >= 0)].sum()
-
-            # calculate capital losses
-            cap_losses = -1 * values[(self.tax_years[tax_year]['Tax Type'] == TaxType.CAPGAINS) &
-                                     (self.tax_years[tax_year]['Value'] < 0)].sum()
+            totals = records.totals()
+            income = totals[INCOME_TOTAL]
+            discount_eligible_cap_gains = totals[DISCOUNT_ELIGIBLE_TOTAL]
+            discount_ineligible_cap_gains = totals[DISCOUNT_INELIGIBLE_TOTAL]
+            cap_losses = -1 * totals[CAPITAL_LOSSES_TOTAL]
 
             # calculate total capital gains as 'discount-ineligible CG - capital losses + 0.5 * (discount-eligible CG - remaining capital losses)
             if cap_losses > discount_ineligible_cap_gains + discount_eligible_cap_gains:
@@ -137,25 +384,23 @@ class TaxState(FeatureState):
             else:
                 cap_gains = (discount_ineligible_cap_gains - cap_losses) + (0.5 * discount_eligible_cap_gains)
 
-            # add total rows
-            self.tax_years[tax_year].loc[len(self.tax_years[tax_year])] = (
-                [None, tax_year, 'Total Income', TaxType.INCOME, None, None, None, None, income]
-            )
-            self.tax_years[tax_year].loc[len(self.tax_years[tax_year])] = (
-                [None, tax_year, 'Discount-Eligible CG', TaxType.CAPGAINS, None, None, None, None, discount_eligible_cap_gains]
-            )
-            self.tax_years[tax_year].loc[len(self.tax_years[tax_year])] = (
-                [None, tax_year, 'Discount-Ineligible CG', TaxType.CAPGAINS, None, None, None, None, discount_ineligible_cap_gains]
-            )
-            self.tax_years[tax_year].loc[len(self.tax_years[tax_year])] = (
-                [None, tax_year, 'Capital Losses', TaxType.CAPGAINS, None, None, None, None, cap_losses]
-            )
-            self.tax_years[tax_year].loc[len(self.tax_years[tax_year])] = (
-                [None, tax_year, 'Total Capital Gains', TaxType.CAPGAINS, None, None, None, None, cap_gains]
-            )
+            # total rows
+            total_rows = pd.DataFrame([[None, tax_year, 'Total Income', str(TaxType.INCOME), None, None, None, None, income],
+                                       [None, tax_year, 'Discount-Eligible CG', str(TaxType.CAPGAINS), None, None, None, None, discount_eligible_cap_gains],
+                                       [None, tax_year, 'Discount-Ineligible CG', str(TaxType.CAPGAINS), None, None, None, None, discount_ineligible_cap_gains],
+                                       [None, tax_year, 'Capital Losses', str(TaxType.CAPGAINS), None, None, None, None, cap_losses],
+                                       [None, tax_year, 'Total Capital Gains', str(TaxType.CAPGAINS), None, None, None, None, cap_gains]],
+                                      columns=TAX_COLUMNS)
+
+            # the summary has the total rows at the bottom, times are written as they were in the transactions
+            self.tax_years[tax_year] = pd.concat([rows.astype({'Time Acquired': object, 'Time Disposed': object, 'Tax Type': object}), total_rows],
+                                                 ignore_index=True)
 
             # save to csv
             self.tax_years[tax_year].to_csv(os.path.join(os.path.dirname(__file__), "results", "tax", f"{file_name}-{tax_year}.csv"))
+            if parquet:
+                rows.to_parquet(os.path.join(os.path.dirname(__file__), "results", "tax", f"{file_name}-{tax_year}.parquet"))
+                total_rows.to_parquet(os.path.join(os.path.dirname(__file__), "results", "tax", f"{file_name}-{tax_year}-totals.parquet"))
 
         print("Tax summaries have been saved to /results/tax.")
 
@@ -168,8 +413,11 @@ class TaxTokenState(TokenState):
     Contains information about a token and all buy/incoming transactions for which a sell/outgoing transaction has not
     yet been processed.
     """
-    def __init__(self, name):
+    def __init__(self, name, interactive=True):
         super().__init__(name)
+        self.interactive = interactive
+        # number of disposals that didn't have enough holdings, so the rest was filled in by the user or a placeholder
+        self.shortfalls = 0
 
     def subtract_holding(self, sell_volume, transaction):
         """May involve subtracting from an existing holding or removing a completely used-up holding."""
@@ -192,7 +440,17 @@ class TaxTokenState(TokenState):
                 # if we've run out of holdings before getting through all of the sell volume, there's probably been
                 # a mistake or not all transactions were processed correctly when creating the transaction bank
                 # get the needed info from the user
+                if not self.interactive:
+                    raise InsufficientHoldingsError(f"Not enough holdings of {self.name} to match a disposal of {sell_volume}")
                 print(f"Transaction: {transaction} \nRemaining volume not matched: {sell_volume}")
+                self.shortfalls += 1
+                if batch_mode():
+                    # nobody to ask in batch mode, so add it to the review queue and use a zero cost base acquired at
+                    # the time of the disposal for now, which never understates the gain
+                    add_to_review_queue('tax', None, transaction.time, f"Not enough holdings of {self.name} to match a disposal of {sell_volume}")
+                    holding_info.append((transaction.time, 0, sell_volume))
+                    sell_volume = 0
+                    continue
                 print("Not enough holdings from buy/income transactions were found to match this disposal. Please enter the necessary information for taxes.")
                 time = get_user_input("Time when acquired: (YYYY-MM-DD HH:MM:SS) ", 'datetime')
                 tz = get_user_input(f"What timezone is this time in, as an offset from UTC? (eg. +10, -9 etc.) ", 'int')
@@ -214,6 +472,8 @@ class TaxHolding(Holding):
     Represents a token that has been aquired but for which the disposal has not been processed or occurred. This is
     generally an intermediate item in a tax queue awaiting processing.
     """
+    __slots__ = ('tax_price',)
+
     def __init__(self, name, time, price, tax_price, volume):
         super().__init__(name, time, price, volume)
         self.tax_price = tax_price
@@ -232,89 +492,274 @@ def calculate_tax_year(date):
         return f"{date.year - 1}-{date.year - 2000}FY", date.year
 
 
-def tax_process_all_transactions(transaction_bank, start_date, end_date, currency='aud'):
-    # create a TaxState object that holds information about the state and results of the processing so far
-    print("Trying to create a tax state...")
-    tax = TaxState(start_date, end_date)
-    print("Created a tax state...")
-
-    # transaction bank is a dictionary of (token ticker: list of transactions) pairs
-    # go through tokens, processing each transaction and the tax consequences
-    for (token, transactions) in transaction_bank.items():
-        # sort the list of transactions by date
-        transactions.sort(key=lambda x: x.time)
+def tax_process_token(tax, token, transactions, currency='aud', engine='heap', verbose=True):
+    """
+    Process the tax consequences of all of one token's transactions, which must be sorted by time.
+    :param tax: the TaxState to add the results to
+    :param engine: 'heap' (the default) to process transactions one by one, or 'numpy' to process the token's
+    transactions at once and build the rows as arrays (see TaxState.process_fifo)
+    :param verbose: whether to print each transaction
+    """
+    if verbose:
         print("-------------------------------------------------------------------------------------------------")
         print(f"Processing transactions involving {token}, here is the list: ")
         for transaction in transactions:
             print(f"{transaction}")
 
-        # if token is fiat currency, only process gains as taxable
-        if type(token) is not tuple and token.lower() == currency.lower():
-            for transaction in transactions:
-                if transaction.transaction_type == TransactionType.GAIN:
-                    tax.process_gain(transaction)
+    # if token is fiat currency, only process gains as taxable
+    if type(token) is not tuple and token.lower() == currency.lower():
+        for transaction in transactions:
+            if transaction.transaction_type == TransactionType.GAIN:
+                tax.process_gain(transaction)
+                if verbose:
                     print(f"Gain of {token} processed")
-        else:
-            # go through transactions in chronological order
-            for transaction in transactions:
-                if transaction.transaction_type == TransactionType.BUY:
-                    tax.process_buy(transaction)
+    elif engine == 'numpy' and tax.process_fifo(transactions):
+        if verbose:
+            print(f"Processed {len(transactions)} transactions of {token}")
+    else:
+        # go through transactions in chronological order
+        # this is also used when there are not enough holdings for a disposal, so the user can be asked about it
+        for transaction in transactions:
+            if transaction.transaction_type == TransactionType.BUY:
+                tax.process_buy(transaction)
+                if verbose:
                     print(f"Buy of {token} processed")
-                elif transaction.transaction_type == TransactionType.SELL:
-                    tax.process_sell(transaction)
+            elif transaction.transaction_type == TransactionType.SELL:
+                tax.process_sell(transaction)
+                if verbose:
                     print(f"Sell of {token} processed")
-                elif transaction.transaction_type == TransactionType.GAIN:
-                    tax.process_gain(transaction)
+            elif transaction.transaction_type == TransactionType.GAIN:
+                tax.process_gain(transaction)
+                if verbose:
                     print(f"Gain of {token} processed")
-                elif transaction.transaction_type == TransactionType.LOSS:
-                    tax.process_loss(transaction)
+            elif transaction.transaction_type == TransactionType.LOSS:
+                tax.process_loss(transaction)
+                if verbose:
                     print(f"Loss of {token} processed")
+            else:
+                raise Exception("Transaction Type is not valid")
+
+
+def financial_year_segments(transactions):
+    """
+    Split a token's transactions (sorted by time) into the financial years they happened in.
+    :return: list of [tax year string, index of the year's first transaction, index after its last transaction]
+    """
+    segments = []
+    for ind, transaction in enumerate(transactions):
+        tax_year, _ = calculate_tax_year(transaction.time)
+        if segments and segments[-1][0] == tax_year:
+            segments[-1][2] = ind + 1
+        else:
+            segments.append([tax_year, ind, ind + 1])
+    return segments
+
+
+def transaction_fingerprints(transactions, segments):
+    """
+    Fingerprint all of the transactions up to the end of each financial year, so that a checkpoint can tell whether
+    anything before it has changed.
+    :return: list of md5 hex digests, one for each segment from financial_year_segments
+    """
+    digest = hashlib.md5()
+    fingerprints = []
+    for _, start, end in segments:
+        for transaction in transactions[start:end]:
+            digest.update(repr((str(transaction.time), transaction.transaction_type.name, transaction.token, transaction.volume, transaction.token_price,
+                                transaction.token_fee_adjusted_price)).encode('utf-8'))
+        fingerprints.append(digest.hexdigest())
+    return fingerprints
+
+
+def tax_process_token_checkpointed(tax, token, transactions, saved, currency='aud', engine='heap', verbose=True):
+    """
+    Process the tax consequences of one token's transactions, starting from the holdings saved at the end of the last
+    financial year that has not changed since the previous run. The rows of the financial years before that are
+    reused from the checkpoints as well.
+    :param tax: the TaxState to add the results to, rows outside of its tax years are left out
+    :param saved: list of checkpoints saved for this token by a previous run, one for the end of each financial year
+    the token has transactions in, each a dictionary with 'tax_year', 'fingerprint', 'holdings' and 'records'
+    :return: the updated list of checkpoints. Years where a disposal didn't have enough holdings (and the years after
+    them) aren't checkpointed, so the shortfall is dealt with again on the next run rather than reusing what was
+    filled in for it, eg. a zero cost base placeholder in batch mode
+    """
+    if not transactions:
+        return []
+    segments = financial_year_segments(transactions)
+    fingerprints = transaction_fingerprints(transactions, segments)
+
+    # find how many financial years are unchanged since the checkpoints were saved
+    resume = 0
+    while resume < min(len(segments), len(saved)) and saved[resume]['fingerprint'] == fingerprints[resume]:
+        resume += 1
+    checkpoints = saved[:resume]
+
+    # holdings and rows for this token only, covering all the years it has transactions in
+    token_tax = TaxState(transactions[0].time, transactions[-1].time, tax.interactive)
+    for checkpoint in checkpoints:
+        token_tax.tax_years[checkpoint['tax_year']] = checkpoint['records']
+    if checkpoints:
+        for name, holdings in checkpoints[-1]['holdings'].items():
+            token_tax.token_states[name] = TaxTokenState(name, tax.interactive)
+            # saved in heap order, so holdings acquired at the same time are used in the same order as a full run
+            token_tax.token_states[name].holdings = [TaxHolding(name, time, price, tax_price, volume) for time, price, tax_price, volume in holdings]
+        if verbose:
+            print(f"Using saved holdings of {token} at the end of the {checkpoints[-1]['tax_year']} financial year")
+
+    # process the rest of the years, saving the holdings at the end of each
+    for tax_year, start, end in segments[resume:]:
+        tax_process_token(token_tax, token, transactions[start:end], currency, engine, verbose)
+        if any(state.shortfalls for state in token_tax.token_states.values()):
+            continue
+        checkpoints.append({'tax_year': tax_year,
+                            'fingerprint': fingerprints[len(checkpoints)],
+                            'holdings': {name: [(holding.time, holding.price, holding.tax_price, holding.volume) for holding in state.holdings]
+                                         for name, state in token_tax.token_states.items()},
+                            'records': token_tax.tax_years[tax_year]})
+
+    for tax_year, records in token_tax.tax_years.items():
+        if tax_year in tax.tax_years:
+            tax.tax_years[tax_year].merge(records)
+    return checkpoints
+
+
+def load_tax_checkpoints():
+    """
+    Load the holdings checkpoints saved by previous runs.
+    :return: dictionary mapping (token, currency, engine) to the token's list of checkpoints
+    """
+    if not os.path.exists(TAX_CHECKPOINTS):
+        return dict()
+    with open(TAX_CHECKPOINTS, "rb") as checkpoint_file:
+        saved = pickle.load(checkpoint_file)
+    if saved.get('version') != TAX_CHECKPOINTS_VERSION:
+        return dict()
+    return saved['checkpoints']
+
+
+def save_tax_checkpoints(checkpoints):
+    os.makedirs(os.path.dirname(TAX_CHECKPOINTS), exist_ok=True)
+    temp_filename = f"{TAX_CHECKPOINTS}.tmp"
+    with open(temp_filename, "wb") as checkpoint_file:
+        pickle.dump({'version': TAX_CHECKPOINTS_VERSION, 'checkpoints': checkpoints}, checkpoint_file)
+    os.replace(temp_filename, TAX_CHECKPOINTS)
+
+
+def tax_process_token_worker(token, transactions, start_date, end_date, currency, engine, saved):
+    """
+    Process one token's transactions in a worker process, see tax_process_token_checkpointed.
+    :return: (the rows added to each tax year, the token's updated checkpoints), or None if there were not enough
+    holdings for a disposal, so the token needs to be processed in the main process where the user can be asked about it
+    """
+    tax = TaxState(start_date, end_date, interactive=False)
+    try:
+        checkpoints = tax_process_token_checkpointed(tax, token, transactions, saved, currency, engine, verbose=False)
+    except InsufficientHoldingsError:
+        return None
+    return tax.tax_years, checkpoints
+
+
+def tax_process_all_transactions(transaction_bank, start_date, end_date, currency='aud', engine='heap', workers=1, parquet=False, use_checkpoints=True):
+    """
+    Work out the tax consequences of every transaction in the transaction bank and save the tax summaries.
+    :param engine: 'heap' (the default) to process transactions one by one, or 'numpy' to process each token's
+    transactions at once and build the rows as arrays (see TaxState.process_fifo)
+    :param workers: number of processes to split the tokens between. Each token's holdings are independent, so the
+    results are the same as processing them one after the other
+    :param parquet: whether to save the summaries as parquet files as well as csv
+    :param use_checkpoints: whether to start each token from the holdings saved at the end of the last financial year
+    that is unchanged since the previous run, rather than recomputing every year
+    """
+    # check before processing rather than failing after the first year's csv has been written
+    if parquet and importlib.util.find_spec('pyarrow') is None and importlib.util.find_spec('fastparquet') is None:
+        print("Saving parquet files needs pyarrow or fastparquet to be installed, eg. pip install pyarrow")
+        exit()
+
+    # create a TaxState object that holds information about the state and results of the processing so far
+    print("Trying to create a tax state...")
+    tax = TaxState(start_date, end_date)
+    print(f"Created a tax state for the {', '.join(tax.tax_years)} financial years...")
+
+    # sort the list of transactions of each token by date
+    for transactions in transaction_bank.values():
+        transactions.sort(key=lambda x: x.time)
+
+    checkpoints = load_tax_checkpoints()
+
+    def saved(token):
+        return checkpoints.get((token, currency, engine), []) if use_checkpoints else []
+
+    # transaction bank is a dictionary of (token ticker: list of transactions) pairs
+    # go through tokens, processing each transaction and the tax consequences
+    if workers > 1:
+        tokens = list(transaction_bank.keys())
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            # results come back in the same order as the tokens, so they are merged in the same order as a serial run
+            results = executor.map(tax_process_token_worker, tokens, [transaction_bank[token] for token in tokens], repeat(start_date), repeat(end_date),
+                                   repeat(currency), repeat(engine), [saved(token) for token in tokens], chunksize=max(1, len(tokens) // (4 * workers)))
+            for token, result in zip(tokens, results):
+                if result is None:
+                    checkpoints[(token, currency, engine)] = tax_process_token_checkpointed(tax, token, transaction_bank[token], saved(token), currency, engine)
                 else:
-                    raise Exception("Transaction Type is not valid")
+                    print(f"Processed {len(transaction_bank[token])} transactions of {token}")
+                    tax_years, checkpoints[(token, currency, engine)] = result
+                    for tax_year, records in tax_years.items():
+                        tax.tax_years[tax_year].merge(records)
+    else:
+        for (token, transactions) in transaction_bank.items():
+            checkpoints[(token, currency, engine)] = tax_process_token_checkpointed(tax, token, transactions, saved(token), currency, engine)
+    save_tax_checkpoints(checkpoints)
 
     # finish processing
-    file_name = input("Processing finished. \nOutput file name: ")
-    tax.finish_processing(file_name)
+    file_name = ask("Processing finished. \nOutput file name: ", rule('tax').get('output') if batch_mode() else None)
+    tax.finish_processing(file_name, parquet)
 
 
 def tax_read_in_transactions():
-    # read in from pickled file
+    # read in from saved session file
     file_list = glob.glob(os.path.join(os.path.dirname(__file__), "results", "transactions", "*.p"))
     if file_list:
         print("Transaction files:")
         for n, f in enumerate(file_list):
-            print(f"{n + 1}. {os.path.basename(f)}")
+            print(f"{n + 1}. {describe_session(f)}")
         while True:
-            file_num = input(f"Which transaction file would you like to load? (#/N) ")
+            file_num = ask(f"Which transaction file would you like to load? (#/N) ", file_answer(file_list, rule('tax').get('session', rule('session'))) if batch_mode() else None)
             if file_num in [str(m) for m in range(1, len(file_list) + 1)]:
-                with open(file_list[int(file_num) - 1], "rb") as pickle_file:
-                    (transaction_bank, processed_transaction_hashes, _) = pickle.load(pickle_file)
-                print(f"Loaded transaction hashes: {processed_transaction_hashes}")
-                pp = pprint.PrettyPrinter()
-                print("Loaded transactions:")
-                pp.pprint(transaction_bank)
+                print_session_summary(file_list[int(file_num) - 1])
+                (transaction_bank, processed_transaction_hashes, _) = load_session(file_list[int(file_num) - 1])
                 return transaction_bank
     else:
         print("No transaction files found, you will need to process transactions before calculating tax.")
         exit()
 
 
-def process_tax():
+def process_tax(engine='heap', workers=1, parquet=False, use_checkpoints=True):
 
     print("What period would you like to calculate taxable income and capital gains for?")
-    start_date = get_user_input(f"Enter the start date: (YYYY-MM-DD) ", 'date')
-    start_tz = get_user_input(f"What timezone is this date in, as an offset from UTC? (eg. +10, -9 etc.) ", 'int')
+    start_date = get_user_input(f"Enter the start date: (YYYY-MM-DD) ", 'date', rule_date('start_date'))
+    start_tz = get_user_input(f"What timezone is this date in, as an offset from UTC? (eg. +10, -9 etc.) ", 'int', rule('timezone'))
     start_date -= datetime.timedelta(hours=start_tz)
-    end_date = get_user_input(f"Enter the end date (inclusive): (YYYY-MM-DD) ", 'date')
-    end_tz = get_user_input(f"What timezone is this date in, as an offset from UTC? (eg. +10, -9 etc.) ", 'int')
+    end_date = get_user_input(f"Enter the end date (inclusive): (YYYY-MM-DD) ", 'date', rule_date('end_date'))
+    end_tz = get_user_input(f"What timezone is this date in, as an offset from UTC? (eg. +10, -9 etc.) ", 'int', rule('timezone'))
     end_date -= datetime.timedelta(hours=end_tz)
     end_date += datetime.timedelta(days=1)
 
     transaction_bank = tax_read_in_transactions()
     print("Returned transaction bank")
 
-    tax_process_all_transactions(transaction_bank, start_date, end_date)
+    tax_process_all_transactions(transaction_bank, start_date, end_date, engine=engine, workers=workers, parquet=parquet,
+                                 use_checkpoints=use_checkpoints)
 
 
 if __name__ == '__main__':
-    tax_df = process_tax()
\ No newline at end of file
+    parser = ArgumentParser()
+    parser.add_argument('--rules', '-r', help="rules file for processing without prompts, see batch.py")
+    parser.add_argument('--engine', '-e', choices=['numpy', 'heap'], default='heap', help="how each token's transactions are processed, numpy is opt-in")
+    parser.add_argument('--workers', '-w', type=int, default=1, help="number of processes to split tokens between")
+    parser.add_argument('--parquet', '-p', action='store_true', help="also save the tax summaries as parquet files")
+    parser.add_argument('--recompute', action='store_true', help="recompute every financial year instead of using saved holdings")
+    args = parser.parse_args()
+    if args.rules:
+        load_rules(args.rules)
+
+    tax_df = process_tax(args.engine, args.workers, args.parquet, not args.recompute)
\ No newline at end of file
@@ -1,23 +1,32 @@
-from utils import get_user_input, get_api_keys, get_transaction_by_hash, get_transactions_by_address
+from utils import get_user_input, get_api_keys, get_transaction_by_hash, get_transactions_by_address, get_internal_transactions, \
+    get_internal_transactions_by_hash, http_get, fetch_all, wait_for_rate_limit, wallet_files_dir, SCAN_API_DOMAINS, \
+    COVALENT_TIME_FORMAT
+from session import SessionJournal, ProcessedHashes, load_session, describe_session, print_session_summary
+from batch import ask, yes_no, rule, rule_date, batch_mode, load_rules, source_answer, wallet_answer, file_answer, \
+    match_classification, review_on_failure, record_answers, ANSWER_LOG
+from prices import PriceStore, LP_TOKENS, price_key, to_epoch
+from ingest import read_csv_chunks, read_csv_in_range, iter_hash_groups, iter_transaction_chunks
+from oracle import SwapPriceOracle, transfer_legs
+from blocks import BlockIndex
+from scheduler import DeferredTransactions
 
 import random
 import hashlib
+import heapq
 import os
 import pandas as pd
 import datetime
 import requests
 import warnings
-import pickle
 import glob
+import json
 import yaml
-import pprint
 from time import sleep
 import numpy as np
 from enum import Enum, auto
 from pycoingecko import CoinGeckoAPI
-from io import StringIO
-from collections import Counter
 import re
+from argparse import ArgumentParser
 
 warnings.filterwarnings("ignore")
 
@@ -31,6 +40,26 @@ NATIVE_TOKEN = {'ethereum': 'ETH', 'polygon': 'MATIC', 'bsc': 'BNB', 'fantom': '
 # mapping to translate the chain name into it's value
 CHAIN_IDS = {'ethereum': '1', 'polygon': '137', 'bsc': '56', 'fantom': '250'}
 
+# decoded signatures of the log events used to find token movements
+TRANSFER_SIGNATURE = "Transfer(indexed address from, indexed address to, uint256 value)"
+SWAP_SIGNATURE = "Swap(indexed address sender, uint256 amount0In, uint256 amount1In, uint256 amount0Out, uint256 amount1Out, indexed address to)"
+
+# columns read from covalent exports, and their types
+# the decoded parameter values are kept as strings as token amounts can be too large for any numeric type
+ONCHAIN_DTYPES = {'block_signed_at': str,
+                  'block_height': 'Int64',
+                  'tx_hash': str,
+                  'from_address': str,
+                  'to_address': str,
+                  'gas_spent': np.float64,
+                  'gas_price': np.float64,
+                  'log_events_decoded_signature': str,
+                  'log_events_decoded_params_name': str,
+                  'log_events_decoded_params_value': str,
+                  'log_events_sender_contract_ticker_symbol': str,
+                  'log_events_sender_address': str}
+ONCHAIN_TIME_FORMAT = COVALENT_TIME_FORMAT
+
 # classifications for transactions
 CLASSIFICATIONS = {1: 'Buy + Sell',
                    2: 'Buy',
@@ -47,39 +76,115 @@ TICKERS_NO_CONFIRM = []
 COINGECKO_NO_CONFIRM = []
 NOCOINGECKO_NO_CONFIRM = []
 
-# dictionary of swap addresses for each token
+# binance 2021 csv operations that are not tax relevant, and those that are
+BINANCE_IGNORED_OPERATIONS = ['deposit', 'withdraw', 'pos savings purchase', 'pos savings redemption', 'savings purchase', 'liquid swap add',
+                              'savings principal redemption']
+BINANCE_TAXABLE_OPERATIONS = ['pos savings interest', 'rewards distribution', 'savings interest', 'fee', 'transaction related', 'buy', 'sell',
+                              'commission fee shared with you']
+
+# swap addresses found for each token, keyed by chain:contract address, see find_common_swap_addresses
 SWAP_ADDRESSES = dict()
+# file the swap addresses are saved to, and how long they are used for before finding them again
+SWAP_ADDRESSES_CACHE = os.path.join(os.path.dirname(__file__), "results", "cache", "swap-addresses.json")
+SWAP_ADDRESSES_TTL = datetime.timedelta(days=7)
+
+# coingecko api client, shared so that its connections are reused
+COINGECKO_API = CoinGeckoAPI()
+
+# number of transactions downloaded at the same time when estimating prices from other transactions
+ESTIMATE_BATCH_SIZE = 10
+
+# store for retrieving previously found prices, shared between sessions
+PRICE_STORE = PriceStore()
 
-# dictionary for retrieving previously found prices in token ticker:datetime:price format
-# TODO: save prices based on hash rather than name
-PREVIOUS_PRICES = dict()
+# swap price oracle for each chain, built from the exported transactions on first use by swap_price_oracle
+SWAP_PRICE_ORACLES = dict()
+# block index for each chain, see block_index
+BLOCK_INDEXES = dict()
+# how long before a transaction other transactions are looked at to estimate a price
+ESTIMATE_WINDOW = datetime.timedelta(days=1)
+
+# how far from a transaction a stored coingecko price can be and still be used for it
+COINGECKO_PRICE_TOLERANCE = datetime.timedelta(hours=1)
+# longest period that coingecko gives hourly prices for
+COINGECKO_PREFETCH_WINDOW = datetime.timedelta(days=89)
+
+# file the coingecko coin list is saved to, and how long it is used for before downloading it again
+COINGECKO_COINS_CACHE = os.path.join(os.path.dirname(__file__), "results", "cache", "coingecko-coins.json")
+COINGECKO_COINS_TTL = datetime.timedelta(days=7)
 
 
 def create_coingecko_id_lookup():
     """
     Create a dictionary that links token tickers to coingecko IDs.
-    :return: lookup, that dictionary
+    :return: lookup, that dictionary, and id_list, a list of all coingecko IDs
     """
     # TODO: save all coin names that match a ticker, and allow user to choose if there is more than 1
-    cg = CoinGeckoAPI()
-    coin_list = cg.get_coins_list()
+    wait_for_rate_limit('api.coingecko.com')
+    coin_list = COINGECKO_API.get_coins_list()
     lookup = {}
     id_list = []
     for coin in coin_list:
-        if coin['symbol'] not in lookup.keys():
+        if coin['symbol'].lower() not in lookup.keys():
             lookup[coin['symbol'].lower()] = [coin['id']]
         else:
             lookup[coin['symbol'].lower()].append(coin['id'])
         id_list.append(coin['id'])
     # I don't know why this isn't in there
-    lookup['bnb'].append('binancecoin')
+    lookup.setdefault('bnb', []).append('binancecoin')
     # get rid of the SLP ones so it doesn't confuse sushiswap LPs with SLP the token
-    del lookup['slp']
+    lookup.pop('slp', None)
     return lookup, id_list
 
 
-# create coingecko lookup table
-COINGECKOID_LOOKUP, COINGECKOID_LIST = create_coingecko_id_lookup()
+def load_coingecko_id_lookup():
+    """
+    Get the ticker to coingecko ID lookup from the cache file, downloading the coin list again if the cache is older
+    than COINGECKO_COINS_TTL. A stale cache is still used if coingecko can't be reached.
+    :return: lookup, a dictionary of ticker: list of IDs, and id_set, a set of all coingecko IDs
+    """
+    cache = None
+    if os.path.exists(COINGECKO_COINS_CACHE):
+        with open(COINGECKO_COINS_CACHE) as cache_file:
+            cache = json.load(cache_file)
+
+    if cache is None or datetime.datetime.now().timestamp() - cache['fetched'] > COINGECKO_COINS_TTL.total_seconds():
+        try:
+            lookup, id_list = create_coingecko_id_lookup()
+        except (requests.exceptions.RequestException, ValueError) as error:
+            if cache is None:
+                raise error
+            print(f"Could not update the coingecko coin list ({error}), using the list saved on {datetime.datetime.fromtimestamp(cache['fetched'])}.")
+        else:
+            cache = {'fetched': datetime.datetime.now().timestamp(), 'lookup': lookup, 'ids': id_list}
+            os.makedirs(os.path.dirname(COINGECKO_COINS_CACHE), exist_ok=True)
+            with open(COINGECKO_COINS_CACHE, 'w') as cache_file:
+                json.dump(cache, cache_file)
+
+    return cache['lookup'], set(cache['ids'])
+
+
+def coingecko_id_lookup():
+    """
+    Return the dictionary linking token tickers to coingecko IDs, loading it the first time it is needed.
+    """
+    global COINGECKOID_LOOKUP, COINGECKOID_LIST
+    if COINGECKOID_LOOKUP is None:
+        COINGECKOID_LOOKUP, COINGECKOID_LIST = load_coingecko_id_lookup()
+    return COINGECKOID_LOOKUP
+
+
+def coingecko_ids():
+    """
+    Return the set of all coingecko IDs, loading it the first time it is needed.
+    """
+    coingecko_id_lookup()
+    return COINGECKOID_LIST
+
+
+# coingecko lookup tables, loaded on first use by coingecko_id_lookup and coingecko_ids
+COINGECKOID_LOOKUP = None
+COINGECKOID_LIST = None
 # create a dict of user selected coingeckoIDs, it is ticker: id
 COINGECKOID_USER_SELECTIONS = dict()
 
@@ -88,6 +193,8 @@ class Transaction:
     """
     Contains the information about a single transaction (buy, sell or both).
     """
+    # there can be hundreds of thousands of these, so they don't each have a __dict__
+    __slots__ = ('time', 'transaction_type', 'token', 'volume', 'fee', 'token_price', 'token_fee_adjusted_price')
 
     def __init__(self, time, transaction_type, token, volume, fee, token_price, token_fee_adjusted_price):
         self.time = time  # datetime objet
@@ -101,11 +208,24 @@ class Transaction:
         self.token_price = token_price
         self.token_fee_adjusted_price = token_fee_adjusted_price
 
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __getstate__(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __setstate__(self, state):
+        # sessions saved before __slots__ was used pickled the instance __dict__
+        if isinstance(state, dict):
+            state = tuple(state[name] for name in self.__slots__)
+        for name, value in zip(self.__slots__, state):
+            setattr(self, name, value)
+
     def __str__(self):
-        return str(vars(self))
+        return str(self.as_dict())
 
     def __repr__(self):
-        return str(vars(self))
+        return str(self.as_dict())
 
     def __lt__(self, other):
         return self.time < other.time
@@ -162,7 +282,7 @@ def correct_transaction_classification(class_guess):
     print("Classification choices: ")
     for i in range(1, len(CLASSIFICATIONS) + 1):
         print(f"{i}. {CLASSIFICATIONS[i]}")
-    class_correct = input(f"This looks like {class_guess}, is it? (y/N): ")
+    class_correct = ask(f"This looks like {class_guess}, is it? (y/N): ", yes_no(rule('accept_classification_guesses')))
     if class_correct.lower() != 'y':
         class_int = get_user_input("Which is the correct classification number? (#) ", 'int')
     else:
@@ -193,78 +313,59 @@ def printProgressBar (iteration, total, prefix='', suffix='', decimals=1, length
         print()
 
 
-def store_token_price(token, token_hash, time, price):
-    if token.lower() == 'cake-lp' or token.lower() == 'slp' or token.lower() == 'wlp':
-        if token.lower() in PREVIOUS_PRICES.keys():
-            PREVIOUS_PRICES[(token, token_hash)][time] = price
-        else:
-            PREVIOUS_PRICES[(token, token_hash)] = {time: price}
-    else:
-        if token.lower() in PREVIOUS_PRICES.keys():
-            PREVIOUS_PRICES[token][time] = price
-        else:
-            PREVIOUS_PRICES[token] = {time: price}
-
-
-def retrieve_token_price(token, token_hash, time, verbose=True):
-    prices = []
-    if token.lower() == 'cake-lp' or token.lower() == 'slp' or token.lower() == 'wlp':
-        if (token, token_hash) in PREVIOUS_PRICES.keys():
-            for prev_time in PREVIOUS_PRICES[(token, token_hash)].keys():
-                if time-datetime.timedelta(hours=24) <= prev_time <= time+datetime.timedelta(hours=24):
-                    prices.append((abs(time-prev_time), prev_time))
-            if len(prices) == 0:
-                return None
-            else:
-                (_, closest_time) = min(prices)
-            if verbose:
-                print(f"We previously found that the price per token for {token}({token_hash}) at {closest_time} was {PREVIOUS_PRICES[(token, token_hash)][closest_time]}.")
-                assume = input(f"Would you like to assume the price at {time} was the same? (Y/n) ")
-                if assume.lower() == 'n':
-                    return None
-            return PREVIOUS_PRICES[(token, token_hash)][prev_time]
-        return None
-    else:
-        if token in PREVIOUS_PRICES.keys():
-            for prev_time in PREVIOUS_PRICES[token].keys():
-                if time-datetime.timedelta(hours=24) <= prev_time <= time+datetime.timedelta(hours=24):
-                    prices.append((abs(time-prev_time), prev_time))
-            if len(prices) == 0:
-                return None
-            else:
-                (_, closest_time) = min(prices)
-            if verbose:
-                print(f"We previously found that the price per token for {token} at {closest_time} was {PREVIOUS_PRICES[token][closest_time]}.")
-                assume = input(f"Would you like to assume the price at {time} was the same? (Y/n) ")
-                if assume.lower() == 'n':
-                    return None
-            return PREVIOUS_PRICES[token][prev_time]
+def store_token_price(token, token_hash, time, price, currency='aud'):
+    PRICE_STORE.store(price_key(token, token_hash), currency, time, price)
+
+
+def save_progress(journal, transaction_hash):
+    """
+    Save the transactions added while processing transaction_hash to the session journal.
+    :param journal: SessionJournal for this session
+    :param transaction_hash: hash of the transaction that has just been processed
+    """
+    journal.record(transaction_hash)
+    print(f"Progress saved to {journal.filename}")
+
+
+def retrieve_token_price(token, token_hash, time, verbose=True, currency='aud'):
+    previous = PRICE_STORE.nearest(price_key(token, token_hash), currency, time)
+    if previous is None:
         return None
+    closest_time, price = previous
+    if verbose:
+        if token.lower() in LP_TOKENS:
+            print(f"We previously found that the price per token for {token}({token_hash}) at {closest_time} was {price}.")
+        else:
+            print(f"We previously found that the price per token for {token} at {closest_time} was {price}.")
+        assume = ask(f"Would you like to assume the price at {time} was the same? (Y/n) ", 'y')
+        if assume.lower() == 'n':
+            return None
+    return price
 
 
 def select_cgid_from_lookup(token):
-    if token.lower() in COINGECKOID_LOOKUP.keys():
-        if len(COINGECKOID_LOOKUP[token.lower()]) == 1:
-            token_id = COINGECKOID_LOOKUP[token.lower()][0]
-            correct_token_id = input(f"\rIs {token_id} the correct token ID for {token.lower()}? (Y/n) ")
+    if token.lower() in coingecko_id_lookup().keys():
+        if len(coingecko_id_lookup()[token.lower()]) == 1:
+            token_id = coingecko_id_lookup()[token.lower()][0]
+            correct_token_id = ask(f"\rIs {token_id} the correct token ID for {token.lower()}? (Y/n) ", 'y')
             if correct_token_id.lower() == 'n':
-                token_id = input(f"\rWhat is the correct coingecko token ID? (Search token in cg and use coin name in URL) ")
+                token_id = ask(f"\rWhat is the correct coingecko token ID? (Search token in cg and use coin name in URL) ")
             COINGECKOID_USER_SELECTIONS[token.lower()] = token_id
-            again = input("Do you want to be asked this again for this ticker? (Y/n) ")
+            again = ask("Do you want to be asked this again for this ticker? (Y/n) ", 'n')
             if again.lower() == 'n':
                 TICKERS_NO_CONFIRM.append(token.lower())
         else:
             print("Possible coingecko IDs:")
-            for ind, id in enumerate(COINGECKOID_LOOKUP[token.lower()]):
+            for ind, id in enumerate(coingecko_id_lookup()[token.lower()]):
                 print(f"{ind + 1}. {id}")
             print(f"{ind + 2}. None of the above")
             correct_id = get_user_input("Which is the correct coingecko ID? (#) ", 'int')
             if correct_id >= ind + 2 or correct_id <= 0:
                 token_id = None
             else:
-                token_id = COINGECKOID_LOOKUP[token.lower()][correct_id - 1]
+                token_id = coingecko_id_lookup()[token.lower()][correct_id - 1]
                 COINGECKOID_USER_SELECTIONS[token.lower()] = token_id
-                again = input("Do you want to be asked this again for this ticker? (Y/n) ")
+                again = ask("Do you want to be asked this again for this ticker? (Y/n) ", 'n')
                 if again.lower() == 'n':
                     TICKERS_NO_CONFIRM.append(token.lower())
     else:
@@ -279,11 +380,11 @@ def select_coingecko_id(token):
     else:
         if token.lower() in COINGECKOID_USER_SELECTIONS.keys():
             token_id = COINGECKOID_USER_SELECTIONS[token.lower()]
-            correct_token_id = input(f"\rIs {token_id} the correct token ID for {token.lower()}? (Y/n) ")
+            correct_token_id = ask(f"\rIs {token_id} the correct token ID for {token.lower()}? (Y/n) ", 'y')
             if correct_token_id.lower() == 'n':
                 token_id = select_cgid_from_lookup(token)
             else:
-                again = input("Do you want to be asked this again for this ticker? (Y/n) ")
+                again = ask("Do you want to be asked this again for this ticker? (Y/n) ", 'n')
                 if again.lower() == 'n':
                     TICKERS_NO_CONFIRM.append(token.lower())
         else:
@@ -291,6 +392,82 @@ def select_coingecko_id(token):
     return token_id
 
 
+def coingecko_price_key(token_id):
+    return f"coingecko:{token_id}"
+
+
+def get_coingecko_price_range(token_id, currency, from_timestamp, to_timestamp):
+    """
+    Get all coingecko prices for a token between two unix times and save them in the price store. Coingecko gives
+    5-minutely prices for ranges up to a day, hourly prices for ranges up to 90 days and daily prices for longer ranges.
+    :return: list of (unix time, price) pairs
+    """
+    # query the coingecko api here and extract the relevant data
+    for i in range(10):
+        try:
+            wait_for_rate_limit('api.coingecko.com')
+            result = COINGECKO_API.get_coin_market_chart_range_by_id(
+                id=token_id,
+                vs_currency=currency,
+                from_timestamp=from_timestamp,
+                to_timestamp=to_timestamp
+            )
+            break
+        except requests.exceptions.HTTPError as error:
+            if i == 9:
+                raise error
+            print("Coingecko API Request error, likely due to too many requests in a short time period.")
+            print("Waiting 1 minute to try again...")
+            sleep(60)
+
+    # coingecko times are in milliseconds
+    prices = [(time / 1000, price) for time, price in result['prices']]
+    PRICE_STORE.store_many(coingecko_price_key(token_id), currency, prices)
+    return prices
+
+
+def prefetch_coingecko_prices(token_times, currency='aud'):
+    """
+    Fetch hourly coingecko prices covering the whole period each token was traded in, so that pricing transactions
+    later does not need a request per transaction. Only tokens whose coingecko ID is already known (chosen by the user or
+    the only ID for that ticker) are fetched, so nothing is asked of the user here.
+    :param token_times: dictionary mapping token tickers to (earliest time, latest time) tuples
+    :param currency: a string, the currency used (usually 'aud')
+    """
+    for token, (first_time, last_time) in token_times.items():
+        if type(token) is not str or token.lower() == currency.lower():
+            continue
+        if token.lower() in COINGECKOID_USER_SELECTIONS.keys():
+            token_id = COINGECKOID_USER_SELECTIONS[token.lower()]
+        elif len(coingecko_id_lookup().get(token.lower(), [])) == 1:
+            token_id = coingecko_id_lookup()[token.lower()][0]
+        else:
+            continue
+
+        # split the period into windows that coingecko still gives hourly prices for
+        window_start = first_time - datetime.timedelta(hours=12)
+        period_end = last_time + datetime.timedelta(hours=12)
+        while window_start < period_end:
+            window_end = min(window_start + COINGECKO_PREFETCH_WINDOW, period_end)
+            # skip windows that have already been fetched
+            if not all(PRICE_STORE.nearest(coingecko_price_key(token_id), currency, time, COINGECKO_PRICE_TOLERANCE)
+                       for time in (window_start, window_start + (window_end - window_start) / 2, window_end)):
+                print(f"Prefetching {token_id} prices from {window_start} to {window_end}...")
+                get_coingecko_price_range(token_id, currency, to_epoch(window_start), to_epoch(window_end))
+            window_start = window_end
+
+
+def prefetch_coingecko_prices_from_frame(df, token_column, time_column, currency='aud'):
+    """
+    Prefetch coingecko prices for all the tokens in a column of a dataframe of transactions, see
+    prefetch_coingecko_prices.
+    """
+    if len(df.index) == 0:
+        return
+    time_ranges = df.groupby(token_column)[time_column].agg(['min', 'max'])
+    prefetch_coingecko_prices({token: (row['min'], row['max']) for token, row in time_ranges.iterrows()}, currency)
+
+
 def get_token_price(token, token_contract_address, transaction_time, chain, original_transaction_hash, original_moves, currency='aud'):
     """
     Get the price of a token, using either the coingecko API or if that's not available, an average of recent
@@ -311,19 +488,20 @@ def get_token_price(token, token_contract_address, transaction_time, chain, orig
     # convert the time to unix time
     epoch_time = int(transaction_time.timestamp())
 
-    while (token_id not in COINGECKOID_LIST) and (use_coingecko.lower() != 'n') and (token.lower() not in NOCOINGECKO_NO_CONFIRM):
+    while (token_id not in coingecko_ids()) and (use_coingecko.lower() != 'n') and (token.lower() not in NOCOINGECKO_NO_CONFIRM):
         # check whether coingecko lookup or manual calculation should be used for price
         if (token.lower() not in COINGECKO_NO_CONFIRM) and (token.lower() not in NOCOINGECKO_NO_CONFIRM):
-            use_coingecko = input(f"\rWould you like to use CoinGecko to determine {token}'s price? "
-                                  f"If not, manual on-chain price calculation will be used, which takes longer. (Y/n) ")
+            use_coingecko = ask(f"\rWould you like to use CoinGecko to determine {token}'s price? "
+                                f"If not, manual on-chain price calculation will be used, which takes longer. (Y/n) ",
+                                yes_no(token.lower() in coingecko_id_lookup().keys()))
             if use_coingecko.lower() != 'n':
                 # check if we should assume coingecko should be used in the future
-                again = input("Do you want to be asked this again for this ticker? (Y/n) ")
+                again = ask("Do you want to be asked this again for this ticker? (Y/n) ", 'n')
                 if again.lower() == 'n':
                     COINGECKO_NO_CONFIRM.append(token.lower())
             else:
                 # check if we should assume coingecko should not be used in the future
-                again = input("Do you want to be asked this again for this ticker? (Y/n) ")
+                again = ask("Do you want to be asked this again for this ticker? (Y/n) ", 'n')
                 if again.lower() == 'n':
                     NOCOINGECKO_NO_CONFIRM.append(token.lower())
                 break
@@ -331,7 +509,7 @@ def get_token_price(token, token_contract_address, transaction_time, chain, orig
         if (use_coingecko.lower() != 'n') and (token.lower() not in NOCOINGECKO_NO_CONFIRM):
             token_id = select_coingecko_id(token)
 
-            if token_id not in COINGECKOID_LIST:
+            if token_id not in coingecko_ids():
                 print(f'Token ID {token_id} is not a valid coingecko ID. Enter a different token ID or opt to use manual on-chain price calculation.')
                 if token.lower() in COINGECKO_NO_CONFIRM:
                     COINGECKO_NO_CONFIRM.remove(token.lower())
@@ -341,46 +519,47 @@ def get_token_price(token, token_contract_address, transaction_time, chain, orig
                     NOCOINGECKO_NO_CONFIRM.remove(token.lower())
 
     # if checks have passed, use coingecko to find price
-    if (use_coingecko.lower() != 'n') and (token.lower() not in NOCOINGECKO_NO_CONFIRM) and (token_id in COINGECKOID_LIST):
-        twelve_hours = 12 * 60 * 60
-        # query the api +- 12 hours around the time of transaction, then find the closest time
-        from_timestamp = epoch_time - twelve_hours
-        to_timestamp = epoch_time + twelve_hours
-
-        # query the coingecko api here and extract the relevant data
-        cg = CoinGeckoAPI()
-        for i in range(10):
-            try:
-                result = cg.get_coin_market_chart_range_by_id(
-                    id=token_id,
-                    vs_currency=currency,
-                    from_timestamp=from_timestamp,
-                    to_timestamp=to_timestamp
-                )
-                break
-            except requests.exceptions.HTTPError as error:
-                if i == 9:
-                    raise error
-                print("Coingecko API Request error, likely due to too many requests in a short time period.")
-                print("Waiting 1 minute to try again...")
-                sleep(60)
-
-        # find the closest time to the time of transaction
-        token_price = None  # just in case the is an error
-        min_time_difference = float('inf')
-        for time, price in result['prices']:
-            time_difference = abs(epoch_time - time)
-            if time_difference < min_time_difference:
-                min_time_difference = time_difference
-                token_price = price
-
-        store_token_price(token, token_contract_address, transaction_time, token_price)
+    if (use_coingecko.lower() != 'n') and (token.lower() not in NOCOINGECKO_NO_CONFIRM) and (token_id in coingecko_ids()):
+        # use a price prefetched or found earlier if there is one close enough to the time of the transaction
+        previous = PRICE_STORE.nearest(coingecko_price_key(token_id), currency, transaction_time, COINGECKO_PRICE_TOLERANCE)
+        if previous is not None:
+            _, token_price = previous
+        else:
+            twelve_hours = 12 * 60 * 60
+            # query the api +- 12 hours around the time of transaction, then find the closest time
+            from_timestamp = epoch_time - twelve_hours
+            to_timestamp = epoch_time + twelve_hours
+            prices = get_coingecko_price_range(token_id, currency, from_timestamp, to_timestamp)
+
+            # find the closest time to the time of transaction
+            token_price = None  # just in case the is an error
+            min_time_difference = float('inf')
+            for time, price in prices:
+                time_difference = abs(epoch_time - time)
+                if time_difference < min_time_difference:
+                    min_time_difference = time_difference
+                    token_price = price
+
+        store_token_price(token, token_contract_address, transaction_time, token_price, currency)
         return token_price
 
-    previous_price = retrieve_token_price(token, token_contract_address, transaction_time)
+    previous_price = retrieve_token_price(token, token_contract_address, transaction_time, currency=currency)
     if previous_price:
         return previous_price
 
+    # try the swaps of this token in the exported transactions before anything that needs requests
+    oracle_estimate = None
+    if token_contract_address is not None and chain in NATIVE_TOKEN:
+        oracle_estimate = swap_price_oracle(chain).estimate(token_contract_address, transaction_time,
+                                                            lambda ticker, contract, time: known_token_price(ticker, contract, time, currency))
+    if oracle_estimate:
+        price_estimate, swap_count = oracle_estimate
+        print(f"Estimated price per token of {token} from {swap_count} swaps in the exported transactions is {price_estimate} {currency.upper()}.")
+        use_price = ask(f"Are you confident this is the correct price? (Y/n) ", yes_no(rule('accept_estimated_prices')))
+        if use_price.lower() != "n":
+            store_token_price(token, token_contract_address, transaction_time, price_estimate, currency)
+            return price_estimate
+
     # else use manual price method
     print(f"Estimating price for {token} from other tokens in transaction...")
     price_estimate = get_estimated_price_from_transaction(original_transaction_hash, token, token_contract_address, chain, original_moves, transaction_time, currency)
@@ -388,46 +567,32 @@ def get_token_price(token, token_contract_address, transaction_time, chain, orig
         print(f"Could not estimate price from other tokens, trying other methods...")
     else:
         print(f"Estimated price per token of {token} is {price_estimate} {currency.upper()}.")
-        use_price = input(f"Are you confident this is the correct price? "
-                          f"If not, further price estimation will be used and you can manually enter a price if they are not successful. (Y/n) ")
+        use_price = ask(f"Are you confident this is the correct price? "
+                        f"If not, further price estimation will be used and you can manually enter a price if they are not successful. (Y/n) ",
+                        yes_no(rule('accept_estimated_prices')))
         if use_price.lower() != "n":
-            store_token_price(token, token_contract_address, transaction_time, price_estimate)
+            store_token_price(token, token_contract_address, transaction_time, price_estimate, currency)
             return price_estimate
 
     price_estimates = []
     print(f"Estimating price for {token} from other transactions...")
-    method1 = input(f"Would you like to try method 1? (y/N) ")
+    method1 = ask(f"Would you like to try method 1? (y/N) ", 'n')
     if method1.lower() == 'y':
-        api_domains = {'ethereum': 'api.etherscan.io', 'polygon': 'api.polygonscan.com', 'bsc': 'api.bscscan.com', 'fantom': 'api.ftmscan.com'}
-
-        # get latest block before provided time
+        # get the blocks at the start of the window before the provided time and at the time
         api_key = get_api_keys()[chain]
-        block = int(requests.get(f"https://{api_domains[chain]}/api?module=block&action=getblocknobytime&timestamp={epoch_time}&closest=before&apikey={api_key}").json()['result'])
+        start_block = get_block_before(chain, epoch_time - int(ESTIMATE_WINDOW.total_seconds()))
+        block = get_block_after(chain, epoch_time)
 
-        # get transactions prior to block above
-        result = requests.get(f"https://{api_domains[chain]}/api?module=account&action=txlist&address={token_contract_address}&startblock=1&endblock={block}&sort=desc&apikey={api_key}").json()['result']
+        # get transactions in the window before the time, the end block can be a little after it
+        result = http_get(f"https://{SCAN_API_DOMAINS[chain]}/api?module=account&action=txlist&address={token_contract_address}&startblock={start_block}&endblock={block}&sort=desc&apikey={api_key}").json()['result']
+        result = [transaction for transaction in result if int(transaction['timeStamp']) <= epoch_time]
 
         # get transaction hashes for non-approval transactions
         transaction_hashes = [transaction['hash'] for transaction in result if transaction['input'][:10] != '0x095ea7b3']
 
-        # iterate through transaction hashes until 10 appropriate transactions are found and add values to lists
-        price_estimates = []
-        printProgressBar(0, 10, prefix='Price estimates found:', suffix='Complete', length=10)
-        progress = 0
-        for ind, transaction_hash in enumerate(transaction_hashes):
-            # break once you have 10 transactions
-            if len(price_estimates) >= 10:
-                break
-
-            # get price from transaction
-            price_estimate = get_estimated_price_from_transaction(transaction_hash, token, token_contract_address, chain, None, None, currency)
+        # go through transaction hashes until 10 appropriate transactions are found
+        price_estimates = estimate_prices_from_transactions(transaction_hashes, token, token_contract_address, chain, currency)
 
-            if price_estimate:
-                price_estimates.append(price_estimate)
-                progress += 1
-                printProgressBar(progress, 10, prefix='Price estimates found:', suffix='Complete', length=10)
-
-        print("")
         if len(price_estimates) >= 10:
             # get average of middle 6 price estimates
             price_estimates.sort()
@@ -435,27 +600,34 @@ def get_token_price(token, token_contract_address, transaction_time, chain, orig
             average_price = sum(price_estimates[2:8]) / 6
             print(f"Estimated price is {average_price}")
             token_price = average_price
-            store_token_price(token, token_contract_address, transaction_time, token_price)
+            store_token_price(token, token_contract_address, transaction_time, token_price, currency)
             return token_price
 
-    method2 = input(f"Would you like to try method 2? (y/N) ")
+    method2 = ask(f"Would you like to try method 2? (y/N) ", 'n')
     if method2.lower() == 'y':
+        # get the blocks at the start of the window before the provided time and at the time
+        api_key = get_api_keys()[chain]
+        start_block = get_block_before(chain, epoch_time - int(ESTIMATE_WINDOW.total_seconds()))
+        block = get_block_after(chain, epoch_time)
+
         # look at recent (current day) transactions to find the addresses most commonly involved in swaps of that token
         swap_addresses = find_common_swap_addresses(token, token_contract_address, chain, currency)
         print(swap_addresses)
 
         for page in range(1, 11):
             if page > 1:
-                keep_looking = input(f"Only {len(price_estimates)}/10 price estimates found so far, continue looking? If not you can manually enter the price. (Y/n) ")
+                keep_looking = ask(f"Only {len(price_estimates)}/10 price estimates found so far, continue looking? If not you can manually enter the price. (Y/n) ", 'n')
                 if keep_looking.lower() == 'n':
                     break
-            for swap_address in swap_addresses:
-                # get transactions prior to block above for each of the swap addresses
-                # TODO: try tokentx
-                result = \
-                requests.get(f"https://{api_domains[chain]}/api?module=account&action=txlist&address={swap_address}&startblock=1&endblock={block}&page={page}&offset=10000&sort=desc&apikey={api_key}").json()[
-                    'result']
-
+            # get transactions prior to block above for each of the swap addresses at the same time
+            # TODO: try tokentx
+            results = fetch_all(lambda url: http_get(url).json()['result'],
+                                [(f"https://{SCAN_API_DOMAINS[chain]}/api?module=account&action=txlist&address={swap_address}&startblock={start_block}&endblock={block}&page={page}&offset=10000&sort=desc&apikey={api_key}",)
+                                 for swap_address in swap_addresses])
+
+            for result in results:
+                # the end block can be a little after the time
+                result = [transaction for transaction in result or [] if int(transaction['timeStamp']) <= epoch_time]
                 if not result:
                     continue
 
@@ -471,24 +643,8 @@ def get_token_price(token, token_contract_address, transaction_time, chain, orig
                 if len(transaction_hashes) == 0:
                     continue
 
-                # iterate through transaction hashes until 10 appropriate transactions are found and add values to lists
-                price_estimates = []
-                printProgressBar(0, 10, prefix='Price estimates found:', suffix='Complete', length=10)
-                progress = 0
-                for ind, transaction_hash in enumerate(transaction_hashes):
-                    # break once you have 10 transactions
-                    if len(price_estimates) >= 10:
-                        break
-
-                    # get price from transaction
-                    price_estimate = get_estimated_price_from_transaction(transaction_hash, token, token_contract_address, chain, None, None, currency)
-
-                    if price_estimate:
-                        price_estimates.append(price_estimate)
-                        progress += 1
-                        printProgressBar(progress, 10, prefix='Price estimates found:', suffix='Complete', length=10)
-
-                print("")
+                # go through transaction hashes until 10 appropriate transactions are found
+                price_estimates = estimate_prices_from_transactions(transaction_hashes, token, token_contract_address, chain, currency)
 
             if len(price_estimates) >= 10:
                 # get average of middle 10 price estimates
@@ -497,47 +653,163 @@ def get_token_price(token, token_contract_address, transaction_time, chain, orig
                 average_price = sum(price_estimates[2:8]) / 6
                 print(f"Estimated price is {average_price}")
                 token_price = average_price
-                store_token_price(token, token_contract_address, transaction_time, token_price)
+                store_token_price(token, token_contract_address, transaction_time, token_price, currency)
                 return token_price
 
     print('Could not find enough transactions to get an accurate price estimate...')
     if len(price_estimates) > 0:
         print(f"Price estimates found: {price_estimates}")
     token_price = get_user_input(f'Enter price per token at {transaction_time} in {currency} manually: ', 'float')
-    save_price = input(f"Would you like to save this price of {token_price} {currency} for {token}? (y/N) ")
+    save_price = ask(f"Would you like to save this price of {token_price} {currency} for {token}? (y/N) ", 'y')
     if save_price.lower() == 'y':
-        store_token_price(token, token_contract_address, transaction_time, token_price)
+        store_token_price(token, token_contract_address, transaction_time, token_price, currency)
     return token_price
 
 
-def get_estimated_price_from_transaction(transaction_hash, token, token_contract_address, chain, original_moves, original_time, currency='aud'):
+def known_token_price(token, token_contract_address, time, currency='aud'):
+    """
+    Get the price of a token from prices that have already been found, without asking anything or making requests.
+    :return: the price, or None if it isn't known
+    """
+    if type(token) is not str:
+        return None
+    if token.lower() == currency.lower():
+        return 1
+    if token.lower() in COINGECKOID_USER_SELECTIONS.keys():
+        token_id = COINGECKOID_USER_SELECTIONS[token.lower()]
+    elif len(coingecko_id_lookup().get(token.lower(), [])) == 1:
+        token_id = coingecko_id_lookup()[token.lower()][0]
+    else:
+        token_id = None
+    if token_id is not None:
+        previous = PRICE_STORE.nearest(coingecko_price_key(token_id), currency, time, COINGECKO_PRICE_TOLERANCE)
+        if previous is not None:
+            return previous[1]
+    return retrieve_token_price(token, token_contract_address, time, verbose=False, currency=currency)
+
+
+def swap_price_oracle(chain):
+    """
+    Get the swap price oracle for a chain, indexing the swaps in all of the chain's exported transactions the first
+    time it is needed.
+    """
+    if chain not in SWAP_PRICE_ORACLES:
+        print(f"Indexing swaps in the exported {chain} transactions...")
+        oracle = SwapPriceOracle()
+        files = glob.glob(os.path.join('transaction-files', chain, '**', '*.csv'), recursive=True)
+        for chunk in iter_transaction_chunks(read_onchain_chunks(files, None, None), 'tx_hash'):
+            signatures = chunk["log_events_decoded_signature"]
+            oracle.add_chunk(chunk[signatures == TRANSFER_SIGNATURE], chunk[signatures == SWAP_SIGNATURE])
+        oracle.finish()
+        SWAP_PRICE_ORACLES[chain] = oracle
+    return SWAP_PRICE_ORACLES[chain]
+
+
+def block_index(chain):
+    """
+    Get the block index of a chain, adding the blocks in all of the chain's exported transactions the first time it is
+    needed.
+    """
+    if chain not in BLOCK_INDEXES:
+        index = BlockIndex(chain)
+        files = glob.glob(os.path.join('transaction-files', chain, '**', '*.csv'), recursive=True)
+        points = [chunk[['block_signed_at', 'block_height']].drop_duplicates() for chunk in read_onchain_chunks(files, None, None)]
+        if points:
+            points = pd.concat(points, axis=0)
+            index.add_many(points['block_signed_at'].to_numpy().astype('datetime64[s]').astype(np.int64), points['block_height'].to_numpy(dtype=np.int64))
+        BLOCK_INDEXES[chain] = index
+    return BLOCK_INDEXES[chain]
+
+
+def get_block_before(chain, epoch_time):
+    """
+    Get the latest block on a chain before a unix time, from the block index if it has a block close enough before
+    the time, otherwise from the chain's api.
+    """
+    index = block_index(chain)
+    block = index.block_before(epoch_time)
+    if block is None:
+        api_key = get_api_keys()[chain]
+        block = int(http_get(f"https://{SCAN_API_DOMAINS[chain]}/api?module=block&action=getblocknobytime&timestamp={epoch_time}&closest=before&apikey={api_key}").json()['result'])
+        index.add_requested(epoch_time, block)
+    return block
+
+
+def get_block_after(chain, epoch_time):
+    """
+    Get the earliest block on a chain at or after a unix time, from the blocks in the exports if there is one close
+    enough after the time, otherwise from the chain's api.
+    """
+    index = block_index(chain)
+    block = index.block_after(epoch_time)
+    if block is None:
+        api_key = get_api_keys()[chain]
+        block = int(http_get(f"https://{SCAN_API_DOMAINS[chain]}/api?module=block&action=getblocknobytime&timestamp={epoch_time}&closest=after&apikey={api_key}").json()['result'])
+        # the block before it is the latest block before the time
+        index.add_requested(epoch_time, block - 1)
+    return block
+
+
+def estimate_prices_from_transactions(transaction_hashes, token, token_contract_address, chain, currency='aud', needed=10):
+    """
+    Estimate the price of a token from other transactions involving it, until enough estimates are found. The
+    transactions are downloaded in batches at the same time, then the price is estimated from each in turn.
+    :param transaction_hashes: hashes of the transactions to try, in the order to try them
+    :param needed: the number of price estimates to stop at
+    :return: a list of price estimates
+    """
+    price_estimates = []
+    printProgressBar(0, needed, prefix='Price estimates found:', suffix='Complete', length=10)
+    for batch_start in range(0, len(transaction_hashes), ESTIMATE_BATCH_SIZE):
+        # break once you have enough transactions
+        if len(price_estimates) >= needed:
+            break
+        batch = transaction_hashes[batch_start:batch_start + ESTIMATE_BATCH_SIZE]
+        transaction_dfs = fetch_all(get_transaction_by_hash, [(CHAIN_IDS[chain], transaction_hash) for transaction_hash in batch])
+        # internal transactions are only needed for transactions with token transfers
+        internal_transactions = dict()
+        for result in fetch_all(get_internal_transactions_by_hash, [(chain, transaction_hash) for transaction_hash, df in zip(batch, transaction_dfs)
+                                                                    if (df['log_events_decoded_signature'] == TRANSFER_SIGNATURE).any()]):
+            internal_transactions.update(result)
+
+        for transaction_hash, df in zip(batch, transaction_dfs):
+            if len(price_estimates) >= needed:
+                break
+
+            # get price from transaction
+            price_estimate = get_estimated_price_from_transaction(transaction_hash, token, token_contract_address, chain, None, None, currency,
+                                                                  df, internal_transactions)
+
+            if price_estimate:
+                price_estimates.append(price_estimate)
+                printProgressBar(len(price_estimates), needed, prefix='Price estimates found:', suffix='Complete', length=10)
+
+    print("")
+    return price_estimates
+
+
+def get_estimated_price_from_transaction(transaction_hash, token, token_contract_address, chain, original_moves, original_time, currency='aud',
+                                         df=None, internal_transactions=None):
     # if we have the original moves, no need to read in
     if not original_moves:
-        # read information about transaction into df
-        data_text = get_transaction_by_hash(CHAIN_IDS[chain], transaction_hash)
-        try:
-            df = pd.read_csv(StringIO(data_text), dtype=str)
-        except pd.errors.ParserError:
-            return None
+        # read information about transaction into df, unless it has already been downloaded
+        if df is None:
+            df = get_transaction_by_hash(CHAIN_IDS[chain], transaction_hash)
 
-        if (len(df.index) == 0) or 'log_events_decoded_signature' not in df.columns or 'log_events_decoded_signature' not in df.columns:
+        if len(df.index) == 0:
             return None
 
-        # parse times
-        df['block_signed_at'] = pd.to_datetime(df['block_signed_at'], format="%Y-%m-%dT%H:%M:%SZ")
-
-        # get token transfers associated with hash
-        transaction_df = df[(df['tx_hash'] == transaction_hash)
-                            & (df["log_events_decoded_signature"] == "Transfer(indexed address from, indexed address to, uint256 value)")]
-
-        if len(transaction_df.index) == 0:
+        # get token transfers and swaps associated with hash
+        transaction_groups = group_onchain_transactions(df)
+        if transaction_hash not in transaction_groups:
             return None
 
         # get wallet that triggered transaction
-        wallet = transaction_df['from_address'].iloc[0]
+        wallet = transaction_groups[transaction_hash]['transfers']['from_address'].iloc[0]
 
         # parse transactions into 'moves'
-        transaction_time, moves, gas_fee_fiat = parse_onchain_transactions(chain, wallet, transaction_df, transaction_hash, currency, True)
+        transaction_time, moves, gas_fee_fiat = parse_onchain_transactions(chain, wallet, transaction_groups[transaction_hash], transaction_hash, currency, True,
+                                                                           internal_transactions)
     else:
         moves = original_moves
         transaction_time = original_time
@@ -550,10 +822,9 @@ def get_estimated_price_from_transaction(transaction_hash, token, token_contract
     # all tokens are in coingeckoid_lookup, this prevents this code from looping
     # AND there is one incoming and one outgoing token, for simplicity
     # AND one of those tokens is the token in question
-    tmp = [(move['token'].lower() in COINGECKOID_LOOKUP.keys(), move['token'].lower() == token.lower(), retrieve_token_price(move['token'], move['token_contract'], transaction_time, verbose=False)) for move in moves]
-    if (not all([(move['token'].lower() in COINGECKOID_LOOKUP.keys()
+    if (not all([(move['token'].lower() in coingecko_id_lookup().keys()
                   or move['token'].lower() == token.lower())
-                  or retrieve_token_price(move['token'], move['token_contract'], transaction_time, verbose=False)
+                  or retrieve_token_price(move['token'], move['token_contract'], transaction_time, verbose=False, currency=currency)
                  for move in moves])
             or not any([move['token'].lower() == token.lower() for move in moves])):
         return None
@@ -567,65 +838,47 @@ def get_estimated_price_from_transaction(transaction_hash, token, token_contract
 
 
 def find_common_swap_addresses(token, token_address, chain, currency):
-
-    if token.lower() in SWAP_ADDRESSES.keys():
-        return SWAP_ADDRESSES[token.lower()]
-
-    # read information about transaction into df
-    data_text = get_transactions_by_address(CHAIN_IDS[chain], token_address, page_size=2500)
-
-    if not data_text:
-        return []
-
-    df = pd.read_csv(StringIO(data_text), dtype=str)
-
-    if len(df.index) == 0 or 'log_events_decoded_signature' not in df.columns:
-        return []
-
-    # parse times
-    df['block_signed_at'] = pd.to_datetime(df['block_signed_at'], format="%Y-%m-%dT%H:%M:%SZ")
-
-    # get token transfers only
-    transaction_df = df[(df["log_events_decoded_signature"] == "Transfer(indexed address from, indexed address to, uint256 value)")]
-
-    # get only transactions that actually involve the token
-    sub_df = transaction_df[(transaction_df["log_events_sender_address"].str.lower() == token_address.lower())]
-
-    # get transactions for which the token is either going to or coming from the invoker
-    sub_df = sub_df[(sub_df["from_address"].str.lower() == sub_df["log_events_decoded_params_value"].str.lower())]
-
-    if len(transaction_df.index) == 0:
-        return []
-
-    # get unique transaction hashes from sub_df
-    transaction_hashes = sub_df['tx_hash'].unique()
-
-    swap_addresses = []
-
+    """
+    Find the addresses most commonly involved in swaps of a token: the wallets making the swaps and the contracts
+    (eg. routers) they send them to, from the token's latest transactions. Results are saved per chain and token
+    contract, and found again once they are older than SWAP_ADDRESSES_TTL.
+    :return: list of addresses
+    """
+    key = f"{chain}:{token_address.lower()}"
+    if key not in SWAP_ADDRESSES and os.path.exists(SWAP_ADDRESSES_CACHE):
+        with open(SWAP_ADDRESSES_CACHE) as cache_file:
+            SWAP_ADDRESSES.update(json.load(cache_file))
+    if key in SWAP_ADDRESSES and datetime.datetime.now().timestamp() - SWAP_ADDRESSES[key]['fetched'] <= SWAP_ADDRESSES_TTL.total_seconds():
+        return SWAP_ADDRESSES[key]['addresses']
+
+    # read information about the latest transactions into df
     print("Finding swap addresses...")
-    for ind, transaction_hash in enumerate(transaction_hashes):
-        if len(swap_addresses) > 100:
-            break
-        if ind % 10 == 0:
-            print(f"{ind}/{min(100, len(transaction_hashes))}")
+    df = get_transactions_by_address(CHAIN_IDS[chain], token_address, page_size=2500, max_pages=1)
 
-        # get wallet that triggered transaction
-        wallet = transaction_df[transaction_df['tx_hash'] == transaction_hash]['from_address'].iloc[0]
+    top = []
+    if len(df.index) > 0:
+        # the wallet that made each transaction, and the contract it was sent to
+        invokers = df.groupby('tx_hash', sort=False)['from_address'].first().str.lower()
+        contracts = df.groupby('tx_hash', sort=False)['to_address'].first().str.lower()
 
-        # parse transactions into 'moves'
-        transaction_time, moves, gas_fee_fiat = parse_onchain_transactions(chain, wallet, transaction_df, transaction_hash, currency, True)
+        legs = transfer_legs(df[df["log_events_decoded_signature"] == TRANSFER_SIGNATURE])
+        legs['invoker'] = legs['tx_hash'].map(invokers)
+        sends = legs['tx_hash'][legs['from'] == legs['invoker']].unique()
+        receives = legs['tx_hash'][legs['to'] == legs['invoker']].unique()
+        has_swap = df['tx_hash'][df["log_events_decoded_signature"] == SWAP_SIGNATURE].unique()
 
-        # only use transactions that have at least one token going in and one token going out
-        if (len([move for move in moves if move['direction'] == 'in']) > 0) and len([move for move in moves if move['direction'] == 'out']) > 0:
-            # get the associated addresses
-            swap_addresses.append(wallet)
-            swap_addresses.append(transaction_df[transaction_df['tx_hash'] == transaction_hash]['to_address'].iloc[0])
+        # transactions where the invoker sent or received the token, and which swapped it for something else
+        token_legs = legs[(legs['token'] == token_address.lower()) & ((legs['from'] == legs['invoker']) | (legs['to'] == legs['invoker']))]
+        swap_hashes = pd.Index(token_legs['tx_hash'].unique())
+        swap_hashes = swap_hashes[swap_hashes.isin(has_swap) | (swap_hashes.isin(sends) & swap_hashes.isin(receives))]
 
-    counter = Counter(swap_addresses)
+        counts = pd.concat([invokers[swap_hashes], contracts[swap_hashes]]).value_counts()
+        top = counts.index[counts >= 3].tolist()
 
-    top = set([address for address in swap_addresses if counter[address] >= 3])
-
-    SWAP_ADDRESSES[token.lower()] = top
+    SWAP_ADDRESSES[key] = {'fetched': datetime.datetime.now().timestamp(), 'addresses': top}
+    os.makedirs(os.path.dirname(SWAP_ADDRESSES_CACHE), exist_ok=True)
+    with open(SWAP_ADDRESSES_CACHE, 'w') as cache_file:
+        json.dump(SWAP_ADDRESSES, cache_file)
 
     return top
 
@@ -744,10 +997,10 @@ def add_transactions_w_opposite(transaction_bank, self_moves, self_values, self_
             print(f"WARNING: expected price for {move['token']} considering other tokens is {raw_price_1token} while price calculated from coingecko or manual methods was {previously_calced_price}."
                   f"\n{raw_price_1token} will be used as the cost base if you continue, and this may be incorrect."
                   f"\nYou may want to end this program, restart from last save and edit the transaction.")
-            _ = input("(Press enter to continue) ")
+            _ = ask("(Press enter to continue) ", '')
 
         print(temp_transaction)
-        _ = input('Adding above transaction... (Press enter to continue)')
+        _ = ask('Adding above transaction... (Press enter to continue)', '')
         if move['token'].lower() == 'cake-lp' or move['token'].lower() == 'slp' or move['token'].lower() == 'wlp':
             if move['token'] in transaction_bank:
                 transaction_bank[(move['token'], move['token_contract'])].append(temp_transaction)
@@ -781,9 +1034,9 @@ def add_transactions_no_opposite(transaction_bank, self_moves, self_count, self_
         price_inc_fee_1token = (value * taxable_prop + (gas_fee_fiat / self_count)) / (move['quantity'] * taxable_prop)
         temp_transaction = Transaction(transaction_time, transaction_type, move['token'], move['quantity'] * taxable_prop, gas_fee_fiat / self_count, raw_price_1token,
                                        price_inc_fee_1token)
-        print(vars(temp_transaction))
+        print(temp_transaction)
         if not silent_income:
-            _ = input('Adding above transaction... (Press enter to continue)')
+            _ = ask('Adding above transaction... (Press enter to continue)', '')
         if move['token'].lower() == 'cake-lp' or move['token'].lower() == 'slp' or move['token'].lower() == 'wlp':
             if move['token'] in transaction_bank:
                 transaction_bank[(move['token'], move['token_contract'])].append(temp_transaction)
@@ -796,17 +1049,34 @@ def add_transactions_no_opposite(transaction_bank, self_moves, self_count, self_
                 transaction_bank[move['token']] = [temp_transaction]
 
 
-def classify_transaction(temp_moves, currency):
+def classification_number(classification):
+    """Convert a classification name or number (eg. from a rules file) into its number in CLASSIFICATIONS."""
+    for class_int, name in CLASSIFICATIONS.items():
+        if str(classification).lower() in [str(class_int), name.lower()]:
+            return class_int
+    raise ValueError(f"{classification} is not a valid classification, choose one of {list(CLASSIFICATIONS.values())}")
+
+
+def classify_transaction(temp_moves, currency, source=None, contract=None, events=()):
     """
     Get input from user to classify transaction type, allowing tax rules to be applied correctly
     :param temp_moves: list of dictionaries, each with information about the movement of a single cryptocurrency token within a transaction
     :param currency: string, name of currency used (usually 'aud')
+    :param source: where the transaction is from (eg. the chain), contract: the address the transaction was sent to and
+    events: names of its log events, used to match classification rules in batch mode
     :return: class_int, the classification as an integer, in_count, the number of different incoming tokens, out_count, the number of different outgoing tokens
     """
 
     in_count = len([True for move in temp_moves if move['direction'] == 'in'])
     out_count = len([True for move in temp_moves if move['direction'] == 'out'])
 
+    # in batch mode, use the classification from the rules file if there is one for this transaction
+    class_rule = match_classification(source, temp_moves, contract, events)
+    if class_rule is not None:
+        class_int = classification_number(class_rule)
+        print(f"Classified as {CLASSIFICATIONS[class_int]} by the rules file")
+        return class_int, in_count, out_count
+
     # classifications = {1: 'Buy + Sell',
     #                    2: 'Buy',
     #                    3: 'Sell',
@@ -887,9 +1157,9 @@ def add_transaction_to_transaction_bank(class_int, transaction_bank, temp_moves,
     elif class_int == 5:  # Unstaking + Income
         for move in temp_moves:
             print(f"Token: {move}")
-            income = input("Are some of these tokens income (tokens that you did not stake)? (y/N) ")
+            income = ask("Are some of these tokens income (tokens that you did not stake)? (y/N) ")
             if income.lower() == "y":
-                all_income = input("Are ALL of these tokens income? (Y/n) ")
+                all_income = ask("Are ALL of these tokens income? (Y/n) ")
                 if all_income.lower() == "n":
                     income_amount = get_user_input("How many units are income?", 'float')
                     income_prop = income_amount / move['quantity']
@@ -921,27 +1191,155 @@ def add_transaction_to_transaction_bank(class_int, transaction_bank, temp_moves,
         # add transactions with outgoing tokens (gifts
         add_transactions_no_opposite(transaction_bank, out_moves, out_count, out_values, gas_fee_fiat, transaction_time, TransactionType.SELL, 1)
     elif class_int in [4, 9]:
-        _ = input('No taxable transactions... (Press enter to continue)')
+        _ = ask('No taxable transactions... (Press enter to continue)', '')
+
+
+def group_onchain_transactions(df):
+    """
+    Split a dataframe of on-chain log event rows into the rows belonging to each transaction, in a single pass rather
+    than filtering the whole dataframe once per transaction hash.
+    :param df: dataframe of log event rows, as exported from covalent
+    :return: dictionary mapping each transaction hash that has at least one token transfer to a dictionary with
+    'transfers' (its Transfer event rows), 'swaps' (its Swap event rows) and 'events' (the set of names of all its
+    log events), in order of first appearance in df
+    """
+    transfers = df[df["log_events_decoded_signature"] == TRANSFER_SIGNATURE]
+    swaps = df[df["log_events_decoded_signature"] == SWAP_SIGNATURE]
+    no_swaps = swaps.iloc[0:0]
+
+    transaction_groups = {transaction_hash: {'transfers': rows, 'swaps': no_swaps, 'events': set()}
+                          for transaction_hash, rows in transfers.groupby('tx_hash', sort=False)}
+    for transaction_hash, rows in swaps.groupby('tx_hash', sort=False):
+        if transaction_hash in transaction_groups:
+            transaction_groups[transaction_hash]['swaps'] = rows
+
+    # names of the events, eg. 'Transfer' from 'Transfer(indexed address from, ...)'
+    event_names = df["log_events_decoded_signature"].dropna().str.split('(').str[0]
+    for transaction_hash, names in event_names.groupby(df["tx_hash"][event_names.index], sort=False):
+        if transaction_hash in transaction_groups:
+            transaction_groups[transaction_hash]['events'] = set(names)
+    return transaction_groups
+
+
+def onchain_transaction_rows(rows):
+    """
+    Split the log event rows of a single transaction in the same way as group_onchain_transactions.
+    :param rows: dataframe of the transaction's log event rows
+    :return: dictionary with 'transfers', 'swaps' and 'events', or None if the transaction has no token transfers
+    """
+    signatures = rows["log_events_decoded_signature"]
+    transfers = rows[signatures == TRANSFER_SIGNATURE]
+    if len(transfers.index) == 0:
+        return None
+    return {'transfers': transfers,
+            'swaps': rows[signatures == SWAP_SIGNATURE],
+            'events': set(signatures.dropna().str.split('(').str[0])}
+
+
+def normalise_onchain_chunk(chunk):
+    # addresses are compared in lower case, as they are when downloaded (see utils.filter_transactions)
+    for column in ['from_address', 'to_address', 'log_events_decoded_params_value']:
+        chunk[column] = chunk[column].str.lower()
+    return chunk
+
+
+def read_onchain_chunks(filenames, start_date, end_date, reverse=()):
+    """Read covalent exports a chunk at a time, see ingest.read_csv_chunks."""
+    return read_csv_chunks(filenames, 'block_signed_at', ONCHAIN_TIME_FORMAT, start_date, end_date,
+                           dtype=ONCHAIN_DTYPES, usecols=list(ONCHAIN_DTYPES.keys()), normalise=normalise_onchain_chunk,
+                           reverse=reverse)
+
+
+def read_onchain_file_groups(filename, start_date, end_date, descending=False):
+    """
+    Read the rows of each transaction in a covalent export, oldest first.
+    :param descending: whether the file is in order of newest first, as files exported from covalent's website are,
+    in which case it is read from the last row to the first
+    :return: generator of (transaction hash, dataframe of its rows) tuples
+    """
+    reverse = [filename] if descending else []
+    for transaction_hash, rows in iter_hash_groups(read_onchain_chunks([filename], start_date, end_date, reverse), 'tx_hash'):
+        # the rows of each transaction are kept in the order they were exported
+        yield transaction_hash, rows.iloc[::-1] if descending else rows
+
 
+def scan_onchain_files(filenames, start_date, end_date):
+    """
+    Read through covalent exports a chunk at a time to find what they cover.
+    :param filenames: list of csv files
+    :param start_date: datetime object of earliest date to get transactions from
+    :param end_date: datetime object of latest date to get transactions from
+    :return: (token_times, first time, last time, latest block, descending), where token_times maps the ticker of
+    each token transferred to the (earliest time, latest time) it was transferred, see prefetch_coingecko_prices. The
+    times and block are None if there are no rows in the date range. descending is the set of files that are in order
+    of newest first
+    """
+    token_times = dict()
+    first_time, last_time, end_block = None, None, None
+    descending = set()
+    # read the same way as the transactions are read later, so that files are only parsed once (see ingest.py)
+    for filename in filenames:
+        first_block, last_block = None, None
+        for chunk in read_onchain_chunks([filename], start_date, end_date):
+            if len(chunk.index) == 0:
+                continue
+            if first_block is None:
+                first_block = int(chunk['block_height'].iloc[0])
+            last_block = int(chunk['block_height'].iloc[-1])
+            first_time, last_time, end_block = scan_onchain_chunk(chunk, token_times, first_time, last_time, end_block)
+        if first_block is not None and first_block > last_block:
+            descending.add(filename)
+    return token_times, first_time, last_time, end_block, descending
+
+
+def scan_onchain_chunk(chunk, token_times, first_time, last_time, end_block):
+    """Add what a chunk of covalent export rows covers to what has been found so far, see scan_onchain_files."""
+    chunk_first, chunk_last = chunk['block_signed_at'].min(), chunk['block_signed_at'].max()
+    first_time = chunk_first if first_time is None else min(first_time, chunk_first)
+    last_time = chunk_last if last_time is None else max(last_time, chunk_last)
+    chunk_block = int(chunk['block_height'].max())
+    end_block = chunk_block if end_block is None else max(end_block, chunk_block)
+
+    transfers = chunk[chunk['log_events_decoded_signature'] == TRANSFER_SIGNATURE]
+    time_ranges = transfers.groupby('log_events_sender_contract_ticker_symbol')['block_signed_at'].agg(['min', 'max'])
+    for token, row in time_ranges.iterrows():
+        if token in token_times:
+            token_times[token] = (min(token_times[token][0], row['min']), max(token_times[token][1], row['max']))
+        else:
+            token_times[token] = (row['min'], row['max'])
+    return first_time, last_time, end_block
 
-def parse_onchain_transactions(chain, wallet, df, transaction_hash, currency='aud', checking_price=False):
+
+def parse_onchain_transactions(chain, wallet, transaction_rows, transaction_hash, currency='aud', checking_price=False, internal_transactions=None):
+    """
+    Parse the token movements in and out of a wallet in a single on-chain transaction.
+    :param chain: the chain that we are currently working on
+    :param wallet: string of wallet address
+    :param transaction_rows: the rows of this transaction from group_onchain_transactions, a dictionary with
+    'transfers' and 'swaps' dataframes
+    :param transaction_hash: hash of the transaction
+    :param currency: fiat currency, usually 'aud'
+    :param checking_price: if True, this transaction is only being used to estimate a price so the user isn't asked
+    to make changes
+    :param internal_transactions: the wallet's internal transactions indexed by hash, from get_internal_transactions. If
+    not given, the internal transactions of this hash are requested from the chain's api
+    :return: transaction_time, temp_moves, a list of token movement dictionaries, and gas_fee_fiat
+    """
     # setup object to store intermediate information about ingoing and outgoing tokens
     temp_moves = []
 
     # get token transfers associated with hash
-    transaction_df = df[(df['tx_hash'] == transaction_hash)
-                        & (df["log_events_decoded_signature"] == "Transfer(indexed address from, indexed address to, uint256 value)")]
+    transaction_df = transaction_rows['transfers']
     transaction_time = transaction_df['block_signed_at'].iloc[0]
 
     # get gas fee from transaction
-    transaction_df['gas_spent'] = pd.to_numeric(transaction_df['gas_spent'], errors='coerce')
-    transaction_df['gas_price'] = pd.to_numeric(transaction_df['gas_price'], errors='coerce')
-    gas_fee_native_token = max(transaction_df['gas_spent'] * transaction_df['gas_price'] / 1e18)
+    gas_spent = pd.to_numeric(transaction_df['gas_spent'], errors='coerce')
+    gas_price = pd.to_numeric(transaction_df['gas_price'], errors='coerce')
+    gas_fee_native_token = max(gas_spent * gas_price / 1e18)
     gas_fee_fiat = gas_fee_native_token * get_token_price(NATIVE_TOKEN[chain], None, transaction_time, chain, transaction_hash, None, currency)
 
     # get incoming tokens from token transfers
-    in_mask = (transaction_df['log_events_decoded_signature'] == 'Transfer(indexed address from, indexed address to, uint256 value)') \
-              & (transaction_df['log_events_decoded_params_name'] == 'to') \
+    in_mask = (transaction_df['log_events_decoded_params_name'] == 'to') \
               & (transaction_df['log_events_decoded_params_value'] == wallet.lower())
     in_indicies = transaction_df.index[in_mask]
 
@@ -955,8 +1353,7 @@ def parse_onchain_transactions(chain, wallet, df, transaction_hash, currency='au
                                'quantity': quantity})
 
     # get outgoing tokens from token transfers
-    out_mask = ((transaction_df['log_events_decoded_signature'] == 'Transfer(indexed address from, indexed address to, uint256 value)')
-                & (transaction_df['log_events_decoded_params_name'] == 'from')
+    out_mask = ((transaction_df['log_events_decoded_params_name'] == 'from')
                 & (transaction_df['log_events_decoded_params_value'] == wallet.lower())
                 )
     out_indicies = transaction_df.index[out_mask]
@@ -971,11 +1368,10 @@ def parse_onchain_transactions(chain, wallet, df, transaction_hash, currency='au
                                'quantity': quantity})
 
     # get internal transactions related to hash
-    api_domains = {'ethereum': 'api.etherscan.io', 'polygon': 'api.polygonscan.com', 'bsc': 'api.bscscan.com', 'fantom': 'api.ftmscan.com'}
-    api_key = get_api_keys()[chain]
-    response = requests.get(f"https://{api_domains[chain]}/api?module=account&action=txlistinternal&txhash={transaction_hash}&apikey={api_key}")
-
-    result = response.json()['result']
+    if internal_transactions is not None:
+        result = internal_transactions.get(transaction_hash, [])
+    else:
+        result = get_internal_transactions_by_hash(chain, transaction_hash)[transaction_hash]
     # print(f"Internal transactions: {result}")
 
     # use temporary dictionary to store information about transaction until more information can be gained so it can be added to transaction bankfixed
@@ -998,9 +1394,7 @@ def parse_onchain_transactions(chain, wallet, df, transaction_hash, currency='au
     # catch these here
 
     # get swaps associated with hash
-    swap_df = df[(df['tx_hash'] == transaction_hash)
-                        & (df["log_events_decoded_signature"] ==
-                           "Swap(indexed address sender, uint256 amount0In, uint256 amount1In, uint256 amount0Out, uint256 amount1Out, indexed address to)")]
+    swap_df = transaction_rows['swaps']
 
     # get moves in each direction
     in_moves = [move for move in temp_moves if move['direction'] == 'in']
@@ -1036,17 +1430,17 @@ def parse_onchain_transactions(chain, wallet, df, transaction_hash, currency='au
         print("Token movements: ")
         for n, move in enumerate(temp_moves):
             print(f"{n + 1}. {move}")
-        changes = input("Would you like to make any changes? (y/N) ")
+        changes = ask("Would you like to make any changes? (y/N) ", 'n')
         if changes.lower() == 'y':
             print("Options: \n1. Remove a transaction \n2. Add a transaction")
-            option = input(f"Select an option: (#/N) ")
+            option = ask(f"Select an option: (#/N) ")
             if option.strip() == '1':
-                remove = input("Which transaction would you like to remove? (#/N) ")
+                remove = ask("Which transaction would you like to remove? (#/N) ")
                 if remove in [str(m) for m in range(1, len(temp_moves)+1)]:
                     del temp_moves[int(remove)-1]
             elif option.strip() == '2':
-                ticker = input("Enter token ticker: ")
-                token_contract = input("Enter token contract address: ")
+                ticker = ask("Enter token ticker: ")
+                token_contract = ask("Enter token contract address: ")
                 direction = get_user_input("Enter token movement direction: (in/out) ", 'direction')
                 quantity = get_user_input("Enter quantity: (#) ", 'float')
                 temp_moves.append({'token': ticker,
@@ -1056,12 +1450,24 @@ def parse_onchain_transactions(chain, wallet, df, transaction_hash, currency='au
     return transaction_time, temp_moves, gas_fee_fiat
 
 
-def read_onchain_transactions(chain, wallet, transaction_bank, processed_transaction_hashes, pickle_file_name, start_date, end_date, currency='aud'):
+def onchain_files(chain, wallet):
+    """
+    Find the exported files of a wallet's transactions: files shared by all wallets on the chain in
+    transaction-files/<chain>, then the wallet's own files from sync_transactions in order of block.
+    """
+    path = os.path.join('transaction-files', chain)
+    wallet_files = glob.glob(os.path.join(wallet_files_dir(chain, wallet), "*.csv"))
+    # synced files are named <first block>-<last block>.csv
+    wallet_files.sort(key=lambda f: int(os.path.basename(f).split('-')[0]) if os.path.basename(f).split('-')[0].isdigit() else 0)
+    return glob.glob(path + "/*.csv") + wallet_files
+
+
+def read_onchain_transactions(chain, wallet, transaction_bank, processed_transaction_hashes, journal, start_date, end_date, currency='aud'):
     """
     Reads in transaction data from an etherscan-based blockchain scanning website and adds transactions to the
     transaction bank.
-    :param pickle_file_name: name of the file used when pickling this session (string)
-    :param processed_transaction_hashes: list of hashes that have already been processed
+    :param journal: SessionJournal that progress is saved to after each transaction
+    :param processed_transaction_hashes: ProcessedHashes of hashes that have already been processed
     :param chain: string of scanning website domain
     :param wallet: string of wallet address
     :param transaction_bank: a dictionary mapping a token to a list of transactions
@@ -1072,58 +1478,38 @@ def read_onchain_transactions(chain, wallet, transaction_bank, processed_transac
     """
     # TODO: check for value way off market value
 
-    # read all files for a given chain into single data frame
-    path = os.path.join('transaction-files', chain)
-    all_files = glob.glob(path + "/*.csv")
+    all_files = onchain_files(chain, wallet)
 
-    df_list = []
+    # first read through the files to find the tokens, dates and blocks covered
+    token_times, first_time, last_time, end_block, descending = scan_onchain_files(all_files, start_date, end_date)
 
-    for filename in all_files:
-        df = pd.read_csv(filename, index_col=None, header=0)
-        df_list.append(df)
+    # fetch prices for all the tokens in these transactions (and the native token used for gas) up front
+    prefetch_coingecko_prices(token_times, currency)
+    if first_time is not None:
+        prefetch_coingecko_prices({NATIVE_TOKEN[chain]: (first_time, last_time)}, currency)
 
-    df = pd.concat(df_list, axis=0, ignore_index=True)
+    # get all of the wallet's internal transactions up front, rather than requesting them for each transaction
+    internal_transactions = get_internal_transactions(chain, wallet, end_block)
 
-    # get only transactions within date range
-    df['block_signed_at'] = pd.to_datetime(df['block_signed_at'], format="%Y-%m-%dT%H:%M:%SZ")
-    df = df[(df['block_signed_at'] >= start_date) & (df['block_signed_at'] < end_date)]
-    df.sort_values(by='block_signed_at', inplace=True)
+    # transactions are read from the files one at a time, oldest first across all of the files
+    # transactions without any token transfers are skipped
+    def transaction_groups():
+        file_groups = [read_onchain_file_groups(filename, start_date, end_date, filename in descending) for filename in all_files]
+        for group_hash, rows in heapq.merge(*file_groups, key=lambda group: group[1]['block_signed_at'].iloc[0]):
+            group = onchain_transaction_rows(rows)
+            if group is not None:
+                yield group_hash, group
 
-    # fix types
-    df['gas_spent'] = pd.to_numeric(df['gas_spent'], errors='coerce')
-    df['gas_price'] = pd.to_numeric(df['gas_price'], errors='coerce')
-
-    # get unique transaction hashes, removing those that have been previously processed
-    transaction_hashes = list(dict.fromkeys(df['tx_hash']))
-
-    # iterate through transaction hashes, parsing them and adding transactions to transaction bank
-    while len(transaction_hashes) > 0:
-        transaction_hash = transaction_hashes.pop(0)
-        if transaction_hash in processed_transaction_hashes:
-            continue
-        transaction_df = df[(df['tx_hash'] == transaction_hash)
-                            & (df["log_events_decoded_signature"] == "Transfer(indexed address from, indexed address to, uint256 value)")]
-        if len(transaction_df) == 0:
-            continue
-        # parse transaction token movements into a dictionary 'temp_moves'
-        print("-------------------------------------------------------------------------------------------------")
-        print(f"Transaction hash: {transaction_hash}")
-        transaction_time = transaction_df['block_signed_at'].iloc[0]
-        print(f"Transaction time: {transaction_time}")
-        transaction_time, temp_moves, gas_fee_fiat = parse_onchain_transactions(chain, wallet, df, transaction_hash, currency)
-
-        # you may not want to process now if the prices will be easier to find after processing future transactions
-        # only ask if more than one of the tokens are not in the coingecko lookup dict and not in the previous prices dict
-        if len([True for move in temp_moves if (move['token'].lower() not in COINGECKOID_LOOKUP.keys() and
-                                                not retrieve_token_price(move['token'], move['token_contract'], transaction_time, verbose=False))]) > 1:
-            process_now = input(f"Would you like to process this transaction now? If not, this transaction will be processed later. "
-                                f"(Prices may be easier to determine after processing future transactions) (y/N) ")
-            if process_now.lower() != 'y':
-                transaction_hashes.append(transaction_hash)
-                continue
+    def unpriced_tokens(temp_moves, transaction_time):
+        # tokens that are not in the coingecko lookup dict and not in the previous prices dict
+        return set(price_key(move['token'], move['token_contract']).lower() for move in temp_moves
+                   if (move['token'].lower() not in coingecko_id_lookup().keys() and
+                       not retrieve_token_price(move['token'], move['token_contract'], transaction_time, verbose=False, currency=currency)))
 
+    def finish_transaction(transaction_hash, transaction_rows, transaction_time, temp_moves, gas_fee_fiat):
         # attempt to classify and check with user
-        class_int, in_count, out_count = classify_transaction(temp_moves, currency)
+        class_int, in_count, out_count = classify_transaction(temp_moves, currency, chain, transaction_rows['transfers']['to_address'].iloc[0],
+                                                              transaction_rows['events'])
 
         # Use classification to add to transaction bank
         add_transaction_to_transaction_bank(class_int, transaction_bank, temp_moves, in_count, out_count, gas_fee_fiat, transaction_time, chain, transaction_hash, currency)
@@ -1131,11 +1517,63 @@ def read_onchain_transactions(chain, wallet, transaction_bank, processed_transac
         # mark transaction hash as processed
         processed_transaction_hashes.append(transaction_hash)
 
-        # pickle progress so far
-        filename = os.path.join(os.path.dirname(__file__), "results", "transactions", f"{pickle_file_name}.p")
-        with open(filename, "wb") as pickle_file:
-            pickle.dump((transaction_bank, processed_transaction_hashes, PREVIOUS_PRICES), pickle_file)
-        print(f"Progress saved to {filename}")
+        # save progress so far
+        save_progress(journal, transaction_hash)
+
+    # transactions the user chose to process later, kept parsed so their questions aren't asked again
+    deferred = DeferredTransactions()
+
+    # iterate through transaction hashes, parsing them and adding transactions to transaction bank
+    for transaction_hash, transaction_rows in transaction_groups():
+        if transaction_hash in processed_transaction_hashes:
+            continue
+        transaction_time = transaction_rows['transfers']['block_signed_at'].iloc[0]
+        # in batch mode, transactions that need a person to answer a question are added to the review queue instead
+        with review_on_failure(transaction_bank, chain, transaction_hash, transaction_time):
+            # parse transaction token movements into a dictionary 'temp_moves'
+            print("-------------------------------------------------------------------------------------------------")
+            print(f"Transaction hash: {transaction_hash}")
+            print(f"Transaction time: {transaction_time}")
+            transaction_time, temp_moves, gas_fee_fiat = parse_onchain_transactions(chain, wallet, transaction_rows, transaction_hash, currency,
+                                                                                     internal_transactions=internal_transactions)
+
+            # you may not want to process now if the prices will be easier to find after processing future transactions
+            # only ask if more than one of the tokens don't have a known price
+            if len(unpriced_tokens(temp_moves, transaction_time)) > 1:
+                process_now = ask(f"Would you like to process this transaction now? If not, this transaction will be processed later. "
+                                  f"(Prices may be easier to determine after processing future transactions) (y/N) ", 'y')
+                if process_now.lower() != 'y':
+                    deferred.add(transaction_hash, (transaction_rows, transaction_time, temp_moves, gas_fee_fiat),
+                                 [price_key(move['token'], move['token_contract']).lower() for move in temp_moves])
+                    continue
+
+            finish_transaction(transaction_hash, transaction_rows, transaction_time, temp_moves, gas_fee_fiat)
+
+    if len(deferred) == 0:
+        return
+
+    # process the transactions left until later in an order where the prices found from earlier ones are used by later
+    # ones, each is processed once, without asking again whether to leave it until later
+    order, stuck = deferred.schedule(lambda item: unpriced_tokens(item[2], item[1]))
+    if stuck:
+        print("-------------------------------------------------------------------------------------------------")
+        print(f"{len(stuck)} of the transactions processed later need prices that can't be found from the other transactions, "
+              f"some of these prices may need to be entered manually:")
+        for transaction_hash, tokens in stuck.items():
+            print(f"{transaction_hash}: {', '.join(sorted(tokens))}")
+    for transaction_hash, (transaction_rows, transaction_time, temp_moves, gas_fee_fiat), forced in order:
+        with review_on_failure(transaction_bank, chain, transaction_hash, transaction_time):
+            print("-------------------------------------------------------------------------------------------------")
+            print(f"Transaction hash: {transaction_hash} (processed later)")
+            print(f"Transaction time: {transaction_time}")
+            if forced:
+                # reached by breaking a cycle, see DeferredTransactions.schedule
+                print("This transaction still needs prices for more than one token, which none of the other transactions left "
+                      "until later can give. It is being processed now so that its prices can be used for the others.")
+            print("Token movements: ")
+            for n, move in enumerate(temp_moves):
+                print(f"{n + 1}. {move}")
+            finish_transaction(transaction_hash, transaction_rows, transaction_time, temp_moves, gas_fee_fiat)
 
 
 def parse_and_classify_binance_transaction(transaction, transaction_time, transaction_hash, currency='aud', silent_income=False):
@@ -1187,17 +1625,17 @@ def parse_and_classify_binance_transaction(transaction, transaction_time, transa
         for n, move in enumerate(temp_moves):
             print(f"{n + 1}. {move}")
         if not (len([True for m in temp_moves if m['direction'] == 'in']) == 1 and len([True for m in temp_moves if m['direction'] == 'out']) == 0 and silent_income):
-            changes = input("Would you like to make any changes? (y/N) ")
+            changes = ask("Would you like to make any changes? (y/N) ", 'n')
             if changes.lower() == 'y':
                 print("Options: \n1. Remove a transaction \n2. Add a transaction")
-                option = input(f"Select an option: (#/N) ")
+                option = ask(f"Select an option: (#/N) ")
                 if option.strip() == '1':
-                    remove = input("Which transaction would you like to remove? (#/N) ")
+                    remove = ask("Which transaction would you like to remove? (#/N) ")
                     if remove in [str(m) for m in range(1, len(temp_moves)+1)]:
                         del temp_moves[int(remove)-1]
                 elif option.strip() == '2':
-                    ticker = input("Enter token ticker: ")
-                    token_contract = input("Enter token contract address: ")
+                    ticker = ask("Enter token ticker: ")
+                    token_contract = ask("Enter token contract address: ")
                     direction = get_user_input("Enter token movement direction: (in/out) ", 'direction')
                     quantity = get_user_input("Enter quantity: (#) ", 'float')
                     temp_moves.append({'token': ticker,
@@ -1211,7 +1649,7 @@ def parse_and_classify_binance_transaction(transaction, transaction_time, transa
     return temp_moves, gas_fee_fiat, class_int, in_count, out_count
 
 
-def read_binance_csv_beth_staking_2022(transaction_bank, processed_transaction_hashes, pickle_file_name, start_date, end_date, currency='aud'):
+def read_binance_csv_beth_staking_2022(transaction_bank, processed_transaction_hashes, journal, start_date, end_date, currency='aud'):
     """
     Reads in a csv file from binance in 2022 format for locked staking and adds transactions to the transaction bank.
     :param transaction_bank: a dictionary mapping each token to a list of transactions
@@ -1223,57 +1661,47 @@ def read_binance_csv_beth_staking_2022(transaction_bank, processed_transaction_h
     path = os.path.join('transaction-files', 'binance-2022-beth')
     all_files = glob.glob(path + "/*.csv")
 
-    df_list = []
-
-    for filename in all_files:
-        df = pd.read_csv(filename, index_col=None, header=0)
-        df_list.append(df)
+    # only the rows within the date range are kept as the files are read
+    df = read_csv_in_range(all_files, 'UTC_Time', "%Y-%m-%d %H:%M:%S", start_date, end_date,
+                           dtype={'Date(UTC)': str, 'Token': str, 'Amount': np.float64},
+                           rename={'Date(UTC)': 'UTC_Time', 'Token': 'Coin', 'Amount': 'Change'})
 
-    df = pd.concat(df_list, axis=0, ignore_index=True)
-    df.rename(columns={'Date(UTC)': 'UTC_Time', 'Token': 'Coin', 'Amount': 'Change'}, inplace=True)
-    df['UTC_Time'] = pd.to_datetime(df['UTC_Time'], format="%Y-%m-%d %H:%M:%S")
-    transaction_list = []
+    # all BETH interest transactions can be treated as independent
+    moves = df.assign(Operation='interest')
+    transaction_list = group_binance_transactions(moves, np.arange(len(moves.index)))
 
-    # iterate through each row and add to transaction list
-    # all locked staking interest transactions can be treated as independent
-    for index, row in df.iterrows():
-        if start_date <= row['UTC_Time'] < end_date:
-            # add transaction to transaction_list
-            transaction = [('interest', row, index)]
-            transaction_list.append(transaction)
+    # fetch prices for all the coins in these transactions up front
+    prefetch_coingecko_prices_from_frame(moves, 'Coin', 'UTC_Time', currency)
 
-    skip = input(f"Would you like to skip confirmation for income transactions? (y/N) ")
+    skip = ask(f"Would you like to skip confirmation for income transactions? (y/N) ", 'y')
     if skip.lower() == 'y':
         silent_income = True
     else:
         silent_income = False
 
-    for transaction in transaction_list:
+    for transaction_hash, transaction in transaction_list:
         transaction_time = transaction[0][1]['UTC_Time']
-        hash_string = str(transaction_time) + '-' + '-'.join([op + row['Coin'] + str(row['Change']) for op, row, index in transaction])
-        transaction_hash = hashlib.md5(hash_string.encode('utf-8')).hexdigest()
 
         if transaction_hash in processed_transaction_hashes:
             continue
-        print("-------------------------------------------------------------------------------------------------")
+        # in batch mode, transactions that need a person to answer a question are added to the review queue instead
+        with review_on_failure(transaction_bank, 'binance-2022-beth', transaction_hash, transaction_time):
+            print("-------------------------------------------------------------------------------------------------")
 
-        print(f"Transaction hash: {transaction_hash}")
-        print(f"Transaction time: {transaction_time}")
+            print(f"Transaction hash: {transaction_hash}")
+            print(f"Transaction time: {transaction_time}")
 
-        temp_moves, gas_fee_fiat, class_int, in_count, out_count = parse_and_classify_binance_transaction(transaction, transaction_time, transaction_hash, currency, silent_income)
+            temp_moves, gas_fee_fiat, class_int, in_count, out_count = parse_and_classify_binance_transaction(transaction, transaction_time, transaction_hash, currency, silent_income)
 
-        # Use classification to add to transaction bank
-        add_transaction_to_transaction_bank(class_int, transaction_bank, temp_moves, in_count, out_count, gas_fee_fiat, transaction_time, 'binance', transaction_hash, currency,
-                                            silent_income)
+            # Use classification to add to transaction bank
+            add_transaction_to_transaction_bank(class_int, transaction_bank, temp_moves, in_count, out_count, gas_fee_fiat, transaction_time, 'binance', transaction_hash, currency,
+                                                silent_income)
 
-        # mark transaction hash as processed
-        processed_transaction_hashes.append(transaction_hash)
+            # mark transaction hash as processed
+            processed_transaction_hashes.append(transaction_hash)
 
-        # pickle progress so far
-        filename = os.path.join(os.path.dirname(__file__), "results", "transactions", f"{pickle_file_name}.p")
-        with open(filename, "wb") as pickle_file:
-            pickle.dump((transaction_bank, processed_transaction_hashes, PREVIOUS_PRICES), pickle_file)
-        print(f"Progress saved to {filename}")
+            # save progress so far
+            save_progress(journal, transaction_hash)
 
 
 def parse_coin_pair(pair):
@@ -1323,7 +1751,47 @@ def parse_amount_binance(a):
     return float(l[0])
 
 
-def read_binance_csv_trade_2022(transaction_bank, processed_transaction_hashes, pickle_file_name, start_date, end_date, currency='aud'):
+def parse_amounts_binance(amounts):
+    """
+    Vectorised version of parse_amount_binance, converts a series like 0.1583000000BETH into a float series.
+    """
+    numbers = amounts.astype(str).str.extract(r'^([\d.]+)', expand=False)
+    if numbers.isna().any():
+        raise ValueError(f"Could not parse binance amount {amounts[numbers.isna()].iloc[0]}")
+    return numbers.astype(float).values
+
+
+def group_binance_transactions(moves, group_ids):
+    """
+    Group the token movements from a binance csv into transactions and create the hash of each transaction.
+    :param moves: dataframe with 'Operation', 'Coin', 'Change' and 'UTC_Time' columns, where the moves in each
+    transaction are next to each other
+    :param group_ids: array with an id for each row of moves, rows in the same transaction have the same id
+    :return: list of (transaction_hash, transaction) tuples, where each transaction is a list of (operation, row, index)
+    tuples and row is a dictionary with 'Coin', 'Change' and 'UTC_Time'
+    """
+    if len(moves.index) == 0:
+        return []
+    group_ids = np.asarray(group_ids)
+
+    # the hash is made from the time of the transaction and a string for each of its moves
+    move_strings = moves['Operation'] + moves['Coin'] + moves['Change'].map(str)
+    hash_strings = moves['UTC_Time'].dt.strftime('%Y-%m-%d %H:%M:%S').groupby(group_ids, sort=False).first() \
+        + '-' + move_strings.groupby(group_ids, sort=False).agg('-'.join)
+
+    # split the moves at the start of each transaction
+    starts = np.flatnonzero(np.r_[True, group_ids[1:] != group_ids[:-1]])
+    operations = moves['Operation'].tolist()
+    rows = moves[['Coin', 'Change', 'UTC_Time']].to_dict('records')
+    indices = moves.index.tolist()
+    transaction_list = []
+    for hash_string, start, end in zip(hash_strings, starts, np.r_[starts[1:], len(rows)]):
+        transaction = list(zip(operations[start:end], rows[start:end], indices[start:end]))
+        transaction_list.append((hashlib.md5(hash_string.encode('utf-8')).hexdigest(), transaction))
+    return transaction_list
+
+
+def read_binance_csv_trade_2022(transaction_bank, processed_transaction_hashes, journal, start_date, end_date, currency='aud'):
     """
     Reads in a csv file from binance in 2022 format for trades and adds transactions to the transaction bank.
     :param transaction_bank: a dictionary mapping each token to a list of transactions
@@ -1336,71 +1804,62 @@ def read_binance_csv_trade_2022(transaction_bank, processed_transaction_hashes,
     path = os.path.join('transaction-files', 'binance-2022-trade')
     all_files = glob.glob(path + "/*.csv")
 
-    df_list = []
-
-    for filename in all_files:
-        df = pd.read_csv(filename, index_col=None, header=0)
-        df_list.append(df)
-
-    df = pd.concat(df_list, axis=0, ignore_index=True)
-    df.rename(columns={'Date(UTC)': 'UTC_Time'}, inplace=True)
-    df['UTC_Time'] = pd.to_datetime(df['UTC_Time'], format="%Y-%m-%d %H:%M:%S")
-    transaction_list = []
-
-    # iterate through each row and create both the buy and the sell portions
-    temp_transaction = []
-    for index, row in df.iterrows():
-        if start_date <= row['UTC_Time'] < end_date:
-            # add transaction to transaction_list
-            coin1, coin2 = parse_coin_pair(row['Pair'])
-            if row['Side'] == 'BUY':
-                change1 = parse_amount_binance(row['Executed'])
-                change2 = -1 * parse_amount_binance(row['Amount'])
-            elif row['Side'] == 'SELL':
-                change1 = -1 * parse_amount_binance(row['Executed'])
-                change2 = parse_amount_binance(row['Amount'])
-            else:
-                raise Exception("Field 'Side' in csv was neither buy nor sell, it was: {}".format(row['Side']))
-
-            new_row1 = pd.Series(data={'Coin': coin1, 'Change': change1, 'UTC_Time': row['UTC_Time']})
-            new_row2 = pd.Series(data={'Coin': coin2, 'Change': change2, 'UTC_Time': row['UTC_Time']})
-            transaction = [('buyandsell', new_row1, index), ('buyandsell', new_row2, index)]
-            transaction_list.append(transaction)
-
-    skip = input(f"Would you like to skip confirmation for income transactions? (y/N) ")
+    # only the rows within the date range are kept as the files are read
+    df = read_csv_in_range(all_files, 'UTC_Time', "%Y-%m-%d %H:%M:%S", start_date, end_date,
+                           dtype={'Date(UTC)': str, 'Pair': str, 'Side': str, 'Executed': str, 'Amount': str},
+                           rename={'Date(UTC)': 'UTC_Time'})
+
+    # create both the buy and the sell portions of each trade
+    sides = df['Side'][~df['Side'].isin(['BUY', 'SELL'])]
+    if len(sides.index) > 0:
+        raise Exception("Field 'Side' in csv was neither buy nor sell, it was: {}".format(sides.iloc[0]))
+    # each pair only needs to be parsed once
+    coin_pairs = {pair: parse_coin_pair(pair) for pair in df['Pair'].unique()}
+    sign = np.where(df['Side'] == 'BUY', 1, -1)
+    moves1 = pd.DataFrame({'Coin': df['Pair'].map(lambda pair: coin_pairs[pair][0]),
+                           'Change': sign * parse_amounts_binance(df['Executed']),
+                           'UTC_Time': df['UTC_Time']})
+    moves2 = pd.DataFrame({'Coin': df['Pair'].map(lambda pair: coin_pairs[pair][1]),
+                           'Change': -sign * parse_amounts_binance(df['Amount']),
+                           'UTC_Time': df['UTC_Time']})
+    # interleave them so that each trade's two portions are next to each other
+    moves = pd.concat([moves1, moves2]).sort_index(kind='mergesort').assign(Operation='buyandsell')
+    transaction_list = group_binance_transactions(moves, moves.index.values)
+
+    # fetch prices for all the coins in these transactions up front
+    prefetch_coingecko_prices_from_frame(moves, 'Coin', 'UTC_Time', currency)
+
+    skip = ask(f"Would you like to skip confirmation for income transactions? (y/N) ", 'y')
     if skip.lower() == 'y':
         silent_income = True
     else:
         silent_income = False
 
-    for transaction in transaction_list:
+    for transaction_hash, transaction in transaction_list:
         transaction_time = transaction[0][1]['UTC_Time']
-        hash_string = str(transaction_time) + '-' + '-'.join([op+row['Coin']+str(row['Change']) for op, row, index in transaction])
-        transaction_hash = hashlib.md5(hash_string.encode('utf-8')).hexdigest()
 
         if transaction_hash in processed_transaction_hashes:
             continue
-        print("-------------------------------------------------------------------------------------------------")
+        # in batch mode, transactions that need a person to answer a question are added to the review queue instead
+        with review_on_failure(transaction_bank, 'binance-2022-trade', transaction_hash, transaction_time):
+            print("-------------------------------------------------------------------------------------------------")
 
-        print(f"Transaction hash: {transaction_hash}")
-        print(f"Transaction time: {transaction_time}")
+            print(f"Transaction hash: {transaction_hash}")
+            print(f"Transaction time: {transaction_time}")
 
-        temp_moves, gas_fee_fiat, class_int, in_count, out_count = parse_and_classify_binance_transaction(transaction, transaction_time, transaction_hash, currency, silent_income)
+            temp_moves, gas_fee_fiat, class_int, in_count, out_count = parse_and_classify_binance_transaction(transaction, transaction_time, transaction_hash, currency, silent_income)
 
-        # Use classification to add to transaction bank
-        add_transaction_to_transaction_bank(class_int, transaction_bank, temp_moves, in_count, out_count, gas_fee_fiat, transaction_time, 'binance', transaction_hash, currency, silent_income)
+            # Use classification to add to transaction bank
+            add_transaction_to_transaction_bank(class_int, transaction_bank, temp_moves, in_count, out_count, gas_fee_fiat, transaction_time, 'binance', transaction_hash, currency, silent_income)
 
-        # mark transaction hash as processed
-        processed_transaction_hashes.append(transaction_hash)
+            # mark transaction hash as processed
+            processed_transaction_hashes.append(transaction_hash)
 
-        # pickle progress so far
-        filename = os.path.join(os.path.dirname(__file__), "results", "transactions", f"{pickle_file_name}.p")
-        with open(filename, "wb") as pickle_file:
-            pickle.dump((transaction_bank, processed_transaction_hashes, PREVIOUS_PRICES), pickle_file)
-        print(f"Progress saved to {filename}")
+            # save progress so far
+            save_progress(journal, transaction_hash)
 
 
-def read_binance_csv_locked_staking_2022(transaction_bank, processed_transaction_hashes, pickle_file_name, start_date, end_date, currency='aud'):
+def read_binance_csv_locked_staking_2022(transaction_bank, processed_transaction_hashes, journal, start_date, end_date, currency='aud'):
     """
     Reads in a csv file from binance in 2022 format for locked staking and adds transactions to the transaction bank.
     :param transaction_bank: a dictionary mapping each token to a list of transactions
@@ -1412,60 +1871,50 @@ def read_binance_csv_locked_staking_2022(transaction_bank, processed_transaction
     path = os.path.join('transaction-files', 'binance-2022-locked')
     all_files = glob.glob(path + "/*.csv")
 
-    df_list = []
-
-    for filename in all_files:
-        df = pd.read_csv(filename, index_col=None, header=0)
-        df_list.append(df)
+    # only the rows within the date range are kept as the files are read
+    df = read_csv_in_range(all_files, 'UTC_Time', "%Y-%m-%d", start_date, end_date,
+                           dtype={'Date(UTC)': str, 'Coin': str, 'Interest': np.float64},
+                           rename={'Date(UTC)': 'UTC_Time', 'Interest': 'Change'})
 
-    df = pd.concat(df_list, axis=0, ignore_index=True)
-    df.rename(columns={'Date(UTC)': 'UTC_Time', 'Interest': 'Change'}, inplace=True)
-    df['UTC_Time'] = pd.to_datetime(df['UTC_Time'], format="%Y-%m-%d")
-    transaction_list = []
-
-    # iterate through each row and add to transaction list
     # all locked staking interest transactions can be treated as independent
-    for index, row in df.iterrows():
-        if start_date <= row['UTC_Time'] < end_date:
-            # add transaction to transaction_list
-            transaction = [('interest', row, index)]
-            transaction_list.append(transaction)
+    moves = df.assign(Operation='interest')
+    transaction_list = group_binance_transactions(moves, np.arange(len(moves.index)))
+
+    # fetch prices for all the coins in these transactions up front
+    prefetch_coingecko_prices_from_frame(moves, 'Coin', 'UTC_Time', currency)
 
-    skip = input(f"Would you like to skip confirmation for income transactions? (y/N) ")
+    skip = ask(f"Would you like to skip confirmation for income transactions? (y/N) ", 'y')
     if skip.lower() == 'y':
         silent_income = True
     else:
         silent_income = False
 
-    for transaction in transaction_list:
+    for transaction_hash, transaction in transaction_list:
         transaction_time = transaction[0][1]['UTC_Time']
-        hash_string = str(transaction_time) + '-' + '-'.join([op + row['Coin'] + str(row['Change']) for op, row, index in transaction])
-        transaction_hash = hashlib.md5(hash_string.encode('utf-8')).hexdigest()
 
         if transaction_hash in processed_transaction_hashes:
             continue
-        print("-------------------------------------------------------------------------------------------------")
+        # in batch mode, transactions that need a person to answer a question are added to the review queue instead
+        with review_on_failure(transaction_bank, 'binance-2022-locked', transaction_hash, transaction_time):
+            print("-------------------------------------------------------------------------------------------------")
 
-        print(f"Transaction hash: {transaction_hash}")
-        print(f"Transaction time: {transaction_time}")
+            print(f"Transaction hash: {transaction_hash}")
+            print(f"Transaction time: {transaction_time}")
 
-        temp_moves, gas_fee_fiat, class_int, in_count, out_count = parse_and_classify_binance_transaction(transaction, transaction_time, transaction_hash, currency, silent_income)
+            temp_moves, gas_fee_fiat, class_int, in_count, out_count = parse_and_classify_binance_transaction(transaction, transaction_time, transaction_hash, currency, silent_income)
 
-        # Use classification to add to transaction bank
-        add_transaction_to_transaction_bank(class_int, transaction_bank, temp_moves, in_count, out_count, gas_fee_fiat, transaction_time, 'binance', transaction_hash, currency,
-                                            silent_income)
+            # Use classification to add to transaction bank
+            add_transaction_to_transaction_bank(class_int, transaction_bank, temp_moves, in_count, out_count, gas_fee_fiat, transaction_time, 'binance', transaction_hash, currency,
+                                                silent_income)
 
-        # mark transaction hash as processed
-        processed_transaction_hashes.append(transaction_hash)
+            # mark transaction hash as processed
+            processed_transaction_hashes.append(transaction_hash)
 
-        # pickle progress so far
-        filename = os.path.join(os.path.dirname(__file__), "results", "transactions", f"{pickle_file_name}.p")
-        with open(filename, "wb") as pickle_file:
-            pickle.dump((transaction_bank, processed_transaction_hashes, PREVIOUS_PRICES), pickle_file)
-        print(f"Progress saved to {filename}")
+            # save progress so far
+            save_progress(journal, transaction_hash)
 
 
-def read_binance_csv_2021(transaction_bank, processed_transaction_hashes, pickle_file_name, start_date, end_date, currency='aud'):
+def read_binance_csv_2021(transaction_bank, processed_transaction_hashes, journal, start_date, end_date, currency='aud'):
     """
     Reads in a csv file from binance in 2021 format and adds transactions to the transaction bank.
     :param transaction_bank: a dictionary mapping each token to a list of transactions
@@ -1477,71 +1926,58 @@ def read_binance_csv_2021(transaction_bank, processed_transaction_hashes, pickle
     path = os.path.join('transaction-files', 'binance-2021')
     all_files = glob.glob(path + "/*.csv")
 
-    df_list = []
+    # only the rows within the date range are kept as the files are read
+    df = read_csv_in_range(all_files, 'UTC_Time', "%Y-%m-%d %H:%M:%S", start_date, end_date,
+                           dtype={'UTC_Time': str, 'Operation': str, 'Coin': str, 'Change': np.float64})
 
-    for filename in all_files:
-        df = pd.read_csv(filename, index_col=None, header=0)
-        df_list.append(df)
+    # check for any operations that we don't know how to handle
+    operations = df['Operation'].str.lower()
+    unknown = df['Operation'][~operations.isin(BINANCE_IGNORED_OPERATIONS + BINANCE_TAXABLE_OPERATIONS)]
+    if len(unknown.index) > 0:
+        raise Exception(f"Function read_binance_csv cannot handle the operation {unknown.iloc[0]}, code changes will need to be made to handle this.")
 
-    df = pd.concat(df_list, axis=0, ignore_index=True)
-    df['UTC_Time'] = pd.to_datetime(df['UTC_Time'], format="%Y-%m-%d %H:%M:%S")
-    transaction_list = []
-
-    # iterate through each row and group all transactions that happened at the same time
+    # group all transactions that happened at the same time
     # this will make it possible to make the corresponding buy/sell transactions
-    # binance CSVs only go down to the second, so we need to ensure that we are not putting multiple transactions together
-    temp_transaction = []
-    for index, row in df.iterrows():
-        if start_date <= row['UTC_Time'] < end_date:
-            # check whether we've had this time already - if not this is a new transaction
-            if row['UTC_Time'] not in [r['UTC_Time'] for _, r, _ in temp_transaction] and len(temp_transaction) > 0:
-                transaction_list.append(temp_transaction)
-                temp_transaction = []
-
-            # skip any that are not tax relevant
-            if row['Operation'].lower() in ['deposit', 'withdraw', 'pos savings purchase', 'pos savings redemption', 'savings purchase', 'liquid swap add', 'savings principal redemption']:
-                continue
-            # if tax relevant, add to transaction
-            elif row['Operation'].lower() in ['pos savings interest', 'rewards distribution', 'savings interest',
-                                              'fee', 'transaction related', 'buy', 'sell',
-                                              'commission fee shared with you']:
-                temp_transaction.append((row['Operation'], row, index))
-            else:
-                raise Exception(f"Function read_binance_csv cannot handle the operation {row['Operation']}, code changes will need to be made to handle this.")
-    else:
-        transaction_list.append(temp_transaction)
+    # binance CSVs only go down to the second, so we need to ensure that we are not putting multiple transactions together,
+    # so a transaction is a run of consecutive rows with the same time (including rows that are not tax relevant)
+    run_ids = (df['UTC_Time'] != df['UTC_Time'].shift()).cumsum()
+
+    # skip any that are not tax relevant
+    relevant = operations.isin(BINANCE_TAXABLE_OPERATIONS)
+    moves = df[relevant]
+    transaction_list = group_binance_transactions(moves, run_ids[relevant].values)
 
-    skip = input(f"Would you like to skip confirmation for income transactions? (y/N) ")
+    # fetch prices for all the coins in these transactions up front
+    prefetch_coingecko_prices_from_frame(moves, 'Coin', 'UTC_Time', currency)
+
+    skip = ask(f"Would you like to skip confirmation for income transactions? (y/N) ", 'y')
     if skip.lower() == 'y':
         silent_income = True
     else:
         silent_income = False
 
-    for transaction in transaction_list:
+    for transaction_hash, transaction in transaction_list:
         transaction_time = transaction[0][1]['UTC_Time']
-        hash_string = str(transaction_time) + '-' + '-'.join([op+row['Coin']+str(row['Change']) for op, row, index in transaction])
-        transaction_hash = hashlib.md5(hash_string.encode('utf-8')).hexdigest()
 
         if transaction_hash in processed_transaction_hashes:
             continue
-        print("-------------------------------------------------------------------------------------------------")
+        # in batch mode, transactions that need a person to answer a question are added to the review queue instead
+        with review_on_failure(transaction_bank, 'binance-2021', transaction_hash, transaction_time):
+            print("-------------------------------------------------------------------------------------------------")
 
-        print(f"Transaction hash: {transaction_hash}")
-        print(f"Transaction time: {transaction_time}")
+            print(f"Transaction hash: {transaction_hash}")
+            print(f"Transaction time: {transaction_time}")
 
-        temp_moves, gas_fee_fiat, class_int, in_count, out_count = parse_and_classify_binance_transaction(transaction, transaction_time, transaction_hash, currency, silent_income)
+            temp_moves, gas_fee_fiat, class_int, in_count, out_count = parse_and_classify_binance_transaction(transaction, transaction_time, transaction_hash, currency, silent_income)
 
-        # Use classification to add to transaction bank
-        add_transaction_to_transaction_bank(class_int, transaction_bank, temp_moves, in_count, out_count, gas_fee_fiat, transaction_time, 'binance', transaction_hash, currency, silent_income)
+            # Use classification to add to transaction bank
+            add_transaction_to_transaction_bank(class_int, transaction_bank, temp_moves, in_count, out_count, gas_fee_fiat, transaction_time, 'binance', transaction_hash, currency, silent_income)
 
-        # mark transaction hash as processed
-        processed_transaction_hashes.append(transaction_hash)
+            # mark transaction hash as processed
+            processed_transaction_hashes.append(transaction_hash)
 
-        # pickle progress so far
-        filename = os.path.join(os.path.dirname(__file__), "results", "transactions", f"{pickle_file_name}.p")
-        with open(filename, "wb") as pickle_file:
-            pickle.dump((transaction_bank, processed_transaction_hashes, PREVIOUS_PRICES), pickle_file)
-        print(f"Progress saved to {filename}")
+            # save progress so far
+            save_progress(journal, transaction_hash)
 
 
 def parse_and_classify_btcmarkets_transaction(row):
@@ -1577,17 +2013,17 @@ def parse_and_classify_btcmarkets_transaction(row):
         print("Token movements: ")
         for n, move in enumerate(temp_moves):
             print(f"{n + 1}. {move}")
-            changes = input("Would you like to make any changes? (y/N) ")
+            changes = ask("Would you like to make any changes? (y/N) ", 'n')
         if changes.lower() == 'y':
             print("Options: \n1. Remove a transaction \n2. Add a transaction")
-            option = input(f"Select an option: (#/N) ")
+            option = ask(f"Select an option: (#/N) ")
             if option.strip() == '1':
-                remove = input("Which transaction would you like to remove? (#/N) ")
+                remove = ask("Which transaction would you like to remove? (#/N) ")
                 if remove in [str(m) for m in range(1, len(temp_moves)+1)]:
                     del temp_moves[int(remove)-1]
             elif option.strip() == '2':
-                ticker = input("Enter token ticker: ")
-                token_contract = input("Enter token contract address: ")
+                ticker = ask("Enter token ticker: ")
+                token_contract = ask("Enter token contract address: ")
                 direction = get_user_input("Enter token movement direction: (in/out) ", 'direction')
                 quantity = get_user_input("Enter quantity: (#) ", 'float')
                 temp_moves.append({'token': ticker,
@@ -1598,7 +2034,7 @@ def parse_and_classify_btcmarkets_transaction(row):
     return temp_moves, gas_fee_fiat, class_int, in_count, out_count
 
 
-def read_btcmarkets_csv(transaction_bank, processed_transaction_hashes, pickle_file_name, start_date, end_date, currency='aud'):
+def read_btcmarkets_csv(transaction_bank, processed_transaction_hashes, journal, start_date, end_date, currency='aud'):
     """
     Reads in a csv file from btcmarkets and adds transactions to the transaction bank.
     :param transaction_bank: a dictionary mapping each token to a list of transactions
@@ -1610,15 +2046,13 @@ def read_btcmarkets_csv(transaction_bank, processed_transaction_hashes, pickle_f
     path = os.path.join('transaction-files', 'btcmarkets')
     all_files = glob.glob(path + "/*.csv")
 
-    df_list = []
+    # column names can have spaces around them
+    df = read_csv_in_range(all_files, 'creationTime', "%Y-%m-%dT%H:%M:%SZ", rename=lambda x: x.strip())
 
-    for filename in all_files:
-        df = pd.read_csv(filename, index_col=None, header=0)
-        df_list.append(df)
-
-    df = pd.concat(df_list, axis=0, ignore_index=True)
-    df.rename(columns=lambda x: x.strip(), inplace=True)
-    df['creationTime'] = pd.to_datetime(df['creationTime'], format="%Y-%m-%dT%H:%M:%SZ")
+    # fetch prices for all the coins in these transactions up front
+    prefetch_coingecko_prices_from_frame(pd.concat([df[['instrument', 'creationTime']].rename(columns={'instrument': 'Coin'}),
+                                                    df[['currency', 'creationTime']].rename(columns={'currency': 'Coin'})]),
+                                         'Coin', 'creationTime', currency)
 
     # Iterate through each row
 
@@ -1628,24 +2062,23 @@ def read_btcmarkets_csv(transaction_bank, processed_transaction_hashes, pickle_f
 
         if transaction_hash in processed_transaction_hashes:
             continue
-        print("-------------------------------------------------------------------------------------------------")
+        # in batch mode, transactions that need a person to answer a question are added to the review queue instead
+        with review_on_failure(transaction_bank, 'btcmarkets', transaction_hash, transaction_time):
+            print("-------------------------------------------------------------------------------------------------")
 
-        print(f"Transaction hash: {transaction_hash}")
-        print(f"Transaction time: {transaction_time}")
+            print(f"Transaction hash: {transaction_hash}")
+            print(f"Transaction time: {transaction_time}")
 
-        temp_moves, gas_fee_fiat, class_int, in_count, out_count = parse_and_classify_btcmarkets_transaction(row)
+            temp_moves, gas_fee_fiat, class_int, in_count, out_count = parse_and_classify_btcmarkets_transaction(row)
 
-        # Use classification to add to transaction bank
-        add_transaction_to_transaction_bank(class_int, transaction_bank, temp_moves, in_count, out_count, gas_fee_fiat, transaction_time, 'btcmarkets', transaction_hash, currency)
+            # Use classification to add to transaction bank
+            add_transaction_to_transaction_bank(class_int, transaction_bank, temp_moves, in_count, out_count, gas_fee_fiat, transaction_time, 'btcmarkets', transaction_hash, currency)
 
-        # mark transaction hash as processed
-        processed_transaction_hashes.append(transaction_hash)
+            # mark transaction hash as processed
+            processed_transaction_hashes.append(transaction_hash)
 
-        # pickle progress so far
-        filename = os.path.join(os.path.dirname(__file__), "results", "transactions", f"{pickle_file_name}.p")
-        with open(filename, "wb") as pickle_file:
-            pickle.dump((transaction_bank, processed_transaction_hashes, PREVIOUS_PRICES), pickle_file)
-        print(f"Progress saved to {filename}")
+            # save progress so far
+            save_progress(journal, transaction_hash)
 
 
 def parse_and_classify_coinspot_transaction(row, transaction_time, transaction_hash, currency='aud'):
@@ -1683,17 +2116,17 @@ def parse_and_classify_coinspot_transaction(row, transaction_time, transaction_h
         print("Token movements: ")
         for n, move in enumerate(temp_moves):
             print(f"{n + 1}. {move}")
-        changes = input("Would you like to make any changes? (y/N) ")
+        changes = ask("Would you like to make any changes? (y/N) ", 'n')
         if changes.lower() == 'y':
             print("Options: \n1. Remove a transaction \n2. Add a transaction")
-            option = input(f"Select an option: (#/N) ")
+            option = ask(f"Select an option: (#/N) ")
             if option.strip() == '1':
-                remove = input("Which transaction would you like to remove? (#/N) ")
+                remove = ask("Which transaction would you like to remove? (#/N) ")
                 if remove in [str(m) for m in range(1, len(temp_moves)+1)]:
                     del temp_moves[int(remove)-1]
             elif option.strip() == '2':
-                ticker = input("Enter token ticker: ")
-                token_contract = input("Enter token contract address: ")
+                ticker = ask("Enter token ticker: ")
+                token_contract = ask("Enter token contract address: ")
                 direction = get_user_input("Enter token movement direction: (in/out) ", 'direction')
                 quantity = get_user_input("Enter quantity: (#) ", 'float')
                 temp_moves.append({'token': ticker,
@@ -1704,7 +2137,7 @@ def parse_and_classify_coinspot_transaction(row, transaction_time, transaction_h
     return temp_moves, gas_fee_fiat, class_int, in_count, out_count
 
 
-def read_coinspot_csv(transaction_bank, processed_transaction_hashes, pickle_file_name, start_date, end_date, currency='aud'):
+def read_coinspot_csv(transaction_bank, processed_transaction_hashes, journal, start_date, end_date, currency='aud'):
     """
     Reads in a csv file from coinspot and adds transactions to the transaction bank.
     :param transaction_bank: a dictionary mapping each token to a list of transactions
@@ -1716,14 +2149,13 @@ def read_coinspot_csv(transaction_bank, processed_transaction_hashes, pickle_fil
     path = os.path.join('transaction-files', 'coinspot')
     all_files = glob.glob(path + "/*.csv")
 
-    df_list = []
+    df = read_csv_in_range(all_files, 'Transaction Date', "%d/%m/%Y %I:%M %p",
+                           dtype={'Transaction Date': str, 'Type': str, 'Market': str, 'Fee': str})
 
-    for filename in all_files:
-        df = pd.read_csv(filename, index_col=None, header=0)
-        df_list.append(df)
-
-    df = pd.concat(df_list, axis=0, ignore_index=True)
-    df['Transaction Date'] = pd.to_datetime(df['Transaction Date'], format="%d/%m/%Y %I:%M %p")
+    # fetch prices for all the coins in these transactions (and their fees) up front
+    coins = pd.concat([df['Market'].str.split("/").str[0], df['Market'].str.split("/").str[1], df['Fee'].str.split().str[1]])
+    prefetch_coingecko_prices_from_frame(pd.DataFrame({'Coin': coins.values, 'Transaction Date': pd.concat([df['Transaction Date']] * 3).values}),
+                                         'Coin', 'Transaction Date', currency)
 
     # Iterate through each row
 
@@ -1734,113 +2166,136 @@ def read_coinspot_csv(transaction_bank, processed_transaction_hashes, pickle_fil
 
         if transaction_hash in processed_transaction_hashes:
             continue
-        print("-------------------------------------------------------------------------------------------------")
+        # in batch mode, transactions that need a person to answer a question are added to the review queue instead
+        with review_on_failure(transaction_bank, 'coinspot', transaction_hash, transaction_time):
+            print("-------------------------------------------------------------------------------------------------")
 
-        print(f"Transaction hash: {transaction_hash}")
-        print(f"Transaction time: {transaction_time}")
+            print(f"Transaction hash: {transaction_hash}")
+            print(f"Transaction time: {transaction_time}")
 
-        temp_moves, gas_fee_fiat, class_int, in_count, out_count = parse_and_classify_coinspot_transaction(row, transaction_time, transaction_hash, currency)
+            temp_moves, gas_fee_fiat, class_int, in_count, out_count = parse_and_classify_coinspot_transaction(row, transaction_time, transaction_hash, currency)
 
-        # Use classification to add to transaction bank
-        add_transaction_to_transaction_bank(class_int, transaction_bank, temp_moves, in_count, out_count, gas_fee_fiat, transaction_time, 'coinspot', transaction_hash, currency)
+            # Use classification to add to transaction bank
+            add_transaction_to_transaction_bank(class_int, transaction_bank, temp_moves, in_count, out_count, gas_fee_fiat, transaction_time, 'coinspot', transaction_hash, currency)
 
-        # mark transaction hash as processed
-        processed_transaction_hashes.append(transaction_hash)
+            # mark transaction hash as processed
+            processed_transaction_hashes.append(transaction_hash)
+
+            # save progress so far
+            save_progress(journal, transaction_hash)
 
-        # pickle progress so far
-        filename = os.path.join(os.path.dirname(__file__), "results", "transactions", f"{pickle_file_name}.p")
-        with open(filename, "wb") as pickle_file:
-            pickle.dump((transaction_bank, processed_transaction_hashes, PREVIOUS_PRICES), pickle_file)
-        print(f"Progress saved to {filename}")
+
+def apply_coingecko_rules(coingecko_ids):
+    """
+    Use the ticker to coingecko ID mappings from a rules file as if the user had chosen them and asked not to be asked
+    again. A ticker mapped to None is never priced with coingecko.
+    """
+    for token, token_id in coingecko_ids.items():
+        if token_id is None:
+            NOCOINGECKO_NO_CONFIRM.append(str(token).lower())
+        else:
+            COINGECKOID_USER_SELECTIONS[str(token).lower()] = token_id
+            COINGECKO_NO_CONFIRM.append(str(token).lower())
+            TICKERS_NO_CONFIRM.append(str(token).lower())
 
 
 def read_all_transactions():
-    # set up pickling so we can save our progress as we go
+    if batch_mode():
+        apply_coingecko_rules(rule('coingecko_ids'))
+
+    # set up a save file so we can save our progress as we go
     # look for existing files
-    previous = input(f"Would you like to load in classifications from a previous session? (Y/n) ")
+    previous = ask(f"Would you like to load in classifications from a previous session? (Y/n) ", yes_no(rule('load')))
     if previous.lower() != "n":
         file_list = glob.glob(os.path.join(os.path.dirname(__file__), "results", "transactions", "*.p"))
         if file_list:
             print("Existing files:")
             for n, f in enumerate(file_list):
-                print(f"{n+1}. {os.path.basename(f)}")
+                print(f"{n+1}. {describe_session(f)}")
             while True:
-                file_num = input(f"Which existing file would you like to load? (#/n) ")
+                file_num = ask(f"Which existing file would you like to load? (#/n) ", file_answer(file_list, rule('load')))
                 if file_num in [str(m) for m in range(1, len(file_list)+1)]:
-                    with open(file_list[int(file_num)-1], "rb") as pickle_file:
-                        global PREVIOUS_PRICES
-                        (transaction_bank, processed_transaction_hashes, PREVIOUS_PRICES) = pickle.load(pickle_file)
-                    print(f"Loaded transaction hashes: {processed_transaction_hashes}")
-                    pp = pprint.PrettyPrinter()
-                    print("Loaded transactions:")
-                    pp.pprint(transaction_bank)
-                    print(f"Loaded previous prices:")
-                    pp.pprint(PREVIOUS_PRICES)
+                    (transaction_bank, processed_transaction_hashes, previous_prices) = load_session(file_list[int(file_num)-1])
+                    print_session_summary(file_list[int(file_num)-1])
+                    # prices used to be saved with each session, move them into the shared price store
+                    if previous_prices:
+                        PRICE_STORE.import_prices(previous_prices)
+                        print(f"Moved previous prices for {len(previous_prices)} tokens into {PRICE_STORE.filename}")
                     break
                 elif file_num.lower() == 'n':
                     print('No file selected, starting from scratch.')
                     transaction_bank = dict()
-                    processed_transaction_hashes = []
+                    processed_transaction_hashes = ProcessedHashes()
                     break
         else:
             print("No existing files found, starting from scratch.")
             transaction_bank = dict()
-            processed_transaction_hashes = []
+            processed_transaction_hashes = ProcessedHashes()
     else:
         transaction_bank = dict()
-        processed_transaction_hashes = []
+        processed_transaction_hashes = ProcessedHashes()
 
-    pickle_file_name = input(f"What would you like to call this session's save file? ")
+    pickle_file_name = ask(f"What would you like to call this session's save file? ", rule('session'))
+    journal = SessionJournal(pickle_file_name, transaction_bank, processed_transaction_hashes)
 
     print("What time period would you like to process transactions for?")
-    start_date = get_user_input(f"Enter the start date: (YYYY-MM-DD) ", 'date')
-    start_tz = get_user_input(f"What timezone is this date in, as an offset from UTC? (eg. +10, -9 etc.) ", 'int')
+    start_date = get_user_input(f"Enter the start date: (YYYY-MM-DD) ", 'date', rule_date('start_date'))
+    start_tz = get_user_input(f"What timezone is this date in, as an offset from UTC? (eg. +10, -9 etc.) ", 'int', rule('timezone'))
     start_date -= datetime.timedelta(hours=start_tz)
-    end_date = get_user_input(f"Enter the end date (inclusive): (YYYY-MM-DD) ", 'date')
-    end_tz = get_user_input(f"What timezone is this date in, as an offset from UTC? (eg. +10, -9 etc.) ", 'int')
+    end_date = get_user_input(f"Enter the end date (inclusive): (YYYY-MM-DD) ", 'date', rule_date('end_date'))
+    end_tz = get_user_input(f"What timezone is this date in, as an offset from UTC? (eg. +10, -9 etc.) ", 'int', rule('timezone'))
     end_date -= datetime.timedelta(hours=end_tz)
     end_date += datetime.timedelta(days=1)
 
-    process = input(f"Would you like to process Binance 2021 transactions? (Y/n) ")
+    process = ask(f"Would you like to process Binance 2021 transactions? (Y/n) ", source_answer('binance-2021'))
     if process.lower() != "n":
-        read_binance_csv_2021(transaction_bank, processed_transaction_hashes, pickle_file_name, start_date, end_date)
+        read_binance_csv_2021(transaction_bank, processed_transaction_hashes, journal, start_date, end_date)
 
-    process = input(f"Would you like to process Binance 2022 trading transactions? (Y/n) ")
+    process = ask(f"Would you like to process Binance 2022 trading transactions? (Y/n) ", source_answer('binance-2022-trade'))
     if process.lower() != "n":
-        read_binance_csv_trade_2022(transaction_bank, processed_transaction_hashes, pickle_file_name, start_date, end_date)
+        read_binance_csv_trade_2022(transaction_bank, processed_transaction_hashes, journal, start_date, end_date)
 
-    process = input(f"Would you like to process Binance 2022 BETH interest transactions? (Y/n) ")
+    process = ask(f"Would you like to process Binance 2022 BETH interest transactions? (Y/n) ", source_answer('binance-2022-beth'))
     if process.lower() != "n":
-        read_binance_csv_beth_staking_2022(transaction_bank, processed_transaction_hashes, pickle_file_name, start_date, end_date)
+        read_binance_csv_beth_staking_2022(transaction_bank, processed_transaction_hashes, journal, start_date, end_date)
 
-    process = input(f"Would you like to process Binance 2022 locked staking interest transactions? (Y/n) ")
+    process = ask(f"Would you like to process Binance 2022 locked staking interest transactions? (Y/n) ", source_answer('binance-2022-locked'))
     if process.lower() != "n":
-        read_binance_csv_locked_staking_2022(transaction_bank, processed_transaction_hashes, pickle_file_name, start_date, end_date)
+        read_binance_csv_locked_staking_2022(transaction_bank, processed_transaction_hashes, journal, start_date, end_date)
 
-    process = input(f"Would you like to process BTCMarkets transactions? (Y/n) ")
+    process = ask(f"Would you like to process BTCMarkets transactions? (Y/n) ", source_answer('btcmarkets'))
     if process.lower() != "n":
-        read_btcmarkets_csv(transaction_bank, processed_transaction_hashes, pickle_file_name, start_date, end_date)
+        read_btcmarkets_csv(transaction_bank, processed_transaction_hashes, journal, start_date, end_date)
 
-    process = input(f"Would you like to process CoinSpot transactions? (Y/n) ")
+    process = ask(f"Would you like to process CoinSpot transactions? (Y/n) ", source_answer('coinspot'))
     if process.lower() != "n":
-        read_coinspot_csv(transaction_bank, processed_transaction_hashes, pickle_file_name, start_date, end_date)
+        read_coinspot_csv(transaction_bank, processed_transaction_hashes, journal, start_date, end_date)
 
     for chain in ['ethereum', 'bsc', 'polygon', 'fantom']:
-        process = input(f"Would you like to process {chain} transactions? (Y/n) ")
+        process = ask(f"Would you like to process {chain} transactions? (Y/n) ", source_answer(chain))
         if process.lower() != "n":
             with open("wallets.yml") as file:
                 wallets = yaml.load(file)
             for (name, wallet) in wallets.items():
-                wallet_choice = input(f"Would you like to import transactions for wallet {wallet} ({name}) on {chain}? (Y/n) ")
+                wallet_choice = ask(f"Would you like to import transactions for wallet {wallet} ({name}) on {chain}? (Y/n) ", wallet_answer(name, wallet))
                 if wallet_choice.lower() != "n":
                     read_onchain_transactions(chain,
                                               wallet,
                                               transaction_bank,
                                               processed_transaction_hashes,
-                                              pickle_file_name,
+                                              journal,
                                               start_date,
                                               end_date)
 
 
 if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--rules', '-r', help="rules file for processing without prompts, see batch.py")
+    parser.add_argument('--answers', '-a', default=ANSWER_LOG, help="file the answers to questions about transactions are recorded in")
+    parser.add_argument('--replay', action='store_true', help="answer questions from the recorded answers where there is one")
+    args = parser.parse_args()
+    if args.rules:
+        load_rules(args.rules)
+    record_answers(args.answers, args.replay)
+
     read_all_transactions()
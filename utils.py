@@ -4,11 +4,58 @@ from abc import ABC, abstractmethod
 import heapq
 import datetime
 import requests
+import requests.adapters
 import yaml
 import os
+import glob
+import json
+import shutil
 
 import pandas as pd
-from io import StringIO
+from time import sleep, monotonic
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
+import threading
+
+from batch import batch_mode, ask, has_recorded_answer
+
+# requests per second allowed to each api host, the free plan limits of each api
+RATE_LIMITS = {'api.covalenthq.com': 4,
+               'api.coingecko.com': 0.4,
+               'api.etherscan.io': 5,
+               'api.bscscan.com': 5,
+               'api.polygonscan.com': 5,
+               'api.ftmscan.com': 5}
+# number of requests that are made at the same time when fetching concurrently
+MAX_WORKERS = 8
+
+# domains of the etherscan-based api for each chain
+SCAN_API_DOMAINS = {'ethereum': 'api.etherscan.io', 'polygon': 'api.polygonscan.com', 'bsc': 'api.bscscan.com', 'fantom': 'api.ftmscan.com'}
+
+# where internal transactions fetched for each wallet are saved
+INTERNAL_TRANSACTIONS_DIR = os.path.join(os.path.dirname(__file__), 'results', 'cache', 'internal-transactions')
+# largest number of results the etherscan-based apis return for one request
+INTERNAL_TRANSACTIONS_PAGE_SIZE = 10000
+
+# mapping to translate the chain name into it's value
+CHAIN_IDS = {'ethereum': '1', 'polygon': '137', 'bsc': '56', 'fantom': '250'}
+# number of transactions requested from covalent per page
+COVALENT_PAGE_SIZE = 500
+COVALENT_TIME_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+# fields of each transaction, each of its log events and each decoded parameter, which are flattened into the
+# columns of covalent's csv format (see flatten_transactions)
+COVALENT_TRANSACTION_FIELDS = ['block_signed_at', 'block_height', 'tx_hash', 'tx_offset', 'successful', 'from_address',
+                               'from_address_label', 'to_address', 'to_address_label', 'value', 'value_quote',
+                               'gas_offered', 'gas_spent', 'gas_price', 'gas_quote', 'gas_quote_rate']
+COVALENT_LOG_EVENT_FIELDS = ['log_offset', 'sender_contract_decimals', 'sender_name', 'sender_contract_ticker_symbol',
+                             'sender_address', 'sender_address_label', 'raw_log_data']
+COVALENT_PARAM_FIELDS = ['name', 'type', 'indexed', 'decoded', 'value']
+COVALENT_COLUMNS = (COVALENT_TRANSACTION_FIELDS
+                    + [f"log_events_{field}" for field in COVALENT_LOG_EVENT_FIELDS]
+                    + ['log_events_decoded_name', 'log_events_decoded_signature']
+                    + [f"log_events_decoded_params_{field}" for field in COVALENT_PARAM_FIELDS])
+# where the last block synced for each wallet is saved, see sync_transactions
+SYNC_STATE_DIR = os.path.join(os.path.dirname(__file__), 'results', 'cache', 'onchain-sync')
 
 
 class FeatureState:
@@ -89,6 +136,8 @@ class Holding(ABC):
     """
     An object containing a holding of a single token that was bought or gained in a single transaction.
     """
+    __slots__ = ('name', 'time', 'price', 'volume')
+
     def __init__(self, name, time, price, volume):
         self.name = name
         self.time = time
@@ -102,9 +151,66 @@ class Holding(ABC):
         return self.time == other.time
 
 
-def get_user_input(string, dtype):
+class RateLimiter:
+    """
+    Token bucket that limits the rate of requests made to a single host, shared between threads.
+    """
+    def __init__(self, rate):
+        self.rate = rate
+        self.capacity = max(1, rate)
+        self.tokens = self.capacity
+        self.updated = monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        """Block until a request can be made."""
+        while True:
+            with self.lock:
+                now = monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                delay = (1 - self.tokens) / self.rate
+            sleep(delay)
+
+
+RATE_LIMITERS = {host: RateLimiter(rate) for host, rate in RATE_LIMITS.items()}
+
+# session shared by all requests, so that connections to each host are reused
+SESSION = requests.Session()
+SESSION.mount('https://', requests.adapters.HTTPAdapter(pool_connections=len(RATE_LIMITS), pool_maxsize=MAX_WORKERS))
+
+
+def wait_for_rate_limit(host):
+    if host in RATE_LIMITERS:
+        RATE_LIMITERS[host].wait()
+
+
+def http_get(url, params=None):
+    """
+    Make a GET request through the shared session, waiting first if the host's rate limit has been reached.
+    """
+    wait_for_rate_limit(urlparse(url).netloc)
+    return SESSION.get(url, params=params)
+
+
+def fetch_all(function, args_list, max_workers=MAX_WORKERS):
+    """
+    Call function with each tuple of arguments in args_list at the same time using a thread pool.
+    :return: list of the results, in the same order as args_list
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(lambda args: function(*args), args_list))
+
+
+def get_user_input(string, dtype, batch_answer=None):
+    # in batch mode, use the answer from the rules file instead of asking, unless there is a recorded answer
+    if batch_mode() and not has_recorded_answer(string):
+        return ask(string, batch_answer)
     while True:
-        a = input(string)
+        a = ask(string)
         try:
             if dtype == 'float':
                 rtn = float(a)
@@ -132,28 +238,124 @@ def get_api_keys():
     return keys
 
 
-def get_transactions_by_address(chain_id, address, block_signed_at_asc=False, no_logs=False, page_size=500):
+def get_internal_transactions(chain, address, end_block=None):
+    """
+    Get all internal transactions involving an address from the chain's etherscan-based API, indexed by transaction
+    hash. Results are saved per chain and address, only blocks after the last saved block are requested, and nothing
+    is requested at all if the saved transactions already reach end_block.
+    :param chain: chain name, eg. 'bsc'
+    :param address: wallet address
+    :param end_block: the latest block that internal transactions are needed for, if known
+    :return: dictionary mapping transaction hashes to lists of internal transaction dictionaries
+    """
+    filename = os.path.join(INTERNAL_TRANSACTIONS_DIR, f"{chain}-{address.lower()}.json")
+    cache = {'synced_to': 0, 'transactions': []}
+    if os.path.exists(filename):
+        with open(filename) as cache_file:
+            cache = json.load(cache_file)
+
+    if end_block is None or cache['synced_to'] < end_block:
+        print(f"Fetching internal transactions for {address} on {chain}...")
+        api_key = get_api_keys()[chain]
+        start_block = cache['synced_to'] + 1
+        seen = set()
+        while True:
+            result = scan_api_result(chain, {'module': 'account',
+                                             'action': 'txlistinternal',
+                                             'address': address,
+                                             'startblock': start_block,
+                                             'endblock': 99999999,
+                                             'page': 1,
+                                             'offset': INTERNAL_TRANSACTIONS_PAGE_SIZE,
+                                             'sort': 'asc',
+                                             'apikey': api_key})
+            for internal_transaction in result:
+                # pages overlap by a block, so skip any internal transactions already added
+                key = tuple(internal_transaction.get(field) for field in ('hash', 'traceId', 'from', 'to', 'value'))
+                if key not in seen:
+                    seen.add(key)
+                    cache['transactions'].append(internal_transaction)
+                cache['synced_to'] = max(cache['synced_to'], int(internal_transaction['blockNumber']))
+            # the API only returns a limited number of results per request, so keep going from the last block returned
+            if len(result) < INTERNAL_TRANSACTIONS_PAGE_SIZE or int(result[-1]['blockNumber']) == start_block:
+                break
+            start_block = int(result[-1]['blockNumber'])
+
+        if end_block is not None:
+            cache['synced_to'] = max(cache['synced_to'], end_block)
+        os.makedirs(INTERNAL_TRANSACTIONS_DIR, exist_ok=True)
+        with open(filename, 'w') as cache_file:
+            json.dump(cache, cache_file)
+
+    internal_transactions = dict()
+    for internal_transaction in cache['transactions']:
+        internal_transactions.setdefault(internal_transaction['hash'], []).append(internal_transaction)
+    return internal_transactions
+
+
+def scan_api_result(chain, params):
+    """
+    Make a request to the chain's etherscan-based API and return the result list, retrying if the rate limit is hit.
+    """
+    for i in range(5):
+        response = http_get(f"https://{SCAN_API_DOMAINS[chain]}/api", params=params).json()
+        if isinstance(response['result'], list):
+            return response['result']
+        print(f"Request error from {SCAN_API_DOMAINS[chain]}: {response['result']}")
+        sleep(1)
+    raise Exception(f"Could not get a result from {SCAN_API_DOMAINS[chain]}")
+
+
+def get_internal_transactions_by_hash(chain, transaction_hash):
+    """
+    Get the internal transactions of a single transaction from the chain's etherscan-based API.
+    :return: dictionary mapping the transaction hash to its list of internal transaction dictionaries
+    """
+    api_key = get_api_keys()[chain]
+    result = scan_api_result(chain, {'module': 'account', 'action': 'txlistinternal', 'txhash': transaction_hash, 'apikey': api_key})
+    return {transaction_hash: result}
+
+
+def get_transactions_by_address(chain_id, address, block_signed_at_asc=False, no_logs=False, page_size=COVALENT_PAGE_SIZE, max_pages=None):
     '''
     Retrieve all transactions for address including their decoded log events.
     This endpoint does a deep-crawl of the blockchain to retrieve all kinds
     of transactions that references the address.
+    :param max_pages: the most pages to request, or None to follow the pagination until there are no more
+    :return: dataframe with a row per decoded log event parameter, see flatten_transactions
     '''
+    pages = []
+    for df in get_transaction_pages_by_address(chain_id, address, block_signed_at_asc, no_logs, page_size):
+        pages.append(df)
+        if max_pages is not None and len(pages) >= max_pages:
+            break
+    return pd.concat(pages, axis=0, ignore_index=True)
+
 
+def get_transaction_pages_by_address(chain_id, address, block_signed_at_asc=False, no_logs=False, page_size=COVALENT_PAGE_SIZE):
+    """
+    Retrieve the transactions of an address a page at a time, following the pagination until there are no more.
+    :return: generator of a dataframe for each page, see flatten_transactions
+    """
     method_url = f'/v1/{chain_id}/address/{address}/transactions_v2/'
 
     api_key = get_api_keys()['covalent']
 
-    params = {
-        'block-signed-at-asc': block_signed_at_asc,
-        'no-logs': no_logs,
-        'format': 'json',
-        'key': api_key,
-        'page-size': page_size,
-    }
-
-    result = query(method_url, params)
-
-    return result
+    page_number = 0
+    while True:
+        params = {
+            'block-signed-at-asc': block_signed_at_asc,
+            'no-logs': no_logs,
+            'format': 'json',
+            'key': api_key,
+            'page-size': page_size,
+            'page-number': page_number,
+        }
+        data = query_page(method_url, params)
+        yield flatten_transactions(data['items'] if data else [])
+        if not (data and data.get('pagination') and data['pagination'].get('has_more')):
+            break
+        page_number += 1
 
 
 def get_transaction_by_hash(chain_id, tx_hash):
@@ -161,6 +363,7 @@ def get_transaction_by_hash(chain_id, tx_hash):
     Retrieve all transactions for address including their decoded log events.
     This endpoint does a deep-crawl of the blockchain to retrieve all kinds
     of transactions that references the address.
+    :return: dataframe with a row per decoded log event parameter, see flatten_transactions
     '''
 
     method_url = f'/v1/{chain_id}/transaction_v2/{tx_hash}/'
@@ -175,9 +378,9 @@ def get_transaction_by_hash(chain_id, tx_hash):
         'page-size': 500,
     }
 
-    result = query(method_url, params)
+    data = query(method_url, params)
 
-    return result
+    return flatten_transactions(data['items'] if data else [])
 
 
 def query(url, params=None):
@@ -186,60 +389,143 @@ def query(url, params=None):
 
     :param url: path url to query.
     :param params: Dictionary with url parameters
-    :param decode: Json decode the returned response from the server.
+    :return: the 'data' of the json response, or None if the request failed
     '''
-    url = "{}{}".format('https://api.covalenthq.com', url)
-
-    response = requests.get(url, params=params)
+    data = query_page(url, params)
 
-    if response:
-        data = response.json()['data']
+    if data and 'pagination' in data.keys():
+        if data['pagination'] is not None and 'has_more' in data['pagination'].keys():
+            if data['pagination']['has_more']:
+                print("NOTE: not all transactions that meet the criteria have been able to be retrieved. Increase page size if more are needed.")
 
-        if data and 'pagination' in data.keys():
-            if data['pagination'] is not None and 'has_more' in data['pagination'].keys():
-                if data['pagination']['has_more']:
-                    print("NOTE: not all transactions that meet the criteria have been able to be retrieved. Increase page size if more are needed.")
+    return data
 
-    params['format'] = 'csv'
 
-    response_csv = requests.get(url, params=params)
+def query_page(url, params):
+    """
+    Make a single json request to the covalent api.
+    :return: the 'data' of the json response, or None if the request failed
+    """
+    url = "{}{}".format('https://api.covalenthq.com', url)
 
-    result = response_csv.text
+    response = http_get(url, params=params)
+    if response:
+        return response.json()['data']
+    return None
 
-    return result
 
+def covalent_value(value):
+    # values are kept as strings, as in covalent's csv format, as token amounts are too large for any numeric type
+    if value is None:
+        return None
+    if isinstance(value, bool):
+        return str(value).lower()
+    return str(value)
 
-def filter_transactions(result):
 
-    # read in transactions to pandas dataframe
-    df = pd.read_csv(StringIO(result), dtype=str)
+def flatten_transactions(items):
+    """
+    Flatten the transaction items of a covalent json response into a dataframe with a row for each decoded parameter
+    of each log event (with the transaction's details repeated on each row), the same rows that covalent's csv format
+    has. Transactions without log events and log events that couldn't be decoded get a single row.
+    :param items: list of transaction dictionaries from the 'items' of the response
+    :return: dataframe with COVALENT_COLUMNS, with block_signed_at as datetimes, block_height as integers, gas_spent
+    and gas_price as floats, and all other columns as strings
+    """
+    rows = []
+    for item in items:
+        transaction = tuple(covalent_value(item.get(field)) for field in COVALENT_TRANSACTION_FIELDS)
+        for log_event in item.get('log_events') or [dict()]:
+            log_values = tuple(covalent_value(log_event.get(field)) for field in COVALENT_LOG_EVENT_FIELDS)
+            decoded = log_event.get('decoded') or dict()
+            decoded_values = (covalent_value(decoded.get('name')), covalent_value(decoded.get('signature')))
+            for param in decoded.get('params') or [dict()]:
+                rows.append(transaction + log_values + decoded_values
+                            + tuple(covalent_value(param.get(field)) for field in COVALENT_PARAM_FIELDS))
+
+    df = pd.DataFrame.from_records(rows, columns=COVALENT_COLUMNS)
+    df['block_signed_at'] = pd.to_datetime(df['block_signed_at'], format=COVALENT_TIME_FORMAT)
+    df['block_height'] = pd.to_numeric(df['block_height']).astype('Int64')
+    df['gas_spent'] = pd.to_numeric(df['gas_spent'], errors='coerce').astype(float)
+    df['gas_price'] = pd.to_numeric(df['gas_price'], errors='coerce').astype(float)
+    return df
+
+
+def filter_transaction_rows(df):
 
     df["from_address"] = df["from_address"].str.lower()
     df["to_address"] = df["to_address"].str.lower()
     df["log_events_decoded_params_value"] = df["log_events_decoded_params_value"].str.lower()
 
     # only get lines which are not approvals
-    filtered_df = df[(df["log_events_decoded_signature"] != "Approval(indexed address owner, indexed address spender, uint256 value)")]
+    return df[(df["log_events_decoded_signature"] != "Approval(indexed address owner, indexed address spender, uint256 value)")]
 
-    # convert pandas df into csv string
-    filtered_result = filtered_df.to_csv()
 
-    return filtered_result
+def transactions_to_csv(df, filename):
+    """Save a dataframe from flatten_transactions in covalent's csv format."""
+    df = df.assign(block_signed_at=df['block_signed_at'].dt.strftime(COVALENT_TIME_FORMAT))
+    df.to_csv(filename, index=False)
 
 
-def save_transactions(chain, address):
+def sync_state_path(chain, address):
+    return os.path.join(SYNC_STATE_DIR, f"{chain}-{address.lower()}.json")
 
-    # mapping to translate the chain name into it's value
-    chain_ids = {'ethereum': '1', 'polygon': '137', 'bsc': '56', 'fantom': '250'}
 
-    # pull all transaction data
-    data_text = get_transactions_by_address(chain_ids[chain], address)
+def wallet_files_dir(chain, address):
+    # each wallet's synced transactions are kept in their own directory, one file per sync
+    return os.path.join('transaction-files', chain, address.lower())
 
-    # filter transaction data to only get necessary lines
-    data_csv = filter_transactions(data_text)
 
-    # save the filtered data in the correct transaction-files subdirectory
-    filename = os.path.join('transaction-files', chain, 'transactions.csv')
-
-    with open(filename, 'w') as file:
-        file.write(data_csv)
+def sync_transactions(chain, address, full=False):
+    """
+    Download only the transactions of a wallet in blocks after the last sync, and save them as a new file in
+    transaction-files/<chain>/<address>/. Pages are requested newest first, and stop once a page reaches a block that
+    was already synced, so that a wallet that hasn't changed only costs a single page.
+    :param chain: chain name, eg. 'bsc'
+    :param address: wallet address
+    :param full: if True, remove the wallet's synced files and download its whole history again
+    :return: the name of the new file, or None if there were no new transactions
+    """
+    state_filename = sync_state_path(chain, address)
+    directory = wallet_files_dir(chain, address)
+    state = {'synced_to': 0}
+    if full:
+        shutil.rmtree(directory, ignore_errors=True)
+    elif os.path.exists(state_filename) and glob.glob(os.path.join(directory, "*.csv")):
+        with open(state_filename) as state_file:
+            state = json.load(state_file)
+
+    print(f"Syncing {address} on {chain} from block {state['synced_to'] + 1}...")
+    pages = []
+    seen_hashes = set()
+    for df in get_transaction_pages_by_address(CHAIN_IDS[chain], address):
+        if len(df.index) == 0:
+            break
+        page_first_block = int(df['block_height'].min())
+        df = df[df['block_height'] > state['synced_to']]
+        # new transactions push older ones onto later pages while paging, so skip transactions already seen
+        df = df[~df['tx_hash'].isin(seen_hashes)]
+        seen_hashes.update(df['tx_hash'].unique())
+        pages.append(df)
+        if page_first_block <= state['synced_to']:
+            break
+
+    if not pages or sum(len(df.index) for df in pages) == 0:
+        print(f"No new transactions for {address} on {chain}.")
+        return None
+
+    df = filter_transaction_rows(pd.concat(pages, axis=0, ignore_index=True))
+    # oldest first, keeping the rows of each transaction together and in order
+    df = df.iloc[df['block_height'].to_numpy(dtype='int64').argsort(kind='mergesort')]
+    first_block, last_block = int(df['block_height'].min()), int(df['block_height'].max())
+
+    os.makedirs(directory, exist_ok=True)
+    filename = os.path.join(directory, f"{first_block}-{last_block}.csv")
+    transactions_to_csv(df, filename)
+
+    state['synced_to'] = max(state['synced_to'], last_block)
+    os.makedirs(SYNC_STATE_DIR, exist_ok=True)
+    with open(state_filename, 'w') as state_file:
+        json.dump(state, state_file)
+    print(f"Saved {df['tx_hash'].nunique()} new transactions for {address} on {chain} to {filename}")
+    return filename